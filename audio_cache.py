@@ -0,0 +1,99 @@
+import os
+import shutil
+import threading
+
+from utility_functions import content_key, sharded_path
+
+class AudioCache:
+    # Persistent, content-addressed store for synthesized audio chunks.
+    # Entries are named by a hash of the chunk text plus voice, language and encoding, so the same chunk is only paid for once,
+    # no matter which document, run or chunk index it shows up at.
+    # Size is capped at max_bytes (None = no cap), least recently used entries go first (mtime is refreshed on every hit)
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # Workers store entries concurrently, the lock keeps the size bookkeeping and eviction consistent
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._total_bytes = sum(size for _, _, size in self._scan_entries())
+
+    @staticmethod
+    def make_key(text, voice_name, language_code, audio_encoding):
+        return content_key(text, voice_name, language_code, audio_encoding)
+
+    def _entry_path(self, key):
+        return sharded_path(self.cache_dir, key, ".audio")
+
+    def contains(self, key):
+        # Lookup without counting as a use, for cost estimates
+        return os.path.exists(self._entry_path(key))
+
+    def fetch(self, key, destination_path):
+        # Copies a cached entry to destination_path, returns False on a miss or if the copy fails
+        entry_path = self._entry_path(key)
+        partial_path = destination_path + ".part"
+        try:
+            # Touched first, so eviction sees it as just used and leaves it alone while it is copied
+            os.utime(entry_path)
+            shutil.copyfile(entry_path, partial_path)
+            os.replace(partial_path, destination_path)
+            return True
+        except OSError as e:
+            # Not cached, evicted between the check and the copy, or unreadable/disk full: nothing half-written stays behind
+            if not isinstance(e, FileNotFoundError):
+                print(f"!!! Warning: Could not read chunk from audio cache: {e}")
+            for path in (partial_path, destination_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            return False
+
+    def store(self, key, source_path):
+        # Adds a finished audio file to the cache, failures only cost a future cache miss so they are reported and ignored
+        entry_path = self._entry_path(key)
+        if os.path.exists(entry_path):
+            return
+        try:
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            partial_path = f"{entry_path}.{threading.get_ident()}.part"
+            shutil.copyfile(source_path, partial_path)
+            os.replace(partial_path, entry_path)
+            size = os.path.getsize(entry_path)
+        except OSError as e:
+            print(f"!!! Warning: Could not store chunk in audio cache: {e}")
+            return
+
+        with self._lock:
+            self._total_bytes += size
+            if self.max_bytes and self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _scan_entries(self):
+        # Yields (mtime, path, size) of every entry on disk
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".audio"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, path, stat.st_size
+
+    def _evict(self):
+        # Drops least recently used entries until the cache is back under 90% of its cap,
+        # the headroom means a full cache isn't rescanned on every single store
+        target_bytes = int(self.max_bytes * 0.9)
+        entries = sorted(self._scan_entries())
+        self._total_bytes = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self._total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+                self._total_bytes -= size
+            except FileNotFoundError:
+                pass
\ No newline at end of file
@@ -0,0 +1,419 @@
+import os
+import struct
+from collections import namedtuple
+
+# MP3 stitching: chunk files from the TTS API each carry their own ID3 tag and Xing/Info frame,
+# plain concatenation leaves those in the middle of the audiobook and players get the duration/seeking wrong.
+# Here the frames of every chunk are located first (headers only, constant memory), then the audio is copied
+# file-to-file with sendfile behind a single Xing/Info frame that describes the whole book.
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Bitrates in kbps, indexed by [version is MPEG1][layer][bitrate index]
+_BITRATES = {
+    True: {
+        1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    },
+    False: {
+        1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    },
+}
+# Sample rates indexed by version bits (0 = MPEG2.5, 2 = MPEG2, 3 = MPEG1)
+_SAMPLE_RATES = {
+    0: (11025, 12000, 8000),
+    2: (22050, 24000, 16000),
+    3: (44100, 48000, 32000),
+}
+
+FrameHeader = namedtuple("FrameHeader", "raw version_bits layer bitrate_index sample_rate samples_per_frame length mono")
+Mp3FileInfo = namedtuple("Mp3FileInfo", "path spans frame_count audio_bytes first_header bitrates")
+
+def parse_frame_header(header_bytes):
+    # Decodes a 4-byte MPEG audio frame header, returns None if the bytes are not a valid header
+    if len(header_bytes) < 4:
+        return None
+    raw = struct.unpack(">I", header_bytes[:4])[0]
+    if (raw >> 21) & 0x7FF != 0x7FF:
+        return None
+    version_bits = (raw >> 19) & 0x3
+    layer = 4 - ((raw >> 17) & 0x3)
+    bitrate_index = (raw >> 12) & 0xF
+    sample_rate_index = (raw >> 10) & 0x3
+    if version_bits == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        # reserved version/layer, free-format or invalid bitrate, reserved sample rate
+        return None
+
+    is_mpeg1 = version_bits == 3
+    bitrate = _BITRATES[is_mpeg1][layer][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version_bits][sample_rate_index]
+    padding = (raw >> 9) & 0x1
+
+    if layer == 1:
+        samples_per_frame = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples_per_frame = 1152 if (layer == 2 or is_mpeg1) else 576
+        length = samples_per_frame // 8 * bitrate // sample_rate + padding
+
+    mono = ((raw >> 6) & 0x3) == 3
+    return FrameHeader(raw, version_bits, layer, bitrate_index, sample_rate, samples_per_frame, length, mono)
+
+def _side_info_size(header):
+    # Size of the Layer III side info that sits between the frame header and a Xing/Info tag
+    if header.version_bits == 3:
+        return 17 if header.mono else 32
+    return 9 if header.mono else 17
+
+def _id3v2_size(first_bytes):
+    # Total size of an ID3v2 tag at the start of a file (0 if there is none)
+    if len(first_bytes) < 10 or first_bytes[:3] != b"ID3":
+        return 0
+    size = 0
+    for byte in first_bytes[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if first_bytes[5] & 0x10 else 0
+    return 10 + size + footer
+
+def _is_vbr_tag_frame(frame_start_bytes, header):
+    # Encoder-written Xing/Info (LAME) or VBRI (Fraunhofer) frame, describes one chunk and carries no audio
+    offset = 4 + _side_info_size(header)
+    return (frame_start_bytes[offset:offset + 4] in (b"Xing", b"Info")
+            or frame_start_bytes[36:40] == b"VBRI")
+
+def _find_next_frame(in_file, position, end):
+    # Resyncs after garbage: looks for the next offset where two valid frames follow each other
+    while position < end:
+        in_file.seek(position)
+        block = in_file.read(min(COPY_BUFFER_SIZE, end - position))
+        if not block:
+            return None
+        search_from = 0
+        while True:
+            candidate = block.find(b"\xff", search_from)
+            if candidate == -1:
+                break
+            absolute = position + candidate
+            in_file.seek(absolute)
+            header = parse_frame_header(in_file.read(4))
+            if header is not None and absolute + header.length <= end:
+                in_file.seek(absolute + header.length)
+                following = in_file.read(4)
+                if absolute + header.length == end or parse_frame_header(following) is not None:
+                    return absolute
+            search_from = candidate + 1
+        position += len(block)
+    return None
+
+def scan_mp3_file(path):
+    # Finds the audio frames of one MP3 file without loading it: skips ID3v2/ID3v1 tags and a leading Xing/Info frame,
+    # and returns the byte spans holding audio frames plus frame/byte counts
+    file_size = os.path.getsize(path)
+    spans = []
+    bitrates = set()
+    frame_count = 0
+    audio_bytes = 0
+    first_header = None
+
+    with open(path, "rb") as in_file:
+        position = _id3v2_size(in_file.read(10))
+        end = file_size
+        if end - position >= 128:
+            in_file.seek(end - 128)
+            if in_file.read(3) == b"TAG":
+                end -= 128
+
+        span_start = None
+        first_frame = True
+        while position + 4 <= end:
+            in_file.seek(position)
+            frame_start_bytes = in_file.read(48)
+            header = parse_frame_header(frame_start_bytes)
+            if header is None or position + header.length > end:
+                if span_start is not None:
+                    spans.append((span_start, position))
+                    span_start = None
+                next_frame = _find_next_frame(in_file, position + 1, end)
+                if next_frame is None:
+                    break
+                position = next_frame
+                continue
+
+            if first_frame and header.layer == 3 and _is_vbr_tag_frame(frame_start_bytes, header):
+                first_frame = False
+                position += header.length
+                continue
+            first_frame = False
+
+            if span_start is None:
+                span_start = position
+            if first_header is None:
+                first_header = header
+            bitrates.add(header.bitrate_index)
+            frame_count += 1
+            audio_bytes += header.length
+            position += header.length
+
+        if span_start is not None:
+            spans.append((span_start, position))
+
+    return Mp3FileInfo(path, spans, frame_count, audio_bytes, first_header, bitrates)
+
+def get_mp3_duration(path):
+    # Playing time of an MP3 file in seconds, from its frame count
+    info = scan_mp3_file(path)
+    if info.first_header is None:
+        return 0.0
+    return info.frame_count * info.first_header.samples_per_frame / info.first_header.sample_rate
+
+def _build_vbr_tag_frame(file_infos, template, total_frames, total_audio_bytes, is_cbr):
+    # One Xing/Info frame for the whole output: frame count, byte count and a 100-entry seek table (TOC)
+    side_info = _side_info_size(template)
+    needed = 4 + side_info + 4 + 4 + 4 + 4 + 100
+
+    # The tag frame copies the audio format of the first frame, with the smallest bitrate that fits the tag and no CRC/padding
+    is_mpeg1 = template.version_bits == 3
+    header = None
+    for bitrate_index in range(1, 15):
+        raw = (template.raw & ~(0xF << 12) & ~(1 << 9)) | (bitrate_index << 12) | (1 << 16)
+        header = parse_frame_header(struct.pack(">I", raw))
+        if header is not None and header.length >= needed:
+            break
+    if header is None or header.length < needed:
+        return b""
+
+    total_bytes = total_audio_bytes + header.length
+
+    # TOC entry i: position of the frame at i% of the playing time, as a fraction (0-255) of the file size.
+    # Chunk files are CBR, so positions inside a chunk are interpolated from its frame and byte counts
+    toc = bytearray(100)
+    chunk_index = 0
+    frames_before = 0
+    bytes_before = header.length
+    non_empty = [info for info in file_infos if info.frame_count]
+    for percent in range(100):
+        target_frame = total_frames * percent / 100
+        while (chunk_index < len(non_empty) - 1
+               and frames_before + non_empty[chunk_index].frame_count <= target_frame):
+            frames_before += non_empty[chunk_index].frame_count
+            bytes_before += non_empty[chunk_index].audio_bytes
+            chunk_index += 1
+        info = non_empty[chunk_index]
+        byte_position = bytes_before + (target_frame - frames_before) / info.frame_count * info.audio_bytes
+        toc[percent] = min(255, int(256 * byte_position / total_bytes))
+
+    frame = bytearray(header.length)
+    frame[0:4] = struct.pack(">I", header.raw)
+    offset = 4 + side_info
+    frame[offset:offset + 4] = b"Info" if is_cbr else b"Xing"
+    # flags: frames | bytes | TOC
+    frame[offset + 4:offset + 16] = struct.pack(">III", 0x7, total_frames, total_bytes)
+    frame[offset + 16:offset + 116] = toc
+    return bytes(frame)
+
+def _copy_range(in_file, out_file, start, length):
+    # Zero-copy transfer with sendfile where the OS supports it for regular files, buffered copy otherwise
+    out_fd = out_file.fileno()
+    in_fd = in_file.fileno()
+    try:
+        while length > 0:
+            sent = os.sendfile(out_fd, in_fd, start, length)
+            if sent == 0:
+                break
+            start += sent
+            length -= sent
+        if length == 0:
+            return
+    except (AttributeError, OSError):
+        pass
+
+    in_file.seek(start)
+    while length > 0:
+        block = in_file.read(min(COPY_BUFFER_SIZE, length))
+        if not block:
+            break
+        out_file.write(block)
+        length -= len(block)
+
+def stitch_mp3_files(input_files, output_path):
+    # Combines MP3 chunk files into one MP3 with near-constant memory use, returns the total duration in seconds
+    file_infos = [scan_mp3_file(path) for path in input_files]
+
+    audio_infos = [info for info in file_infos if info.first_header is not None]
+    total_frames = sum(info.frame_count for info in audio_infos)
+    total_audio_bytes = sum(info.audio_bytes for info in audio_infos)
+
+    tag_frame = b""
+    duration = 0.0
+    if audio_infos:
+        template = audio_infos[0].first_header
+        formats = {(info.first_header.version_bits, info.first_header.layer, info.first_header.sample_rate) for info in audio_infos}
+        if len(formats) > 1:
+            print("!!! Warning: Chunk files use different sample rates/formats, the combined duration may be off.")
+        bitrates = set().union(*(info.bitrates for info in audio_infos))
+        duration = total_frames * template.samples_per_frame / template.sample_rate
+        if template.layer == 3:
+            tag_frame = _build_vbr_tag_frame(audio_infos, template, total_frames, total_audio_bytes, len(bitrates) == 1)
+
+    # Unbuffered, so sendfile and plain writes land in order
+    with open(output_path, "wb", buffering=0) as out_file:
+        out_file.write(tag_frame)
+        for info in file_infos:
+            with open(info.path, "rb") as in_file:
+                if info.first_header is None:
+                    # Not something we can parse as MP3, keep the bytes rather than silently dropping audio
+                    print(f"!!! Warning: No MP3 frames found in '{info.path}', copying it unchanged.")
+                    _copy_range(in_file, out_file, 0, os.path.getsize(info.path))
+                    continue
+                for start, end in info.spans:
+                    _copy_range(in_file, out_file, start, end - start)
+
+    return duration
+
+
+# Ogg Opus stitching: every chunk from the TTS API is a complete Ogg Opus stream (its own headers, its own pre-skip).
+# Streams are chained one after another (RFC 3533 / RFC 7845 chained streams), which players and decoders follow.
+# Like the MP3 path only page headers are read up front, then whole files are copied with sendfile. Links of a chain
+# may not share a serial number: a chunk that reuses one of an earlier chunk is copied page by page with a new serial
+# (and a recomputed checksum), which is rare since encoders pick serials at random
+
+OGG_CAPTURE_PATTERN = b"OggS"
+OGG_PAGE_HEADER = struct.Struct("<4sBBqIIIB")
+OPUS_GRANULE_RATE = 48000
+
+def _build_ogg_crc_table():
+    # CRC-32 with polynomial 0x04c11db7, not reflected, no final xor (the Ogg variant)
+    table = []
+    for index in range(256):
+        crc = index << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04c11db7) if crc & 0x80000000 else (crc << 1)
+        table.append(crc & 0xffffffff)
+    return tuple(table)
+
+_OGG_CRC_TABLE = _build_ogg_crc_table()
+
+def ogg_crc32(data):
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xffffffff) ^ _OGG_CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+OggPage = namedtuple("OggPage", "header_type granule_position serial sequence segment_table body")
+OggFileInfo = namedtuple("OggFileInfo", "path end serials duration")
+OGG_BOS_FLAG = 0x02
+
+def _read_ogg_page_header(in_file):
+    # (header fields, segment table) of the page at the current position, None if there is no complete page header
+    header = in_file.read(OGG_PAGE_HEADER.size)
+    if len(header) < OGG_PAGE_HEADER.size:
+        return None
+    fields = OGG_PAGE_HEADER.unpack(header)
+    if fields[0] != OGG_CAPTURE_PATTERN or fields[1] != 0:
+        return None
+    segment_table = in_file.read(fields[7])
+    if len(segment_table) < fields[7]:
+        return None
+    return fields, segment_table
+
+def iter_ogg_pages(in_file):
+    # Yields the pages of an Ogg file in order, stops at the first thing that isn't a complete page
+    while True:
+        page_header = _read_ogg_page_header(in_file)
+        if page_header is None:
+            return
+        (_, _, header_type, granule_position, serial, sequence, _, _), segment_table = page_header
+        body = in_file.read(sum(segment_table))
+        if len(body) < sum(segment_table):
+            return
+        yield OggPage(header_type, granule_position, serial, sequence, segment_table, body)
+
+def build_ogg_page(header_type, granule_position, serial, sequence, segment_table, body):
+    # Page bytes with the checksum filled in
+    header = OGG_PAGE_HEADER.pack(OGG_CAPTURE_PATTERN, 0, header_type, granule_position, serial, sequence, 0, len(segment_table))
+    page = bytearray(header + bytes(segment_table) + body)
+    struct.pack_into("<I", page, 22, ogg_crc32(page))
+    return bytes(page)
+
+def scan_ogg_file(path):
+    # Reads page headers only (bodies are skipped, except the OpusHead of each stream for its pre-skip).
+    # The file may itself be a chain (e.g. an earlier stitch): every link's playing time is its last granule position
+    # minus its own pre-skip, the duration is the sum over all links
+    end = 0
+    serials = set()
+    duration = 0.0
+    link_serial = None
+    pre_skip = 0
+    last_granule_position = 0
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as in_file:
+        while True:
+            page_header = _read_ogg_page_header(in_file)
+            if page_header is None:
+                break
+            (_, _, header_type, granule_position, serial, _, _, _), segment_table = page_header
+            body_size = sum(segment_table)
+            if in_file.tell() + body_size > file_size:
+                break
+            serials.add(serial)
+            if header_type & OGG_BOS_FLAG:
+                # A stream's first page carries its OpusHead, a new one starts the next link of the chain
+                head = in_file.read(min(body_size, 12))
+                if head.startswith(b"OpusHead") and len(head) >= 12:
+                    if link_serial is not None:
+                        duration += max(0, last_granule_position - pre_skip) / OPUS_GRANULE_RATE
+                    link_serial = serial
+                    pre_skip = struct.unpack_from("<H", head, 10)[0]
+                    last_granule_position = 0
+                in_file.seek(body_size - len(head), os.SEEK_CUR)
+            else:
+                in_file.seek(body_size, os.SEEK_CUR)
+            if serial == link_serial and granule_position > 0:
+                last_granule_position = granule_position
+            end = in_file.tell()
+    if link_serial is not None:
+        duration += max(0, last_granule_position - pre_skip) / OPUS_GRANULE_RATE
+    return OggFileInfo(path, end, serials, duration)
+
+def get_ogg_opus_duration(path):
+    # Playing time of an Ogg Opus file in seconds, summed over the links if it is a chained file
+    return scan_ogg_file(path).duration
+
+def stitch_ogg_opus_files(input_files, output_path):
+    # Chains Ogg Opus chunk files into one file, returns the total duration in seconds
+    file_infos = [scan_ogg_file(path) for path in input_files]
+    used_serials = set()
+    duration = 0.0
+    # Unbuffered, so sendfile and plain writes land in order
+    with open(output_path, "wb", buffering=0) as out_file:
+        for info in file_infos:
+            if not info.end:
+                print(f"!!! Warning: No Ogg pages found in '{info.path}', skipping it.")
+                continue
+            with open(info.path, "rb") as in_file:
+                if info.serials & used_serials:
+                    new_serials = {}
+                    for serial in sorted(info.serials):
+                        new_serial = serial
+                        while new_serial in used_serials or new_serial in new_serials.values():
+                            new_serial = (new_serial + 1) & 0xffffffff
+                        new_serials[serial] = new_serial
+                    for page in iter_ogg_pages(in_file):
+                        out_file.write(build_ogg_page(page.header_type, page.granule_position, new_serials[page.serial],
+                                                      page.sequence, page.segment_table, page.body))
+                    used_serials.update(new_serials.values())
+                else:
+                    _copy_range(in_file, out_file, 0, info.end)
+                    used_serials.update(info.serials)
+            duration += info.duration
+    return duration
+
+# What chunk files of each supported audio encoding are called and how they are combined
+AudioFormat = namedtuple("AudioFormat", "extension stitch duration")
+AUDIO_FORMATS = {
+    "MP3": AudioFormat(".mp3", stitch_mp3_files, get_mp3_duration),
+    "OGG_OPUS": AudioFormat(".ogg", stitch_ogg_opus_files, get_ogg_opus_duration),
+}
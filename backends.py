@@ -0,0 +1,296 @@
+import io
+import time
+import threading
+
+from rate_limiter import poll_delays
+import metrics
+
+# Backends are what the converter and the AI extractor talk to instead of calling Google directly:
+#   TTS:        synthesize(text, voice_name, language_code, audio_encoding) -> audio bytes
+#               synthesize_ssml(ssml, ...) -> audio bytes, {mark name: seconds into the audio}
+#   extraction: extract(pdf_bytes, prompt, temperature, display_name, on_progress) -> text, plus a .model name
+#   long audio: submit(text, ...) -> job id, poll(job id) -> "running" | "done", download(job id, job name, file)
+# The Google implementations live here, fake_backends has local stand-ins for offline tests and load testing.
+# Both translate their service's errors into the exceptions below, so retry/rate-limit handling is backend independent.
+# Google packages are imported when a Google backend is created, the fakes work without them installed.
+
+class BackendError(Exception):
+    # Request failed for good, retrying the same request won't help
+    pass
+
+class TransientBackendError(BackendError):
+    # Service overloaded (503) or otherwise temporarily unavailable, worth retrying after a pause
+    status_code = 503
+    description = "Server error"
+
+class BackendTimeoutError(TransientBackendError):
+    status_code = 504
+    description = "Timeout (Deadline Exceeded)"
+
+class QuotaExceededError(TransientBackendError):
+    status_code = 429
+    description = "Quota exceeded"
+
+class JobNotFoundError(BackendError):
+    # The service doesn't know the job (expired, or submitted to another service instance), it has to be submitted again
+    pass
+
+class TTSBackend:
+    def synthesize(self, text, voice_name, language_code, audio_encoding):
+        raise NotImplementedError
+
+    def synthesize_ssml(self, ssml, voice_name, language_code, audio_encoding):
+        # Marks the service reports no time for are left out of the dict
+        raise NotImplementedError
+
+class LongAudioBackend:
+    # Whole texts of up to max_job_bytes (UTF-8) synthesized as server-side jobs: submitted, polled, then downloaded.
+    # poll raises BackendError if the job failed. job_name is the name the result is stored under, given at submit
+    max_job_bytes = None
+
+    def submit(self, text, voice_name, language_code, audio_encoding, job_name):
+        raise NotImplementedError
+
+    def poll(self, job_id):
+        raise NotImplementedError
+
+    def download(self, job_id, job_name, out_file):
+        # Writes the job's audio to the binary file object out_file, in pieces
+        raise NotImplementedError
+
+    def discard(self, job_id, job_name):
+        # Called once the audio is saved locally, frees whatever the service keeps for the job
+        pass
+
+class ExtractionBackend:
+    model = None
+
+    def extract(self, pdf_bytes, prompt, temperature, display_name=None, on_progress=None):
+        raise NotImplementedError
+
+class GoogleTTSBackend(TTSBackend):
+    # Google Cloud Text-to-Speech, authenticated through GOOGLE_APPLICATION_CREDENTIALS (see config)
+
+    def __init__(self, timeout=120.0):
+        from config import setup_google_credentials
+        setup_google_credentials()
+        from google.cloud import texttospeech
+        from google.api_core import exceptions as google_exceptions
+
+        self._texttospeech = texttospeech
+        self._timeout = timeout
+        self._client = texttospeech.TextToSpeechClient()
+        # Timepoints are only in the v1beta1 API, that client is created on the first SSML request
+        self._beta_client = None
+        self._beta_client_lock = threading.Lock()
+        # (voice, audio config) request parts per API version and target, built once instead of on every request
+        self._request_configs = {}
+        self._error_map = (
+            (google_exceptions.DeadlineExceeded, BackendTimeoutError),
+            (google_exceptions.TooManyRequests, QuotaExceededError),
+            (google_exceptions.ResourceExhausted, QuotaExceededError),
+            (google_exceptions.ServiceUnavailable, TransientBackendError),
+        )
+
+    def _request_config(self, texttospeech, voice_name, language_code, audio_encoding):
+        key = (texttospeech.__name__, voice_name, language_code, audio_encoding)
+        config = self._request_configs.get(key)
+        if config is None:
+            # Workers may race to build the same one, both results are equal so either can win
+            config = self._request_configs[key] = (
+                texttospeech.VoiceSelectionParams(language_code=language_code, name=voice_name),
+                texttospeech.AudioConfig(audio_encoding=getattr(texttospeech.AudioEncoding, audio_encoding)),
+            )
+        return config
+
+    def synthesize(self, text, voice_name, language_code, audio_encoding):
+        texttospeech = self._texttospeech
+        synthesis_input = texttospeech.SynthesisInput(text=text)
+        voice, audio_config = self._request_config(texttospeech, voice_name, language_code, audio_encoding)
+        try:
+            response = self._client.synthesize_speech(
+                input=synthesis_input,
+                voice=voice,
+                audio_config=audio_config,
+                timeout=self._timeout
+            )
+        except Exception as e:
+            for google_error, backend_error in self._error_map:
+                if isinstance(e, google_error):
+                    raise backend_error(str(e)) from e
+            raise
+        return response.audio_content
+
+    def synthesize_ssml(self, ssml, voice_name, language_code, audio_encoding):
+        # Needs a voice with SSML support (Standard, WaveNet, Neural2, ...), Chirp 3: HD voices reject SSML input
+        from google.cloud import texttospeech_v1beta1
+        with self._beta_client_lock:
+            if self._beta_client is None:
+                self._beta_client = texttospeech_v1beta1.TextToSpeechClient()
+        voice, audio_config = self._request_config(texttospeech_v1beta1, voice_name, language_code, audio_encoding)
+        request = texttospeech_v1beta1.SynthesizeSpeechRequest(
+            input=texttospeech_v1beta1.SynthesisInput(ssml=ssml),
+            voice=voice,
+            audio_config=audio_config,
+            enable_time_pointing=[texttospeech_v1beta1.SynthesizeSpeechRequest.TimepointType.SSML_MARK],
+        )
+        try:
+            response = self._beta_client.synthesize_speech(request=request, timeout=self._timeout)
+        except Exception as e:
+            for google_error, backend_error in self._error_map:
+                if isinstance(e, google_error):
+                    raise backend_error(str(e)) from e
+            raise
+        return response.audio_content, {timepoint.mark_name: timepoint.time_seconds for timepoint in response.timepoints}
+
+class GoogleLongAudioBackend(LongAudioBackend):
+    # Google Cloud Text-to-Speech Long Audio Synthesis: the job writes its audio to a Cloud Storage bucket,
+    # from where it is downloaded and then deleted. Clients are created on first use, constructing this is free
+    max_job_bytes = 1_000_000
+
+    def __init__(self, project_id, gcs_bucket, location="global", timeout=120.0):
+        self.project_id = project_id
+        self.gcs_bucket = gcs_bucket
+        self.location = location
+        self._timeout = timeout
+        self._client = None
+
+    def _connect(self):
+        if self._client is not None:
+            return
+        from config import setup_google_credentials
+        setup_google_credentials()
+        from google.cloud import texttospeech, storage
+        from google.api_core import exceptions as google_exceptions
+
+        self._texttospeech = texttospeech
+        self._not_found = google_exceptions.NotFound
+        self._error_map = (
+            (google_exceptions.DeadlineExceeded, BackendTimeoutError),
+            (google_exceptions.TooManyRequests, QuotaExceededError),
+            (google_exceptions.ResourceExhausted, QuotaExceededError),
+            (google_exceptions.ServiceUnavailable, TransientBackendError),
+        )
+        self._bucket = storage.Client(project=self.project_id).bucket(self.gcs_bucket)
+        self._client = texttospeech.TextToSpeechLongAudioSynthesizeClient()
+
+    def _translate_error(self, e):
+        if isinstance(e, self._not_found):
+            return JobNotFoundError(str(e))
+        for google_error, backend_error in self._error_map:
+            if isinstance(e, google_error):
+                return backend_error(str(e))
+        return None
+
+    def _call(self, function, *args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            translated = self._translate_error(e)
+            if translated is not None:
+                raise translated from e
+            raise
+
+    def submit(self, text, voice_name, language_code, audio_encoding, job_name):
+        self._connect()
+        texttospeech = self._texttospeech
+        request = texttospeech.SynthesizeLongAudioRequest(
+            parent=f"projects/{self.project_id}/locations/{self.location}",
+            input=texttospeech.SynthesisInput(text=text),
+            voice=texttospeech.VoiceSelectionParams(language_code=language_code, name=voice_name),
+            audio_config=texttospeech.AudioConfig(audio_encoding=getattr(texttospeech.AudioEncoding, audio_encoding)),
+            output_gcs_uri=f"gs://{self.gcs_bucket}/{job_name}",
+        )
+        operation = self._call(self._client.synthesize_long_audio, request=request, timeout=self._timeout)
+        return operation.operation.name
+
+    def poll(self, job_id):
+        self._connect()
+        operation = self._call(self._client.transport.operations_client.get_operation, job_id, timeout=self._timeout)
+        if not operation.done:
+            return "running"
+        if operation.error.code:
+            raise BackendError(f"Long audio job failed: {operation.error.message}")
+        return "done"
+
+    def download(self, job_id, job_name, out_file):
+        # download_to_file streams the object in pieces, the audio never has to fit in memory
+        self._connect()
+        self._call(self._bucket.blob(job_name).download_to_file, out_file, timeout=self._timeout)
+
+    def discard(self, job_id, job_name):
+        self._connect()
+        try:
+            self._bucket.blob(job_name).delete(timeout=self._timeout)
+        except Exception as e:
+            print(f"!!! Warning: Could not delete 'gs://{self.gcs_bucket}/{job_name}': {e}")
+
+class GeminiExtractionBackend(ExtractionBackend):
+    # Gemini through google-genai: the sub-PDF is uploaded from memory, used in one streamed generation, then deleted
+
+    def __init__(self, api_key, model):
+        from google import genai
+        from google.genai import types, errors
+
+        self.model = model
+        self._types = types
+        self._api_errors = errors.APIError
+        self._client = genai.Client(api_key=api_key)
+
+    def _translate_error(self, e):
+        if isinstance(e, self._api_errors):
+            if e.code == 429:
+                return QuotaExceededError(str(e))
+            if e.code in (503, 504):
+                return TransientBackendError(str(e)) if e.code == 503 else BackendTimeoutError(str(e))
+        return None
+
+    def extract(self, pdf_bytes, prompt, temperature, display_name=None, on_progress=None):
+        types = self._types
+        sample_file = None
+        try:
+            with metrics.span("gemini.upload"):
+                sample_file = self._client.files.upload(
+                    file=io.BytesIO(pdf_bytes),
+                    config=types.UploadFileConfig(mime_type="application/pdf", display_name=display_name)
+                )
+            metrics.increment("gemini.upload_bytes", len(pdf_bytes))
+            # Small files are usually ready almost at once, checks start quick and slow down for big ones
+            with metrics.span("gemini.file_processing"):
+                delays = poll_delays()
+                while sample_file.state.name == "PROCESSING":
+                    time.sleep(next(delays))
+                    sample_file = self._client.files.get(name=sample_file.name)
+            if sample_file.state.name == "FAILED":
+                raise BackendError(f"Gemini could not process the uploaded file '{display_name}'")
+
+            # Generation time, the first streamed chunk is timed separately as well
+            with metrics.span("gemini.generate", model=self.model):
+                first_chunk_span = metrics.start_span("gemini.first_chunk", model=self.model)
+                response_stream = self._client.models.generate_content_stream(
+                    model=self.model,
+                    contents=[sample_file, prompt],
+                    config=types.GenerateContentConfig(temperature=temperature)
+                )
+                chunk_text_parts = []
+                for chunk in response_stream:
+                    first_chunk_span.finish()
+                    if on_progress:
+                        on_progress()
+                    if chunk.text:
+                        chunk_text_parts.append(chunk.text)
+            return "".join(chunk_text_parts)
+
+        except BackendError:
+            raise
+        except Exception as e:
+            translated = self._translate_error(e)
+            if translated is not None:
+                raise translated from e
+            raise
+        finally:
+            if sample_file is not None:
+                try:
+                    self._client.files.delete(name=sample_file.name)
+                except Exception:
+                    pass
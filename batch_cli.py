@@ -0,0 +1,341 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (PRICE_PER_MILLION_CHARS_HD, TTS_CHUNK_SIZE, MAX_RETRIES, INITIAL_BACKOFF, TTS_MAX_WORKERS,
+                    TTS_VOICE_NAME, TTS_LANGUAGE_CODE, TTS_AUDIO_ENCODING, TTS_REQUESTS_PER_MINUTE, TTS_CHARS_PER_MINUTE,
+                    AUDIO_CACHE_FOLDER, AUDIO_CACHE_MAX_BYTES, PDF_EXTRACTION_WORKERS, GEMINI_MAX_CONCURRENCY,
+                    GEMINI_REQUESTS_PER_MINUTE, GEMINI_RESPONSE_CACHE_FOLDER, PAGE_LAYOUT_CACHE_PATH, METRICS_OUTPUT_PATH,
+                    GOOGLE_CLOUD_PROJECT, TTS_LONG_AUDIO_GCS_BUCKET, TTS_LONG_AUDIO_LOCATION, TTS_LONG_AUDIO_MIN_BYTES,
+                    TTS_LONG_AUDIO_JOB_BYTES, TTS_LONG_AUDIO_MAX_JOBS, TTS_LONG_AUDIO_REQUESTS_PER_MINUTE, TTS_SSML_TIMING,
+                    TEXT_OUTPUT_FOLDER, AUDIO_OUTPUT_FOLDER, EPUB_OUTPUT_FOLDER)
+from utility_functions import calculate_tts_cost, load_custom_fixes_from_file, split_text_for_tts
+from pdf_core_text_extractor import extract_and_clean_pdf_text
+from pdf_AI_text_extractor import extract_text_with_gemini
+from google_ai_tts_converter import synthesize_targets, SynthesisTarget, timing_index_path, uses_long_audio
+from audio_stitcher import AUDIO_FORMATS
+from ssml_builder import build_ssml_chunks
+from epub_creator import create_epub_from_text
+from audio_cache import AudioCache
+from gemini_response_cache import GeminiResponseCache
+from page_layout_cache import PageLayoutCache
+from rate_limiter import get_rate_limiter
+from backends import GoogleLongAudioBackend
+from fake_backends import FakeTTSBackend, FakeExtractionBackend, FakeLongAudioBackend
+import metrics
+
+# Headless counterpart of text_to_speech_suite: PDF -> text -> EPUB -> audio for many documents, no prompts.
+# Extraction runs in the main thread (CPU bound, the core extractor also uses a process pool) while the audio of the
+# previous document is synthesized in a background thread (network bound), so the two overlap.
+# Outputs are named after the PDF, a document whose outputs already exist is skipped unless --overwrite is given.
+#
+# Example:
+#   python batch_cli.py papers/ "more_papers/*.pdf" --pages 2-30 --fixes custom_fixes.txt --summary summary.json --metrics run.prom
+
+# Extracted documents waiting for the audio thread, extraction pauses when it gets this far ahead
+MAX_DOCUMENTS_AHEAD = 2
+# --fake-backends runs write everything (texts, EPUBs, audio, temp chunks, audio and response caches) below this folder.
+# Their audio is hash noise: in the real audio cache it would be stitched into real audiobooks as free "hits", and in the
+# real output folders it would make the next real run skip the document
+FAKE_BACKENDS_FOLDER = "fake_backends_output"
+
+def _run_folder(folder, args):
+    # Where this run keeps what config.py puts in `folder`
+    if not args.fake_backends:
+        return folder
+    if os.path.isabs(folder):
+        folder = os.path.basename(os.path.normpath(folder))
+    return os.path.join(FAKE_BACKENDS_FOLDER, folder)
+
+def find_pdf_files(inputs):
+    # Directories are searched for *.pdf, everything else is treated as a glob pattern (a plain path matches itself)
+    pdf_paths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            matches = glob.glob(os.path.join(pattern, "*.pdf")) + glob.glob(os.path.join(pattern, "*.PDF"))
+        else:
+            matches = glob.glob(pattern)
+        for path in sorted(matches):
+            if path.lower().endswith(".pdf") and path not in pdf_paths:
+                pdf_paths.append(path)
+    return pdf_paths
+
+def parse_page_range(value):
+    # "5-40" -> (4, 40), "5-" -> (4, None), "-40" -> (0, 40): start as 0-based index, end as exclusive index like the extractors
+    try:
+        start_text, _, end_text = value.partition("-")
+        start_page_index = int(start_text) - 1 if start_text.strip() else 0
+        end_page_index = int(end_text) if end_text.strip() else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid page range '{value}', expected e.g. 5-40, 5- or -40")
+    if start_page_index < 0 or (end_page_index is not None and end_page_index <= start_page_index):
+        raise argparse.ArgumentTypeError(f"invalid page range '{value}'")
+    return start_page_index, end_page_index
+
+def build_argument_parser():
+    parser = argparse.ArgumentParser(description="Convert a batch of PDFs to text, EPUB and audio without any prompts.")
+    parser.add_argument("inputs", nargs="+", help="PDF files, directories (all *.pdf inside) or glob patterns")
+    parser.add_argument("--pages", type=parse_page_range, default=(0, None),
+                        help="page range applied to every document, e.g. 5-40, 5- or -40 (default: all pages)")
+    parser.add_argument("--fixes", help="custom replacement rules file (same format as custom_fixes.txt)")
+    parser.add_argument("--extractor", choices=("core", "gemini"), default="core",
+                        help="core = local PyMuPDF extraction (default), gemini = AI extraction")
+    parser.add_argument("--gemini-parallel", action="store_true", help="send Gemini page windows in parallel")
+    parser.add_argument("--gemini-concurrency", type=int, default=GEMINI_MAX_CONCURRENCY,
+                        help=f"Gemini page windows in flight with --gemini-parallel (default {GEMINI_MAX_CONCURRENCY})")
+    parser.add_argument("--extract-workers", type=int, default=PDF_EXTRACTION_WORKERS,
+                        help=f"processes reading page layouts for the core extractor (default {PDF_EXTRACTION_WORKERS})")
+    parser.add_argument("--voice", action="append",
+                        help=f"TTS voice name, repeat for several voices (default {TTS_VOICE_NAME})")
+    parser.add_argument("--encoding", action="append", choices=sorted(AUDIO_FORMATS),
+                        help=f"audio encoding, repeat for several formats (default {TTS_AUDIO_ENCODING})")
+    parser.add_argument("--language", default=TTS_LANGUAGE_CODE, help=f"TTS language code (default {TTS_LANGUAGE_CODE})")
+    parser.add_argument("--tts-workers", type=int, default=TTS_MAX_WORKERS,
+                        help=f"TTS requests in flight per document (default {TTS_MAX_WORKERS})")
+    parser.add_argument("--no-epub", action="store_true", help="skip EPUB creation")
+    parser.add_argument("--no-audio", action="store_true", help="skip audio synthesis")
+    parser.add_argument("--overwrite", action="store_true", help="process documents even if their outputs already exist")
+    parser.add_argument("--summary", help="write the JSON summary to this file (default: print it to stdout, progress goes to stderr)")
+    parser.add_argument("--metrics", default=METRICS_OUTPUT_PATH,
+                        help="write per-stage timings and counters to this file, Prometheus text format for *.prom, "
+                             "JSON lines otherwise")
+    parser.add_argument("--fake-backends", action="store_true",
+                        help="use local stand-ins for the TTS and Gemini services (no API calls, no cost), for load testing. "
+                             f"Outputs and caches then go to {FAKE_BACKENDS_FOLDER}/, apart from real runs")
+    parser.add_argument("--no-long-audio", action="store_true",
+                        help="always synthesize in chunks, never as long audio jobs")
+    parser.add_argument("--ssml", action="store_true", default=TTS_SSML_TIMING,
+                        help="synthesize as SSML with pauses and write a timing index of headings/paragraphs next to the "
+                             "audio (needs a voice with SSML support, e.g. en-US-Neural2-F)")
+    return parser
+
+def _audio_targets(pdf_path, args):
+    # One output per voice and encoding, all synthesized in the same run. The voice is only part of the name when
+    # there are several, so the default single output stays <name>.mp3
+    base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    voices = args.voice or [TTS_VOICE_NAME]
+    encodings = args.encoding or [TTS_AUDIO_ENCODING]
+    targets = []
+    for voice in voices:
+        voice_suffix = f"_{voice}" if len(voices) > 1 else ""
+        for encoding in encodings:
+            output_path = os.path.join(_run_folder(AUDIO_OUTPUT_FOLDER, args), f"{base_name}{voice_suffix}{AUDIO_FORMATS[encoding].extension}")
+            targets.append(SynthesisTarget(output_path, voice, args.language, encoding))
+    return targets
+
+def _output_paths(pdf_path, args):
+    base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    suffix = "_AI_extracted" if args.extractor == "gemini" else "_textract"
+    paths = {"text_path": os.path.join(_run_folder(TEXT_OUTPUT_FOLDER, args), f"{base_name}{suffix}.txt")}
+    if not args.no_epub:
+        paths["epub_path"] = os.path.join(_run_folder(EPUB_OUTPUT_FOLDER, args), f"{base_name}.epub")
+    if not args.no_audio:
+        paths["audio_paths"] = [target.output_filename for target in _audio_targets(pdf_path, args)]
+    return paths
+
+def extract_document(pdf_path, args, custom_fixes, response_cache, gemini_rate_limiter, extraction_backend=None,
+                     layout_cache=None):
+    # Text, text file and EPUB of one document. Returns its summary entry, "text" is added for the audio stage
+    result = {"source": pdf_path, "status": "ok"}
+    result.update(_output_paths(pdf_path, args))
+    start_page_index, end_page_index = args.pages
+
+    output_paths = [path for key, path in result.items() if key.endswith("_path")] + result.get("audio_paths", [])
+    if not args.overwrite and all(os.path.exists(path) for path in output_paths):
+        result["status"] = "skipped"
+        result["reason"] = "outputs already exist"
+        return result
+
+    started = time.perf_counter()
+    extract_span = metrics.start_span("batch.extract", extractor=args.extractor)
+    try:
+        if args.extractor == "gemini":
+            # Custom fixes are a core extractor feature, the AI extraction does its own cleanup
+            text = extract_text_with_gemini(pdf_path, start_page_index, end_page_index,
+                                            parallel=args.gemini_parallel, max_concurrency=args.gemini_concurrency,
+                                            response_cache=response_cache, rate_limiter=gemini_rate_limiter,
+                                            backend=extraction_backend)
+        else:
+            text = extract_and_clean_pdf_text(pdf_path, start_page_index, end_page_index,
+                                              custom_replacements=custom_fixes, workers=args.extract_workers,
+                                              layout_cache=layout_cache)
+    except Exception as e:
+        text = None
+        result["error"] = f"extraction failed: {e}"
+    extract_span.labels["outcome"] = "ok" if text else "failed"
+    extract_span.finish()
+    result["extract_seconds"] = round(time.perf_counter() - started, 3)
+
+    if not text:
+        result["status"] = "failed"
+        result.setdefault("error", "extraction returned no text")
+        return result
+
+    os.makedirs(os.path.dirname(result["text_path"]), exist_ok=True)
+    with open(result["text_path"], "w", encoding="utf-8") as f:
+        f.write(text)
+    result["characters"] = len(text)
+
+    if "epub_path" in result:
+        try:
+            os.makedirs(os.path.dirname(result["epub_path"]), exist_ok=True)
+            with metrics.span("batch.epub"):
+                create_epub_from_text(text, result["epub_path"], title=os.path.splitext(os.path.basename(pdf_path))[0])
+        except Exception as e:
+            result["status"] = "failed"
+            result["error"] = f"EPUB creation failed: {e}"
+
+    result["text"] = text
+    return result
+
+def synthesize_document(result, args, audio_cache, tts_rate_limiter, tts_backend=None, long_audio_backend=None):
+    # Audio stage, runs in the background thread. Fills in the audio fields of the summary entry
+    text = result.pop("text")
+    started = time.perf_counter()
+    synthesis_span = metrics.start_span("batch.synthesis")
+    targets = []
+    # Everything up to the synthesis itself is inside the try too, an error in any of it fails this document only
+    try:
+        # (chunk text, what is sent for it), the cache is keyed by the latter
+        if args.ssml:
+            text_chunks = [(ssml_chunk.text, ssml_chunk.ssml) for ssml_chunk in build_ssml_chunks(text, TTS_CHUNK_SIZE)[1]]
+        else:
+            text_chunks = [(chunk, chunk) for chunk in split_text_for_tts(text, TTS_CHUNK_SIZE)]
+        targets = _audio_targets(result["source"], args)
+        total_characters = sum(len(chunk) for chunk, _ in text_chunks)
+        # Targets made by long audio jobs skip the cache, all of their text is billed
+        cached_characters = sum(len(chunk) for target in targets
+                                if not uses_long_audio(text, target.audio_encoding, args.ssml, long_audio_backend is not None,
+                                                       TTS_LONG_AUDIO_MIN_BYTES)
+                                for chunk, request_text in text_chunks
+                                if audio_cache.contains(AudioCache.make_key(request_text, target.voice_name, target.language_code,
+                                                                            target.audio_encoding)))
+        billable_characters = total_characters * len(targets) - cached_characters
+        result["cached_characters"] = cached_characters
+        result["estimated_cost"] = round(calculate_tts_cost(billable_characters, PRICE_PER_MILLION_CHARS_HD), 4)
+
+        for output_folder in {os.path.dirname(target.output_filename) for target in targets}:
+            os.makedirs(output_folder, exist_ok=True)
+        durations = synthesize_targets(text, targets, PRICE_PER_MILLION_CHARS_HD, TTS_CHUNK_SIZE,
+                                       MAX_RETRIES, INITIAL_BACKOFF, args.tts_workers,
+                                       audio_cache=audio_cache, rate_limiter=tts_rate_limiter, interactive=False,
+                                       backend=tts_backend, long_audio_backend=long_audio_backend,
+                                       long_audio_min_bytes=TTS_LONG_AUDIO_MIN_BYTES, long_audio_job_bytes=TTS_LONG_AUDIO_JOB_BYTES,
+                                       long_audio_max_jobs=TTS_LONG_AUDIO_MAX_JOBS,
+                                       long_audio_rate_limiter=get_rate_limiter("tts_long"), ssml=args.ssml)
+    except Exception as e:
+        durations = None
+        result["error"] = f"synthesis failed: {e}"
+    complete = durations is not None and all(durations.get(target.output_filename) is not None for target in targets)
+    synthesis_span.labels["outcome"] = "ok" if complete else "failed"
+    synthesis_span.finish()
+    result["synthesis_seconds"] = round(time.perf_counter() - started, 3)
+
+    result["audio"] = []
+    for target in targets:
+        duration = durations.get(target.output_filename) if durations is not None else None
+        audio_entry = {"path": target.output_filename, "voice": target.voice_name, "encoding": target.audio_encoding,
+                       "duration_seconds": None if duration is None else round(duration, 1)}
+        if args.ssml and duration is not None:
+            audio_entry["timing_index_path"] = timing_index_path(target.output_filename)
+        result["audio"].append(audio_entry)
+
+    if not complete:
+        result["status"] = "failed"
+        # chunks stay on disk, running the batch again resumes this document
+        result.setdefault("error", "synthesis incomplete, rerun to resume")
+    return result
+
+def run_batch(pdf_paths, args):
+    # Extracts documents one after another, handing each to the audio thread as soon as it is ready.
+    # Returns the summary entries in input order
+    custom_fixes = load_custom_fixes_from_file(args.fixes) if args.fixes else None
+    response_cache = GeminiResponseCache(_run_folder(GEMINI_RESPONSE_CACHE_FOLDER, args)) if args.extractor == "gemini" else None
+    layout_cache = PageLayoutCache(PAGE_LAYOUT_CACHE_PATH) if args.extractor == "core" else None
+    gemini_rate_limiter = get_rate_limiter("gemini", GEMINI_REQUESTS_PER_MINUTE)
+    tts_rate_limiter = get_rate_limiter("tts", TTS_REQUESTS_PER_MINUTE, TTS_CHARS_PER_MINUTE)
+    get_rate_limiter("tts_long", TTS_LONG_AUDIO_REQUESTS_PER_MINUTE)
+    audio_cache = None if args.no_audio else AudioCache(_run_folder(AUDIO_CACHE_FOLDER, args), AUDIO_CACHE_MAX_BYTES)
+    # None = the real Google services
+    tts_backend = FakeTTSBackend() if args.fake_backends else None
+    extraction_backend = FakeExtractionBackend() if args.fake_backends else None
+    # None = chunks only
+    long_audio_backend = None
+    if not args.no_long_audio:
+        if args.fake_backends:
+            long_audio_backend = FakeLongAudioBackend()
+        elif GOOGLE_CLOUD_PROJECT and TTS_LONG_AUDIO_GCS_BUCKET:
+            long_audio_backend = GoogleLongAudioBackend(GOOGLE_CLOUD_PROJECT, TTS_LONG_AUDIO_GCS_BUCKET, TTS_LONG_AUDIO_LOCATION)
+
+    results = []
+    audio_futures = []
+    # One audio thread: documents are synthesized one at a time, each already uses tts_workers requests in parallel
+    with ThreadPoolExecutor(max_workers=1) as audio_executor:
+        for number, pdf_path in enumerate(pdf_paths, start=1):
+            print(f"\n===== [{number}/{len(pdf_paths)}] {pdf_path} =====")
+            # Don't let extracted texts pile up when synthesis is the slower stage
+            while len([future for future in audio_futures if not future.done()]) >= MAX_DOCUMENTS_AHEAD:
+                next(future for future in audio_futures if not future.done()).result()
+
+            result = extract_document(pdf_path, args, custom_fixes, response_cache, gemini_rate_limiter, extraction_backend,
+                                      layout_cache)
+            results.append(result)
+            if "text" not in result:
+                continue
+            if args.no_audio or result["status"] != "ok":
+                result.pop("text")
+                continue
+            audio_futures.append(audio_executor.submit(synthesize_document, result, args, audio_cache, tts_rate_limiter,
+                                                       tts_backend, long_audio_backend))
+
+        for future in audio_futures:
+            future.result()
+    return results
+
+def main(argv=None):
+    args = build_argument_parser().parse_args(argv)
+    # Progress messages go to stderr (tqdm bars already do), so stdout carries nothing but the JSON summary
+    with contextlib.redirect_stdout(sys.stderr):
+        pdf_paths = find_pdf_files(args.inputs)
+        if not pdf_paths:
+            print("!!! Error: No PDF files found for the given inputs.")
+            return 2
+
+        if args.metrics:
+            metrics.METRICS.keep_span_events = metrics.export_wants_span_events(args.metrics)
+        print(f"Found {len(pdf_paths)} PDF file(s).")
+        started = time.perf_counter()
+        results = run_batch(pdf_paths, args)
+
+        summary = {
+            "documents": results,
+            "totals": {
+                "documents": len(results),
+                "ok": sum(1 for result in results if result["status"] == "ok"),
+                "skipped": sum(1 for result in results if result["status"] == "skipped"),
+                "failed": sum(1 for result in results if result["status"] == "failed"),
+                "characters": sum(result.get("characters", 0) for result in results),
+                "estimated_cost": round(sum(result.get("estimated_cost", 0) for result in results), 4),
+                "wall_seconds": round(time.perf_counter() - started, 3),
+            },
+        }
+        summary_json = json.dumps(summary, indent=2)
+        if args.summary:
+            with open(args.summary, "w", encoding="utf-8") as f:
+                f.write(summary_json)
+            print(f"\nSummary saved to '{args.summary}'")
+
+        if args.metrics:
+            metrics.export_metrics(args.metrics)
+
+    if not args.summary:
+        print(summary_json)
+    return 1 if summary["totals"]["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
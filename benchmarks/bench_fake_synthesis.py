@@ -0,0 +1,66 @@
+import io
+import os
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+
+# Benchmarks run from the repo root or from this folder, either way the app modules live one level up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google_ai_tts_converter import text_to_speech_converter
+from fake_backends import FakeTTSBackend
+from rate_limiter import RateLimiter
+from synthetic_documents import WORDS
+
+# Load test of the synthesis path (workers, retries, rate limiter, stitching) against the local fake TTS service:
+# no API calls and no cost. For example, how close do 8 workers get to a 300 requests/minute quota with 5% 503s:
+#   python benchmarks/bench_fake_synthesis.py --chunks 200 --workers 8 --quota-rpm 300 --limiter-rpm 300 --error-rate 0.05
+
+def make_document(chunk_count, chunk_size):
+    # Sentences of fixed length, so the chunker packs about chunk_count chunks
+    sentence = " ".join(WORDS[:12]).capitalize() + ". "
+    return sentence * (chunk_count * chunk_size // len(sentence))
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthesis throughput against the fake TTS backend.")
+    parser.add_argument("--chunks", type=int, default=100, help="approximate number of TTS chunks (default 100)")
+    parser.add_argument("--chunk-size", type=int, default=4800, help="chunk size in bytes (default 4800)")
+    parser.add_argument("--workers", type=int, default=4, help="requests in flight (default 4)")
+    parser.add_argument("--latency", type=float, default=0.2, help="fake request latency in seconds (default 0.2)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failing with 503")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="fraction of requests timing out")
+    parser.add_argument("--timeout-seconds", type=float, default=1.0, help="how long a timing out request hangs (default 1)")
+    parser.add_argument("--quota-rpm", type=int, help="requests per minute the fake service accepts (429 above)")
+    parser.add_argument("--quota-cpm", type=int, help="characters per minute the fake service accepts (429 above)")
+    parser.add_argument("--limiter-rpm", type=int, help="client-side requests per minute of the rate limiter")
+    parser.add_argument("--limiter-cpm", type=int, help="client-side characters per minute of the rate limiter")
+    parser.add_argument("--retries", type=int, default=8, help="attempts per chunk (default 8)")
+    parser.add_argument("--initial-backoff", type=float, default=0.5, help="backoff after the first throttle (default 0.5 s)")
+    args = parser.parse_args()
+
+    backend = FakeTTSBackend(latency=args.latency, error_rate=args.error_rate, timeout_rate=args.timeout_rate,
+                             timeout_seconds=args.timeout_seconds, requests_per_minute=args.quota_rpm,
+                             chars_per_minute=args.quota_cpm)
+    rate_limiter = RateLimiter(requests_per_minute=args.limiter_rpm, chars_per_minute=args.limiter_cpm)
+    text = make_document(args.chunks, args.chunk_size)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        output_path = os.path.join(work_dir, "bench.mp3")
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            duration = text_to_speech_converter(text, output_path, 30.0, args.chunk_size, args.retries, args.initial_backoff,
+                                                args.workers, interactive=False, backend=backend, rate_limiter=rate_limiter)
+        elapsed = time.perf_counter() - start
+
+    stats = backend.service.stats
+    print(f"Result:            {'complete' if duration is not None else 'INCOMPLETE (retries ran out)'}")
+    print(f"Wall time:         {elapsed:.2f} s")
+    print(f"Chunks done:       {stats['succeeded']} ({stats['succeeded'] / elapsed:.2f}/s, {stats['succeeded'] / elapsed * 60:.0f}/min)")
+    print(f"Characters:        {stats['characters']} ({stats['characters'] / elapsed * 60:.0f}/min)")
+    print(f"Requests sent:     {stats['requests']}, peak concurrency {stats['peak_concurrency']}")
+    print(f"Rejected/failed:   {stats['quota_rejected']} quota (429), {stats['errors']} errors (503), {stats['timeouts']} timeouts")
+
+if __name__ == "__main__":
+    main()
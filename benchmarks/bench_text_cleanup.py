@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+import argparse
+
+# Benchmarks run from the repo root or from this folder, either way the app modules live one level up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from text_cleanup import CLEANUP_STAGES
+from pdf_core_text_extractor import DEFAULT_FIXES
+from synthetic_documents import make_raw_extractor_text, make_extra_rules
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage cost of the extracted text cleanup.")
+    parser.add_argument("--size-mb", type=float, default=20.0, help="size of the synthetic document (default 20 MB)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest one is reported")
+    parser.add_argument("--extra-rules", type=int, default=0, help="add this many synthetic replacement rules to DEFAULT_FIXES")
+    args = parser.parse_args()
+
+    fixes = dict(DEFAULT_FIXES)
+    fixes.update(make_extra_rules(args.extra_rules))
+
+    raw_text = make_raw_extractor_text(int(args.size_mb * 1024 * 1024))
+    print(f"Synthetic document: {len(raw_text) / 1024 / 1024:.1f} MB, {raw_text.count(chr(10))} lines, {len(fixes)} replacement rules\n")
+    print(f"{'stage':<28}{'seconds':>10}{'MB/s':>10}")
+
+    text = raw_text
+    total = 0.0
+    for name, stage in CLEANUP_STAGES:
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = stage(text, fixes)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        throughput = len(text) / 1024 / 1024 / best if best else float("inf")
+        print(f"{name:<28}{best:>10.3f}{throughput:>10.1f}")
+        total += best
+        # each stage is timed on the output of the previous one, like in the real pipeline
+        text = result
+
+    print(f"{'total':<28}{total:>10.3f}{len(raw_text) / 1024 / 1024 / total:>10.1f}")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
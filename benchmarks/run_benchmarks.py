@@ -0,0 +1,147 @@
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+
+# Benchmarks run from the repo root or from this folder, either way the app modules live one level up
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from pdf_core_text_extractor import extract_and_clean_pdf_text, DEFAULT_FIXES
+from text_cleanup import clean_extracted_text
+from utility_functions import clean_common_pdf_artifacts, is_likely_heading, smart_stitch
+from epub_creator import create_epub_from_text
+from synthetic_documents import make_synthetic_pdf, make_raw_extractor_text
+
+# Times the hot paths on synthetic input and writes the numbers to JSON, so runs on different commits can be compared:
+#   python benchmarks/run_benchmarks.py --pages 300 --output before.json
+#   (change something)
+#   python benchmarks/run_benchmarks.py --pages 300 --output after.json
+# Each stage is timed without tracing (best of --repeat runs), peak memory comes from one extra run under tracemalloc.
+# Memory of worker processes (extraction with --workers > 1) is not included in the peak.
+
+def git_revision():
+    # Commit hash of the checkout and whether it has uncommitted changes, None outside a git checkout
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_ROOT,
+                                capture_output=True, text=True, check=True).stdout
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def measure(name, function, repeat, pages=None, input_bytes=None):
+    # Runs function repeat times (output silenced, the app prints a lot), then once more under tracemalloc.
+    # Returns the result entry for the JSON file
+    best = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            function()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    result = {"name": name, "seconds": round(best, 4), "peak_memory_mb": round(peak_bytes / 1024 / 1024, 2)}
+    if pages is not None:
+        result["pages"] = pages
+        result["pages_per_second"] = round(pages / best, 1) if best else None
+    if input_bytes is not None:
+        result["input_mb"] = round(input_bytes / 1024 / 1024, 3)
+        result["mb_per_second"] = round(input_bytes / 1024 / 1024 / best, 2) if best else None
+    print(f"{name:<32}{best:>10.3f}{result.get('pages_per_second') or '':>12}{result.get('mb_per_second') or '':>10}"
+          f"{result['peak_memory_mb']:>12}")
+    return result
+
+def run_benchmarks(args, work_dir):
+    results = []
+    print(f"{'stage':<32}{'seconds':>10}{'pages/s':>12}{'MB/s':>10}{'peak MB':>12}")
+
+    pdf_path = os.path.join(work_dir, "synthetic.pdf")
+    pdf_bytes = make_synthetic_pdf(pdf_path, args.pages, seed=args.seed)
+
+    results.append(measure("extract_and_clean_pdf_text", lambda: extract_and_clean_pdf_text(pdf_path),
+                           args.repeat, pages=args.pages, input_bytes=pdf_bytes))
+    if args.workers > 1:
+        results.append(measure(f"extract_and_clean_pdf_text x{args.workers}",
+                               lambda: extract_and_clean_pdf_text(pdf_path, workers=args.workers),
+                               args.repeat, pages=args.pages, input_bytes=pdf_bytes))
+
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        extracted_text = extract_and_clean_pdf_text(pdf_path)
+    # Text shaped like what the extractor joins before cleaning, scaled up to --size-mb
+    raw_text = make_raw_extractor_text(int(args.size_mb * 1024 * 1024), seed=args.seed)
+    raw_bytes = len(raw_text.encode("utf-8"))
+
+    results.append(measure("clean_extracted_text", lambda: clean_extracted_text(raw_text, DEFAULT_FIXES),
+                           args.repeat, input_bytes=raw_bytes))
+    results.append(measure("clean_common_pdf_artifacts", lambda: clean_common_pdf_artifacts(raw_text, DEFAULT_FIXES),
+                           args.repeat, input_bytes=raw_bytes))
+
+    lines = raw_text.split("\n")
+    results.append(measure("is_likely_heading", lambda: [is_likely_heading(line) for line in lines],
+                           args.repeat, input_bytes=raw_bytes))
+
+    # Two batches that share a stretch of text, like neighbouring AI extraction windows
+    overlap_start = len(extracted_text) // 2
+    first_batch = extracted_text[:overlap_start + args.stitch_window // 2]
+    second_batch = extracted_text[overlap_start:]
+    stitch_bytes = len(first_batch.encode("utf-8")) + len(second_batch.encode("utf-8"))
+    results.append(measure(f"smart_stitch ({args.stitch_window} chars)",
+                           lambda: smart_stitch(first_batch, second_batch, search_window=args.stitch_window),
+                           args.repeat, input_bytes=stitch_bytes))
+
+    epub_path = os.path.join(work_dir, "synthetic.epub")
+    results.append(measure("create_epub_from_text", lambda: create_epub_from_text(extracted_text, epub_path),
+                           args.repeat, pages=args.pages, input_bytes=len(extracted_text.encode("utf-8"))))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the extraction, cleanup, stitching and EPUB hot paths.")
+    parser.add_argument("--pages", type=int, default=200, help="pages in the synthetic PDF (default 200)")
+    parser.add_argument("--size-mb", type=float, default=10.0, help="size of the synthetic text for the cleanup stages (default 10 MB)")
+    parser.add_argument("--workers", type=int, default=1, help="also time the extraction with this many processes")
+    parser.add_argument("--stitch-window", type=int, default=30000, help="smart_stitch search window in characters (default 30000)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage, the fastest one is reported")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic documents")
+    parser.add_argument("--output", help="JSON results file (default: benchmarks/results/<commit>.json)")
+    args = parser.parse_args()
+
+    commit, dirty = git_revision()
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run_benchmarks(args, work_dir)
+
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "results": results,
+    }
+    output_path = args.output
+    if not output_path:
+        results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+        os.makedirs(results_dir, exist_ok=True)
+        output_path = os.path.join(results_dir, f"{(commit or 'unknown')[:12]}{'-dirty' if dirty else ''}.json")
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to '{output_path}'")
+
+if __name__ == "__main__":
+    main()
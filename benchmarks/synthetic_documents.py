@@ -0,0 +1,106 @@
+import os
+import sys
+import random
+
+# Benchmarks run from the repo root or from this folder, either way the app modules live one level up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from text_cleanup import HEADING_START, HEADING_END, LIST_ITEM_START, LIST_ITEM_END
+
+# Offline test material shaped like the scientific papers the app is used on, generated from a fixed seed so runs on
+# different commits work on exactly the same input
+
+WORDS = ("the model results show that data analysis method effect significant sample were measured "
+         "between groups however previous studies reported similar findings in controlled experiments").split()
+
+def make_raw_extractor_text(target_bytes, seed=0):
+    # Builds text shaped like the joined extractor output before cleanup: lines with hyphenation breaks,
+    # superscript artifacts, citations, heading and list tags, and stray whitespace
+    rng = random.Random(seed)
+    parts = []
+    size = 0
+    while size < target_bytes:
+        roll = rng.random()
+        if roll < 0.03:
+            part = f" {HEADING_START}{rng.randint(1, 9)}.{rng.randint(1, 9)} {rng.choice(WORDS).capitalize()} {rng.choice(WORDS)}{HEADING_END} "
+        elif roll < 0.08:
+            part = f" {LIST_ITEM_START}{rng.choice(WORDS).capitalize()} {' '.join(rng.choices(WORDS, k=6))}{LIST_ITEM_END} "
+        else:
+            words = rng.choices(WORDS, k=rng.randint(8, 14))
+            line_end = rng.choice(["", "", "", ".", "-", "  ", f" (Smith et al., {rng.randint(1950, 2024)})",
+                                   f"?{rng.randint(1, 99)}", " , ", "!®"])
+            part = " ".join(words) + line_end
+        parts.append(part)
+        size += len(part) + 1
+    return "\n".join(parts)
+
+def make_extra_rules(count, seed=0):
+    # OCR-style fixes file entries (a letter or two glued to symbol garbage, like the entries in custom_fixes.txt),
+    # to see how the rule count affects the replacement stage
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    symbols = "!?*®°.,'"
+    rules = {}
+    while len(rules) < count:
+        target = "".join(rng.choices(letters, k=rng.randint(0, 2))) + "".join(rng.choices(symbols, k=rng.randint(1, 3)))
+        rules[target] = target.rstrip(symbols)
+    return rules
+
+def make_paper_lines(rng, line_count):
+    # Body lines of a page: sentences with citations, artifacts and words hyphenated across the line break
+    lines = []
+    carry = ""
+    for _ in range(line_count):
+        words = rng.choices(WORDS, k=rng.randint(9, 13))
+        line = carry + " ".join(words)
+        carry = ""
+        roll = rng.random()
+        if roll < 0.15:
+            # hyphenated word, the rest of it starts the next line
+            word = rng.choice(WORDS) + rng.choice(WORDS)
+            split_at = rng.randint(2, len(word) - 2)
+            line += f" {word[:split_at]}-"
+            carry = word[split_at:] + " "
+        elif roll < 0.30:
+            line += f" (Smith et al., {rng.randint(1950, 2024)})."
+        elif roll < 0.35:
+            line += f" ({rng.choice(['Miller', 'Chen', 'Okafor'])} {rng.randint(1990, 2024)}, pp. {rng.randint(1, 300)})"
+        elif roll < 0.40:
+            line += f" Daubert?{rng.randint(1, 60)}"
+        elif roll < 0.55:
+            line += "."
+        lines.append(line)
+    return lines
+
+def make_synthetic_pdf(pdf_path, page_count, seed=0):
+    # Writes a paper-like PDF with PyMuPDF: a running header and a page number on every page, numbered headings,
+    # bulleted list items and body paragraphs (see make_paper_lines). Returns the file size in bytes
+    import pymupdf
+
+    rng = random.Random(seed)
+    doc = pymupdf.open()
+    try:
+        for page_number in range(1, page_count + 1):
+            page = doc.new_page(width=595, height=842)
+            page.insert_text((72, 40), "Journal of Synthetic Studies, Vol. 12 (2024)", fontsize=8)
+            y = 80
+            while y < 740:
+                roll = rng.random()
+                if roll < 0.12:
+                    text = f"{rng.randint(1, 9)}.{rng.randint(1, 9)} {rng.choice(WORDS).capitalize()} {rng.choice(WORDS)}"
+                    line_count = 1
+                elif roll < 0.22:
+                    items = [f"• {rng.choice(WORDS).capitalize()} {' '.join(rng.choices(WORDS, k=5))}" for _ in range(rng.randint(2, 4))]
+                    text = "\n".join(items)
+                    line_count = len(items)
+                else:
+                    line_count = rng.randint(3, 7)
+                    text = "\n".join(make_paper_lines(rng, line_count))
+                page.insert_text((72, y), text, fontsize=9)
+                # a blank line between blocks keeps them apart in get_text("blocks")
+                y += 12 * line_count + 14
+            page.insert_text((290, 810), str(page_number), fontsize=8)
+        doc.save(pdf_path, garbage=3, deflate=True)
+    finally:
+        doc.close()
+    return os.path.getsize(pdf_path)
@@ -10,15 +10,19 @@ GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
 
 CREDENTIALS_FILE = "google-credentials.json"
 
-# Set up authentication for the Google Cloud Text-to-Speech service
-if os.path.exists(CREDENTIALS_FILE):
+def setup_google_credentials():
+    # Points the Google Cloud Text-to-Speech client at the credentials file. Called when the Google TTS backend is
+    # created rather than at import, so workflows that never call the API (EPUB, core extraction, fake backends)
+    # run without the file. Credentials already set in the environment are used as they are
+    if os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"):
+        return
+    if not os.path.exists(CREDENTIALS_FILE):
+        raise FileNotFoundError(
+            f"Authentication Error: Credentials file not found at '{CREDENTIALS_FILE}'. "
+            "Please ensure the GOOGLE_CREDENTIALS_FILE_PATH in your .env file is correct, "
+            "or set GOOGLE_APPLICATION_CREDENTIALS to your service account key file."
+        )
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = CREDENTIALS_FILE
-else:
-    # If the file is not found or not set, raise an error to stop execution
-    raise FileNotFoundError(
-        f"Authentication Error: Credentials file not found at '{CREDENTIALS_FILE}'. "
-        "Please ensure the GOOGLE_CREDENTIALS_FILE_PATH in your .env file is correct."
-    )
 
 # Pricing Configuration
 # For Chirp 3: HD voices 
@@ -26,11 +30,64 @@ PRICE_PER_MILLION_CHARS_HD = 30.00  # USD per million characters: https://cloud.
 FREE_TIER_LIMIT = 1_000_000  # 1 million characters
 
 # API and Processing Settings
-# Maximum characters a single API request to Google TTS can be
-TTS_CHUNK_SIZE = 4500
+# Maximum size of a single API request to Google TTS, in UTF-8 bytes (the API limit is 5000 bytes per request)
+TTS_CHUNK_SIZE = 4800
 # For retry-mechanism
 MAX_RETRIES = 5
 INITIAL_BACKOFF = 2  # unit in seconds
+# Number of chunk requests to the TTS API in flight at the same time
+TTS_MAX_WORKERS = 4
+# Client-side quotas for the TTS API, set them to your project's limits (Cloud console > IAM & Admin > Quotas).
+# Requests are paced to stay under these, and slowed down further whenever the API answers 429/503. None = no limit
+TTS_REQUESTS_PER_MINUTE = 100
+TTS_CHARS_PER_MINUTE = 150_000
+
+# Voice settings, these are also part of the audio cache key
+TTS_VOICE_NAME = "en-US-Chirp3-HD-Aoede"
+TTS_LANGUAGE_CODE = "en-US"
+TTS_AUDIO_ENCODING = "MP3"
+# Extra versions of every document, made in the same synthesis run as the main one (TTS_VOICE_NAME + TTS_AUDIO_ENCODING):
+# (voice name, audio encoding) pairs, encodings MP3 or OGG_OPUS. The text is chunked once and all versions share the
+# request workers, e.g. [("en-US-Chirp3-HD-Charon", "MP3"), (TTS_VOICE_NAME, "OGG_OPUS")]
+TTS_EXTRA_TARGETS = []
+
+# Long audio synthesis: MP3 texts of at least TTS_LONG_AUDIO_MIN_BYTES go out as a few server-side jobs
+# (Text-to-Speech Long Audio API) instead of thousands of chunk requests. Jobs write their audio to a Cloud Storage bucket,
+# set both GOOGLE_CLOUD_PROJECT and TTS_LONG_AUDIO_GCS_BUCKET in your .env to use it, otherwise everything goes out in chunks
+GOOGLE_CLOUD_PROJECT = os.getenv("GOOGLE_CLOUD_PROJECT")
+TTS_LONG_AUDIO_GCS_BUCKET = os.getenv("TTS_LONG_AUDIO_GCS_BUCKET")
+TTS_LONG_AUDIO_LOCATION = "global"
+TTS_LONG_AUDIO_MIN_BYTES = 300_000
+TTS_LONG_AUDIO_JOB_BYTES = 900_000  # UTF-8 bytes of text per job, the API limit is 1 MB
+TTS_LONG_AUDIO_MAX_JOBS = 4  # jobs running at the same time
+TTS_LONG_AUDIO_REQUESTS_PER_MINUTE = 20  # job submissions
+
+# SSML mode: pauses around headings, paragraphs and list items, plus a timing index (<audio name>.timing.json) with the
+# start of every heading/paragraph in the audio, for seeking and EPUB sync. Needs a voice with SSML support
+# (e.g. "en-US-Neural2-F"), Chirp 3: HD voices reject SSML input
+TTS_SSML_TIMING = False
+
+# Audio cache, synthesized chunks are kept here (by content) and reused across runs and documents
+AUDIO_CACHE_FOLDER = "audio_cache"
+AUDIO_CACHE_MAX_BYTES = 2 * 1024**3  # 2 GB, least recently used chunks are removed past this
+
+# Processes used to read page layouts from large PDFs (option 1), 1 = no multiprocessing
+PDF_EXTRACTION_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+
+# AI extraction (option 2): page windows in flight at the same time when running in parallel mode
+GEMINI_MAX_CONCURRENCY = 4
+# Gemini requests per minute (upload + extraction of one page window), depends on model and billing tier
+GEMINI_REQUESTS_PER_MINUTE = 10
+# AI extraction responses are kept here (by sub-PDF content, model and prompt) and reused across runs
+GEMINI_RESPONSE_CACHE_FOLDER = os.path.join(".cache", "gemini_responses")
+
+# Core extraction (option 1): the text blocks of every page read are kept here (by PDF content and page),
+# so re-running with other fixes or page ranges only reads pages that weren't read before
+PAGE_LAYOUT_CACHE_PATH = os.path.join(".cache", "page_layouts.sqlite3")
+
+# Per-stage timings, retry counts and throughput of a run are written here at the end (see metrics.py):
+# *.prom = Prometheus text format, anything else = JSON lines. None = not written
+METRICS_OUTPUT_PATH = os.getenv("TEXTRACTOR_METRICS_PATH")
 
 # File Paths
 TEXT_OUTPUT_FOLDER = "extracted_texts"
@@ -1,84 +1,195 @@
 import os
-from ebooklib import epub
+import re
+import html
+import time
+import zipfile
 from utility_functions import is_likely_heading
 
-def create_epub_from_text(text_content, output_path, title="Paper Audio"):
-    # 1. Initializing
-    book = epub.EpubBook()
-    
+# EPUB 3 writer without a book object in memory: the text is walked block by block, every chapter is streamed into its
+# zip entry as it is read, and only chapter titles are kept for the navigation files written at the end.
+# Paragraph markup is collected in a list and written out in pieces, so time and memory stay linear in the text size.
+
+# Paragraph markup is written to the zip entry whenever this much has been collected
+CHAPTER_WRITE_BUFFER_CHARS = 64 * 1024
+
+# Control characters are not allowed in XML 1.0, PDF text sometimes carries them (form feeds etc.) and readers reject the file
+INVALID_XML_CHARS_PATTERN = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+STYLE = 'body { font-family: Helvetica, Arial, sans-serif; } h1 { text-align: left; } p { text-align: justify; }'
+
+def _escape(text):
+    return html.escape(INVALID_XML_CHARS_PATTERN.sub('', text))
+
+def iter_text_blocks(text_content):
+    # Yields ("heading" | "paragraph", text) for every block of the text, blocks are split by double newlines
+    # (which the cleaner ensures for paragraphs). Walks the string instead of splitting it, so no second copy is made
+    position = 0
+    while position <= len(text_content):
+        block_end = text_content.find('\n\n', position)
+        if block_end == -1:
+            block_end = len(text_content)
+        clean_block = text_content[position:block_end].strip()
+        position = block_end + 2
+        if not clean_block:
+            continue
+        yield ("heading" if is_likely_heading(clean_block) else "paragraph"), clean_block
+
+def iter_section_blocks(sections):
+    # Blocks of a text that arrives in sections (pdf_core_text_extractor.iter_clean_pdf_text), so the EPUB can be written
+    # while the PDF is still being read. Sections are cut in front of headings, no block spans two of them
+    for section in sections:
+        yield from iter_text_blocks(section)
+
+def _chapter_header(title):
+    return (
+        "<?xml version='1.0' encoding='utf-8'?>\n"
+        "<!DOCTYPE html>\n"
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en" xml:lang="en">\n'
+        f"<head><title>{_escape(title)}</title>"
+        '<link href="style/nav.css" rel="stylesheet" type="text/css"/></head>\n'
+        f"<body><h1>{_escape(title)}</h1>\n"
+    )
+
+def _container_xml():
+    return (
+        "<?xml version='1.0' encoding='utf-8'?>\n"
+        '<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">\n'
+        '  <rootfiles>\n'
+        '    <rootfile media-type="application/oebps-package+xml" full-path="EPUB/content.opf"/>\n'
+        '  </rootfiles>\n'
+        '</container>\n'
+    )
+
+def _content_opf(identifier, title, chapters):
+    modified = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    manifest_items = [
+        '    <item href="toc.ncx" id="ncx" media-type="application/x-dtbncx+xml"/>',
+        '    <item href="nav.xhtml" id="nav" media-type="application/xhtml+xml" properties="nav"/>',
+        '    <item href="style/nav.css" id="style_nav" media-type="text/css"/>',
+    ]
+    spine_items = ['    <itemref idref="nav"/>']
+    for chapter_id, file_name, _ in chapters:
+        manifest_items.append(f'    <item href="{file_name}" id="{chapter_id}" media-type="application/xhtml+xml"/>')
+        spine_items.append(f'    <itemref idref="{chapter_id}"/>')
+    return (
+        "<?xml version='1.0' encoding='utf-8'?>\n"
+        '<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="id" version="3.0" xml:lang="en">\n'
+        '  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+        f'    <dc:identifier id="id">{_escape(identifier)}</dc:identifier>\n'
+        f'    <dc:title>{_escape(title)}</dc:title>\n'
+        '    <dc:language>en</dc:language>\n'
+        '    <dc:creator id="creator">Auto-Extractor</dc:creator>\n'
+        f'    <meta property="dcterms:modified">{modified}</meta>\n'
+        '  </metadata>\n'
+        '  <manifest>\n' + "\n".join(manifest_items) + '\n  </manifest>\n'
+        '  <spine toc="ncx">\n' + "\n".join(spine_items) + '\n  </spine>\n'
+        '</package>\n'
+    )
+
+def _nav_xhtml(title, chapters):
+    entries = "\n".join(f'      <li><a href="{file_name}">{_escape(chapter_title)}</a></li>'
+                        for _, file_name, chapter_title in chapters)
+    return (
+        "<?xml version='1.0' encoding='utf-8'?>\n"
+        "<!DOCTYPE html>\n"
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en" xml:lang="en">\n'
+        f"<head><title>{_escape(title)}</title></head>\n"
+        '<body>\n'
+        '  <nav epub:type="toc" id="id" role="doc-toc">\n'
+        f'    <h2>{_escape(title)}</h2>\n'
+        '    <ol>\n' + entries + '\n    </ol>\n'
+        '  </nav>\n'
+        '</body>\n'
+        '</html>\n'
+    )
+
+def _toc_ncx(identifier, title, chapters):
+    nav_points = "\n".join(
+        f'    <navPoint id="{chapter_id}" playOrder="{order}">'
+        f'<navLabel><text>{_escape(chapter_title)}</text></navLabel><content src="{file_name}"/></navPoint>'
+        for order, (chapter_id, file_name, chapter_title) in enumerate(chapters, start=1)
+    )
+    return (
+        "<?xml version='1.0' encoding='utf-8'?>\n"
+        '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+        f'  <head><meta content="{_escape(identifier)}" name="dtb:uid"/></head>\n'
+        f'  <docTitle><text>{_escape(title)}</text></docTitle>\n'
+        '  <navMap>\n' + nav_points + '\n  </navMap>\n'
+        '</ncx>\n'
+    )
+
+def write_epub_from_blocks(blocks, output_path, title="Paper Audio"):
+    # blocks: iterable of ("heading" | "paragraph", text), e.g. iter_text_blocks(text).
+    # A heading starts a new chapter; chapters without paragraphs are dropped (their heading is replaced by the next one).
+    # Returns the number of chapters, a book without any has only a title page
     filename_base = os.path.splitext(os.path.basename(output_path))[0]
-    book.set_identifier(filename_base)
-    book.set_title(title)
-    book.set_language('en')
-    book.add_author('Auto-Extractor')
-
-    # 2. Parsing text into chapters, split by double newlines, which the cleaner ensures for paragraphs
-    blocks = text_content.split('\n\n')
-    
+    # (id, file name, title) of every written chapter, all that the navigation files need
     chapters = []
-    current_chapter_content = []
-    current_chapter_title = "Start"
-    chapter_count = 1
-
-    def flush_chapter(title, content_list, count):
-        if not content_list: return None
-        
-        # Create HTML file name
-        chap_file = f'chap_{count}.xhtml'
-        c = epub.EpubHtml(title=title, file_name=chap_file, lang='en')
-        
-        # Build HTML content, wrap title in h1, and rest in p tags
-        html_body = f"<h1>{title}</h1>"
-        for para in content_list:
-            # NOTE: some cleanup here?
-            html_body += f"<p>{para}</p>"
-            
-        c.content = html_body
-        return c
-
-    for block in blocks:
-        clean_block = block.strip()
-        if not clean_block: 
-            continue
 
-        # Check if block is a heading
-        if is_likely_heading(clean_block):
-            # If have previous content, save old chapter first
-            if current_chapter_content:
-                chap = flush_chapter(current_chapter_title, current_chapter_content, chapter_count)
-                if chap: 
-                    book.add_item(chap)
-                    chapters.append(chap)
-                    chapter_count += 1
-            
-            # Reset for new chapter
-            current_chapter_title = clean_block
-            current_chapter_content = [] # title does not go to body text list, but as H1
-        else:
-            current_chapter_content.append(clean_block)
-
-    # Flush remaining text
-    if current_chapter_content:
-        chap = flush_chapter(current_chapter_title, current_chapter_content, chapter_count)
-        if chap:
-            book.add_item(chap)
-            chapters.append(chap)
-
-    # 3. Define table of contents and spine...
-    book.toc = (tuple(chapters))
-    
-    # Add default NCX and Nav files (required for epub readers to navigate aparently, not sure what they are exactly)
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
-
-    # CSS style, sloppy
-    style = 'body { font-family: Helvetica, Arial, sans-serif; } h1 { text-align: left; } p { text-align: justify; }'
-    nav_css = epub.EpubItem(uid="style_nav", file_name="style/nav.css", media_type="text/css", content=style)
-    book.add_item(nav_css)
-
-    # read order
-    book.spine = ['nav'] + chapters
-
-    # 4. Write output
-    epub.write_epub(output_path, book, {})
-    print(f"EPUB successfully saved to: {output_path}")
\ No newline at end of file
+    partial_path = output_path + ".part"
+    with zipfile.ZipFile(partial_path, "w", compression=zipfile.ZIP_DEFLATED) as book:
+        # mimetype has to be the first entry and stored uncompressed, readers identify the format by it
+        book.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        book.writestr("META-INF/container.xml", _container_xml())
+        book.writestr("EPUB/style/nav.css", STYLE)
+
+        current_chapter_title = "Start"
+        chapter_file = None
+        buffer = []
+        buffered_chars = 0
+
+        def write_buffer():
+            nonlocal buffered_chars
+            chapter_file.write("".join(buffer).encode("utf-8"))
+            buffer.clear()
+            buffered_chars = 0
+
+        def close_chapter():
+            nonlocal chapter_file
+            buffer.append("</body>\n</html>\n")
+            write_buffer()
+            chapter_file.close()
+            chapter_file = None
+
+        for kind, text in blocks:
+            if kind == "heading":
+                if chapter_file is not None:
+                    close_chapter()
+                current_chapter_title = text
+                continue
+
+            if chapter_file is None:
+                # First paragraph of a chapter, its entry is opened only now so empty chapters never reach the file
+                chapter_number = len(chapters) + 1
+                file_name = f"chap_{chapter_number}.xhtml"
+                chapters.append((f"chapter_{chapter_number}", file_name, current_chapter_title))
+                chapter_file = book.open(f"EPUB/{file_name}", "w")
+                buffer.append(_chapter_header(current_chapter_title))
+
+            paragraph = f"<p>{_escape(text)}</p>\n"
+            buffer.append(paragraph)
+            buffered_chars += len(paragraph)
+            if buffered_chars >= CHAPTER_WRITE_BUFFER_CHARS:
+                write_buffer()
+
+        if chapter_file is not None:
+            close_chapter()
+
+        # No paragraph at all: the navigation still needs an entry (an empty <ol> or navMap is invalid), a title page gets it
+        nav_chapters = chapters
+        if not chapters:
+            nav_chapters = [("title_page", "title.xhtml", title)]
+            book.writestr("EPUB/title.xhtml", _chapter_header(title) + "</body>\n</html>\n")
+
+        # Navigation goes last, it is the only part that needs the full chapter list
+        book.writestr("EPUB/content.opf", _content_opf(filename_base, title, nav_chapters))
+        book.writestr("EPUB/nav.xhtml", _nav_xhtml(title, nav_chapters))
+        book.writestr("EPUB/toc.ncx", _toc_ncx(filename_base, title, nav_chapters))
+
+    os.replace(partial_path, output_path)
+    return len(chapters)
+
+def create_epub_from_text(text_content, output_path, title="Paper Audio"):
+    # Splits the text into chapters at headings and writes them as an EPUB
+    write_epub_from_blocks(iter_text_blocks(text_content), output_path, title)
+    print(f"EPUB successfully saved to: {output_path}")
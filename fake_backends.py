@@ -0,0 +1,274 @@
+import re
+import time
+import random
+import struct
+import hashlib
+import threading
+import collections
+from xml.sax.saxutils import unescape
+
+from audio_stitcher import build_ogg_page
+from backends import (TTSBackend, LongAudioBackend, ExtractionBackend, BackendError, TransientBackendError, BackendTimeoutError,
+                      QuotaExceededError, JobNotFoundError)
+
+# Local stand-ins for the Google services, for tests and offline load testing of the retry, resume, concurrency and
+# rate limiting paths. Same interface and exceptions as the real backends in backends.py, nothing is sent anywhere.
+#   - output is deterministic: the same text always gives the same audio bytes / extraction text
+#   - latency: base + per-character time plus random jitter, slept in the calling thread like a real request
+#   - error injection: a fraction of requests fails with 503 or with a timeout (after the full timeout wait)
+#   - quotas: requests/characters per rolling minute and concurrent requests, exceeding them raises 429 / 503
+# The random parts come from a seeded generator, so a run with the same settings fails the same requests.
+
+class FakeServiceModel:
+    # Latency, failures and quota bookkeeping shared by both fakes
+
+    def __init__(self, latency=0.05, latency_per_char=0.0, jitter=0.02, error_rate=0.0, timeout_rate=0.0,
+                 timeout_seconds=1.0, requests_per_minute=None, chars_per_minute=None, max_concurrency=None, seed=0):
+        self.latency = latency
+        self.latency_per_char = latency_per_char
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.requests_per_minute = requests_per_minute
+        self.chars_per_minute = chars_per_minute
+        self.max_concurrency = max_concurrency
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        # (time, characters) of the requests accepted during the last minute
+        self._recent_requests = collections.deque()
+        self._in_flight = 0
+        # Counters for reports/assertions: requests, succeeded, quota_rejected, overloaded, errors, timeouts, characters,
+        # and peak_concurrency
+        self.stats = collections.Counter()
+
+    def _admit(self, chars):
+        # Quota checks and the random outcome of one request, under the lock so concurrent callers see consistent counts
+        with self._lock:
+            self.stats["requests"] += 1
+            now = time.monotonic()
+            while self._recent_requests and now - self._recent_requests[0][0] >= 60:
+                self._recent_requests.popleft()
+
+            if self.requests_per_minute is not None and len(self._recent_requests) >= self.requests_per_minute:
+                self.stats["quota_rejected"] += 1
+                raise QuotaExceededError(f"429 Fake quota exceeded: {self.requests_per_minute} requests per minute")
+            if self.chars_per_minute is not None and sum(c for _, c in self._recent_requests) + chars > self.chars_per_minute:
+                self.stats["quota_rejected"] += 1
+                raise QuotaExceededError(f"429 Fake quota exceeded: {self.chars_per_minute} characters per minute")
+            if self.max_concurrency is not None and self._in_flight >= self.max_concurrency:
+                self.stats["overloaded"] += 1
+                raise TransientBackendError(f"503 Fake service overloaded: more than {self.max_concurrency} concurrent requests")
+
+            self._recent_requests.append((now, chars))
+            self._in_flight += 1
+            self.stats["peak_concurrency"] = max(self.stats["peak_concurrency"], self._in_flight)
+
+            roll = self._rng.random()
+            if roll < self.timeout_rate:
+                outcome = "timeout"
+            elif roll < self.timeout_rate + self.error_rate:
+                outcome = "error"
+            else:
+                outcome = "ok"
+            delay = self.latency + self.latency_per_char * chars + self._rng.uniform(0, self.jitter)
+            return outcome, delay
+
+    def call(self, chars):
+        # Simulates one request of `chars` characters, returns normally if it "succeeded"
+        outcome, delay = self._admit(chars)
+        try:
+            if outcome == "timeout":
+                time.sleep(self.timeout_seconds)
+                with self._lock:
+                    self.stats["timeouts"] += 1
+                raise BackendTimeoutError(f"504 Fake deadline exceeded after {self.timeout_seconds}s")
+            time.sleep(delay)
+            if outcome == "error":
+                with self._lock:
+                    self.stats["errors"] += 1
+                raise TransientBackendError("503 Fake service unavailable")
+            with self._lock:
+                self.stats["succeeded"] += 1
+                self.stats["characters"] += chars
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+# MPEG-2 Layer III, 32 kbps, 24 kHz, mono, no CRC/padding: 96-byte frames of 576 samples (24 ms)
+FAKE_MP3_FRAME_HEADER = b"\xff\xf3\x44\xc4"
+FAKE_MP3_FRAME_SIZE = 96
+FAKE_MP3_FRAME_SECONDS = 576 / 24000
+# Roughly the pace of the real voices
+FAKE_SPEECH_CHARS_PER_SECOND = 15
+
+# Marks, other tags and the text between them
+SSML_PART_PATTERN = re.compile(r'<mark name="(?P<mark>[^"]*)"/>|<[^>]*>|(?P<text>[^<]+)')
+
+def fake_mp3_audio(text):
+    # Deterministic MP3 frames for a text, about as long as reading it out loud would take. Frames are valid
+    # for parsers (audio_stitcher counts and stitches them), the payload is hash noise rather than decodable sound
+    frame_count = max(1, round(len(text) / FAKE_SPEECH_CHARS_PER_SECOND / FAKE_MP3_FRAME_SECONDS))
+    seed = hashlib.sha256(text.encode("utf-8")).digest()
+    # side info zeroed so no frame ever looks like a Xing/Info tag
+    side_info = bytes(9)
+    payload_size = FAKE_MP3_FRAME_SIZE - len(FAKE_MP3_FRAME_HEADER) - len(side_info)
+    frames = []
+    for frame_index in range(frame_count):
+        block = hashlib.sha256(seed + struct.pack(">I", frame_index)).digest()
+        payload = (block * (payload_size // len(block) + 1))[:payload_size]
+        frames.append(FAKE_MP3_FRAME_HEADER + side_info + payload)
+    return b"".join(frames)
+
+# Ogg Opus stand-in: 20 ms packets of hash noise behind real OpusHead/OpusTags headers, 50 packets per page
+FAKE_OPUS_PACKET_SECONDS = 0.02
+FAKE_OPUS_PACKET_SIZE = 16
+FAKE_OPUS_PACKETS_PER_PAGE = 50
+FAKE_OPUS_PRE_SKIP = 312
+FAKE_OPUS_HEAD = b"OpusHead" + struct.pack("<BBHIhB", 1, 1, FAKE_OPUS_PRE_SKIP, 24000, 0, 0)
+FAKE_OPUS_TAGS = b"OpusTags" + struct.pack("<I", 4) + b"fake" + struct.pack("<I", 0)
+
+def fake_ogg_opus_audio(text):
+    # Deterministic Ogg Opus stream for a text, same length as fake_mp3_audio. Pages and granule positions are valid
+    # for parsers (audio_stitcher chains and times them), the packets don't decode to sound
+    packet_count = max(1, round(len(text) / FAKE_SPEECH_CHARS_PER_SECOND / FAKE_OPUS_PACKET_SECONDS))
+    samples_per_packet = round(48000 * FAKE_OPUS_PACKET_SECONDS)
+    seed = hashlib.sha256(text.encode("utf-8")).digest()
+    serial = struct.unpack_from("<I", seed)[0]
+    pages = [
+        build_ogg_page(0x02, 0, serial, 0, [len(FAKE_OPUS_HEAD)], FAKE_OPUS_HEAD),
+        build_ogg_page(0x00, 0, serial, 1, [len(FAKE_OPUS_TAGS)], FAKE_OPUS_TAGS),
+    ]
+    for page_start in range(0, packet_count, FAKE_OPUS_PACKETS_PER_PAGE):
+        page_packets = min(FAKE_OPUS_PACKETS_PER_PAGE, packet_count - page_start)
+        body = b"".join(hashlib.sha256(seed + struct.pack(">I", page_start + packet_index)).digest()[:FAKE_OPUS_PACKET_SIZE]
+                        for packet_index in range(page_packets))
+        granule_position = FAKE_OPUS_PRE_SKIP + (page_start + page_packets) * samples_per_packet
+        is_last_page = page_start + page_packets == packet_count
+        pages.append(build_ogg_page(0x04 if is_last_page else 0x00, granule_position, serial, len(pages),
+                                    [FAKE_OPUS_PACKET_SIZE] * page_packets, body))
+    return b"".join(pages)
+
+FAKE_AUDIO_ENCODERS = {
+    "MP3": fake_mp3_audio,
+    "OGG_OPUS": fake_ogg_opus_audio,
+}
+
+def _check_encoding(audio_encoding):
+    # Before the service call, an unsupported request must not count against the quotas
+    if audio_encoding not in FAKE_AUDIO_ENCODERS:
+        raise ValueError(f"FakeTTSBackend only produces {', '.join(FAKE_AUDIO_ENCODERS)}, not {audio_encoding}")
+
+class FakeTTSBackend(TTSBackend):
+
+    def __init__(self, **service_settings):
+        # service_settings: see FakeServiceModel (latency, error_rate, timeout_rate, requests_per_minute, ...)
+        self.service = FakeServiceModel(**service_settings)
+
+    def synthesize(self, text, voice_name, language_code, audio_encoding):
+        _check_encoding(audio_encoding)
+        self.service.call(len(text))
+        return FAKE_AUDIO_ENCODERS[audio_encoding](text)
+
+    def synthesize_ssml(self, ssml, voice_name, language_code, audio_encoding):
+        # Speaks the text between the tags, a mark's time is how long the text before it takes to read
+        _check_encoding(audio_encoding)
+        spoken_parts = []
+        spoken_chars = 0
+        timepoints = {}
+        for match in SSML_PART_PATTERN.finditer(ssml):
+            if match.group("mark") is not None:
+                timepoints[match.group("mark")] = spoken_chars / FAKE_SPEECH_CHARS_PER_SECOND
+            elif match.group("text") is not None:
+                spoken_text = unescape(match.group("text"))
+                spoken_parts.append(spoken_text)
+                spoken_chars += len(spoken_text)
+        text = "".join(spoken_parts)
+        self.service.call(len(text))
+        return FAKE_AUDIO_ENCODERS[audio_encoding](text), timepoints
+
+class FakeLongAudioBackend(LongAudioBackend):
+    # Long audio jobs run "on the server" in the background: a job is done job_latency + job_seconds_per_char * characters
+    # after its submission, a job_failure_rate fraction of them fails. Submissions go through the service model
+    # (latency, quotas, injected 503s). Jobs live in this object only, a new instance has forgotten them (JobNotFoundError)
+    max_job_bytes = 1_000_000
+    DOWNLOAD_BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, job_latency=0.2, job_seconds_per_char=0.0, job_failure_rate=0.0, **service_settings):
+        self.job_latency = job_latency
+        self.job_seconds_per_char = job_seconds_per_char
+        self.job_failure_rate = job_failure_rate
+        self.service = FakeServiceModel(**service_settings)
+        self._rng = random.Random(service_settings.get("seed", 0))
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._submitted_jobs = 0
+
+    def submit(self, text, voice_name, language_code, audio_encoding, job_name):
+        if audio_encoding != "MP3":
+            raise ValueError(f"FakeLongAudioBackend only produces MP3, not {audio_encoding}")
+        if len(text.encode("utf-8")) > self.max_job_bytes:
+            raise BackendError(f"Fake long audio input is larger than {self.max_job_bytes} bytes")
+        self.service.call(len(text))
+        with self._lock:
+            self._submitted_jobs += 1
+            job_id = f"fake-operation-{self._submitted_jobs}"
+            failed = self._rng.random() < self.job_failure_rate
+            ready_at = time.monotonic() + self.job_latency + self.job_seconds_per_char * len(text)
+            self._jobs[job_id] = {"text": text, "job_name": job_name, "ready_at": ready_at, "failed": failed}
+        return job_id
+
+    def _job(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise JobNotFoundError(f"404 Fake operation '{job_id}' not found")
+        return job
+
+    def poll(self, job_id):
+        job = self._job(job_id)
+        if time.monotonic() < job["ready_at"]:
+            return "running"
+        if job["failed"]:
+            raise BackendError(f"Fake long audio job '{job_id}' failed")
+        return "done"
+
+    def download(self, job_id, job_name, out_file):
+        job = self._job(job_id)
+        audio = fake_mp3_audio(job["text"])
+        for position in range(0, len(audio), self.DOWNLOAD_BLOCK_SIZE):
+            out_file.write(audio[position:position + self.DOWNLOAD_BLOCK_SIZE])
+
+    def discard(self, job_id, job_name):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+ANCHOR_PATTERN = re.compile(r'<ANCHOR_START>\s*"(.*)"\s*<ANCHOR_END>', re.DOTALL)
+
+class FakeExtractionBackend(ExtractionBackend):
+    # Returns the plain text of the pages (PyMuPDF get_text), and behaves like a well-behaved model with anchors:
+    # when the prompt carries one that is found in the text, extraction continues right after it
+
+    def __init__(self, model="fake-extractor", **service_settings):
+        self.model = model
+        self.service = FakeServiceModel(**service_settings)
+
+    def extract(self, pdf_bytes, prompt, temperature, display_name=None, on_progress=None):
+        import pymupdf
+
+        doc = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            text = "\n".join(page.get_text() for page in doc)
+        finally:
+            doc.close()
+
+        self.service.call(len(text))
+
+        anchor_match = ANCHOR_PATTERN.search(prompt)
+        if anchor_match:
+            anchor_position = text.find(anchor_match.group(1))
+            if anchor_position != -1:
+                text = text[anchor_position + len(anchor_match.group(1)):]
+        if on_progress:
+            on_progress()
+        return text
@@ -0,0 +1,42 @@
+import os
+import threading
+
+from utility_functions import content_key, sharded_path
+
+class GeminiResponseCache:
+    # Persistent store for Gemini page-window extractions.
+    # Entries are named by a hash of the exact sub-PDF bytes plus model, prompt and temperature, so a window is only
+    # uploaded and extracted once: re-runs after a crash or with an overlapping page range reuse every identical window.
+    # Extracted text is small compared to audio, so there is no size cap, delete the folder to start over
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(pdf_bytes, model, prompt, temperature):
+        return content_key(pdf_bytes, model, prompt, temperature)
+
+    def _entry_path(self, key):
+        return sharded_path(self.cache_dir, key, ".txt")
+
+    def get(self, key):
+        # Cached extraction text, None on a miss
+        try:
+            with open(self._entry_path(key), "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, text):
+        # Failures only cost a future cache miss, so they are reported and ignored
+        entry_path = self._entry_path(key)
+        try:
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            # Windows run in parallel threads, the thread id keeps their partial files apart
+            partial_path = f"{entry_path}.{threading.get_ident()}.part"
+            with open(partial_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(partial_path, entry_path)
+        except OSError as e:
+            print(f"!!! Warning: Could not store batch in Gemini response cache: {e}")
@@ -1,27 +1,440 @@
 import os
-import time
 import glob
 import shutil
+import re
+import json
+import hashlib
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
-from google.cloud import texttospeech
-from google.api_core import exceptions as google_exceptions
 
-from utility_functions import stitch_and_save_partial_audio, calculate_tts_cost
+from utility_functions import stitch_and_save_partial_audio, calculate_tts_cost, split_text_for_tts, write_json_atomic
+from audio_cache import AudioCache
+from audio_stitcher import AUDIO_FORMATS
+from rate_limiter import get_rate_limiter, poll_delays
+from backends import GoogleTTSBackend, BackendError, TransientBackendError, JobNotFoundError
+from ssml_builder import build_ssml_chunks
+import metrics
 
-def text_to_speech_converter(text, output_filename, price_per_million, TTS_CHUNK_SIZE=4500, MAX_RETRIES=5, INITIAL_BACKOFF=2):
-    # Chunks text to max chunk size (per specs, see documentation) and uses Google Cloud TTS to generate an audio file (includes retry mechanism for server side errors)
+# SSML mode: where each heading/paragraph starts in the audio, written next to the audio file
+TIMING_INDEX_SUFFIX = ".timing.json"
+# Characters of a section's text kept as its title in the timing index
+TIMING_INDEX_TITLE_CHARS = 100
+SSML_MARK_PATTERN = re.compile(r'<mark name="([^"]*)"/>')
+
+# Chunk mode: the text hash of every chunk index, kept in the chunk folder so a rerun only resumes chunks of the same text
+CHUNK_MANIFEST_FILENAME = "chunks.json"
+# chunk_0001.mp3, chunk_0001.timepoints.json, chunk_0001.mp3.part
+CHUNK_FILE_PATTERN = re.compile(r"chunk_(\d+)\.")
+
+# Long audio mode: job ids and texts of the current run, kept in the job folder so a rerun can pick up running jobs
+LONG_AUDIO_MANIFEST_FILENAME = "jobs.json"
+# Longest wait between two status checks of a long audio job
+LONG_AUDIO_MAX_POLL_SECONDS = 30.0
+
+class _LongAudioUnavailable(Exception):
+    # Long audio mode failed before any job was accepted (not set up, unsupported voice/encoding, ...)
+    pass
+
+# One output of a synthesis run: a voice and audio encoding, written to output_filename
+SynthesisTarget = namedtuple("SynthesisTarget", ["output_filename", "voice_name", "language_code", "audio_encoding"])
+
+class _ChunkTargetRun:
+    # Bookkeeping of one target in a shared chunk run: its temp folder, progress and failures
+
+    def __init__(self, target, temp_dir_path, label):
+        self.target = target
+        self.temp_dir_path = temp_dir_path
+        # Name shown in progress messages when there is more than one target, None otherwise
+        self.label = label
+        self.audio_format = AUDIO_FORMATS[target.audio_encoding]
+        self.processed_chars = 0
+        self.failed_chunks = []
+        self.unrecoverable_error = None
+        # Set by a worker on an unrecoverable error, chunks of this target not yet started will then skip their API call
+        self.abort_event = threading.Event()
+
+def text_to_speech_converter(text, output_filename, price_per_million, TTS_CHUNK_SIZE=4800, MAX_RETRIES=5, INITIAL_BACKOFF=2, max_workers=4,
+                             voice_name="en-US-Chirp3-HD-Aoede", language_code="en-US", audio_encoding="MP3", audio_cache=None,
+                             rate_limiter=None, interactive=True, backend=None, long_audio_backend=None,
+                             long_audio_min_bytes=300_000, long_audio_job_bytes=900_000, long_audio_max_jobs=4,
+                             long_audio_rate_limiter=None, ssml=False):
+    # One voice and encoding, see synthesize_targets
+    # Returns the audio duration in seconds on success, None if no audio file was written
+    target = SynthesisTarget(output_filename, voice_name, language_code, audio_encoding)
+    durations = synthesize_targets(text, [target], price_per_million, TTS_CHUNK_SIZE, MAX_RETRIES, INITIAL_BACKOFF, max_workers,
+                                   audio_cache=audio_cache, rate_limiter=rate_limiter, interactive=interactive, backend=backend,
+                                   long_audio_backend=long_audio_backend, long_audio_min_bytes=long_audio_min_bytes,
+                                   long_audio_job_bytes=long_audio_job_bytes, long_audio_max_jobs=long_audio_max_jobs,
+                                   long_audio_rate_limiter=long_audio_rate_limiter, ssml=ssml)
+    return durations.get(output_filename)
+
+def synthesize_targets(text, targets, price_per_million, TTS_CHUNK_SIZE=4800, MAX_RETRIES=5, INITIAL_BACKOFF=2, max_workers=4,
+                       audio_cache=None, rate_limiter=None, interactive=True, backend=None, long_audio_backend=None,
+                       long_audio_min_bytes=300_000, long_audio_job_bytes=900_000, long_audio_max_jobs=4,
+                       long_audio_rate_limiter=None, ssml=False):
+    # Chunks text to max chunk size in bytes (per specs, see documentation) and uses Google Cloud TTS to generate an audio file (includes retry mechanism for server side errors)
+    # targets: SynthesisTarget list, e.g. several voices and/or MP3 + OGG_OPUS versions of the same text (see AUDIO_FORMATS).
+    # The text is chunked once, the chunks of all targets share one worker pool and one backend client, and each target keeps
+    # its own temp folder, so targets resume and fail independently of each other
+    # Up to max_workers chunks are in flight at once (all targets together), each worker does its own retries so one slow/failing chunk does not hold up the others
+    # If an AudioCache is given, chunks synthesized before (any document, any run) are copied from it instead of paid for again
+    # Requests are paced by rate_limiter (default: the shared "tts" limiter), which also handles backoff when the API throttles
+    # interactive=False never asks anything (batch runs): existing chunks are resumed, failures keep the chunks for a rerun
+    # backend: a backends.TTSBackend, default is Google Cloud TTS (fake_backends.FakeTTSBackend for offline runs)
+    # long_audio_backend: a backends.LongAudioBackend. MP3 texts of at least long_audio_min_bytes (UTF-8) then go out as
+    # a few long audio jobs of up to long_audio_job_bytes instead of chunk requests, see _long_audio_converter.
+    # Job submissions are paced by long_audio_rate_limiter (default: the shared "tts_long" limiter).
+    # If no job can be submitted at all, the text is synthesized in chunks after all
+    # ssml=True sends the chunks as SSML with pauses around headings, paragraphs and list items and a <mark> at every
+    # section (see ssml_builder), and writes a timing index (see timing_index_path) mapping each section to its start in the audio.
+    # Needs a voice with SSML support, and always synthesizes in chunks (long audio jobs report no timepoints)
+    # Returns {output_filename: audio duration in seconds, None if no audio file was written}
     print("\n Synthesizing Audio")
+    durations = {}
     if not text:
         print("No text to synthesize. Aborting.")
+        return durations
+
+    chunk_targets = []
+    for target in targets:
+        if target.audio_encoding not in AUDIO_FORMATS:
+            print(f"\n!!! {target.audio_encoding} chunks can't be combined (supported: {', '.join(AUDIO_FORMATS)}), skipping '{target.output_filename}'. !!!")
+            durations[target.output_filename] = None
+            continue
+        if uses_long_audio(text, target.audio_encoding, ssml, long_audio_backend is not None, long_audio_min_bytes):
+            try:
+                durations[target.output_filename] = _long_audio_converter(
+                    text, target.output_filename, price_per_million, long_audio_backend, long_audio_job_bytes,
+                    long_audio_max_jobs, MAX_RETRIES, INITIAL_BACKOFF, target.voice_name, target.language_code,
+                    target.audio_encoding, long_audio_rate_limiter or get_rate_limiter("tts_long"), interactive)
+                continue
+            except _LongAudioUnavailable as e:
+                print(f"\n!!! Long audio synthesis is not available ({e}), synthesizing in chunks instead. !!!")
+        chunk_targets.append(target)
+
+    if chunk_targets:
+        durations.update(_chunked_converter(text, chunk_targets, price_per_million, TTS_CHUNK_SIZE, MAX_RETRIES, INITIAL_BACKOFF,
+                                            max_workers, audio_cache, rate_limiter, interactive, backend, ssml))
+    return durations
+
+def _output_sidecar_path(output_filename, suffix):
+    # File/folder next to the output. Outputs that only differ in their extension (book.mp3, book.ogg) get separate ones,
+    # MP3 outputs keep the plain name
+    stem, extension = os.path.splitext(output_filename)
+    if extension.lower() not in ("", ".mp3"):
+        stem += "_" + extension[1:]
+    return stem + suffix
+
+def timing_index_path(output_filename):
+    # Where SSML mode writes the timing index of an audio file
+    return _output_sidecar_path(output_filename, TIMING_INDEX_SUFFIX)
+
+def uses_long_audio(text, audio_encoding, ssml, has_long_audio_backend, long_audio_min_bytes):
+    # Whether synthesize_targets sends a target as long audio jobs instead of chunks. Those don't go through the audio cache
+    return (not ssml and has_long_audio_backend and audio_encoding == "MP3"
+            and len(text.encode("utf-8")) >= long_audio_min_bytes)
+
+def _chunked_converter(text, targets, price_per_million, TTS_CHUNK_SIZE, MAX_RETRIES, INITIAL_BACKOFF, max_workers, audio_cache,
+                       rate_limiter, interactive, backend, ssml):
+    # The chunk path of synthesize_targets, for targets that aren't done as long audio jobs
+    durations = {}
+    runs = []
+    for target in targets:
+        # SSML chunks are other requests than plain ones, they don't share a folder
+        temp_dir_path = _output_sidecar_path(target.output_filename, "_temp_ssml_chunks" if ssml else "_temp_chunks")
+        if not _prepare_temp_dir(temp_dir_path, interactive, "chunks"):
+            durations[target.output_filename] = None
+            continue
+        label = os.path.basename(target.output_filename) if len(targets) > 1 else None
+        runs.append(_ChunkTargetRun(target, temp_dir_path, label))
+    if not runs:
+        return durations
+
+    try:
+        if backend is None:
+            backend = GoogleTTSBackend()
+    except Exception as e:
+        print(f"\n!!! Google Cloud Authentication Error: Could not initialize client: {e} !!!")
+        durations.update((run.target.output_filename, None) for run in runs)
+        return durations
+
+    # Split on sentence/paragraph boundaries, packed up to the byte limit of the API. Once, for all targets
+    with metrics.span("tts.split"):
+        if ssml:
+            sections, ssml_chunks = build_ssml_chunks(text, TTS_CHUNK_SIZE)
+            text_chunks = [ssml_chunk.text for ssml_chunk in ssml_chunks]
+            chunk_marks = [ssml_chunk.marks for ssml_chunk in ssml_chunks]
+            # What is sent to the API for each chunk
+            request_texts = [ssml_chunk.ssml for ssml_chunk in ssml_chunks]
+        else:
+            sections = None
+            chunk_marks = None
+            text_chunks = split_text_for_tts(text, TTS_CHUNK_SIZE)
+            request_texts = text_chunks
+    print(f"Text split into {len(text_chunks)} chunks for audio synthesis.")
+
+    pending_chunks = []
+    for run in runs:
+        target = run.target
+        settings = {"voice_name": target.voice_name, "language_code": target.language_code,
+                    "audio_encoding": target.audio_encoding, "ssml": ssml}
+        _discard_stale_chunks(run.temp_dir_path, settings, request_texts)
+        cached_chars = 0
+        resumed_chunks = 0
+        cached_chunks = 0
+        for index_of_chunk, (chunk, request_text) in enumerate(zip(text_chunks, request_texts)):
+            # Define the path for this specific chunk audio file
+            chunk_filename = os.path.join(run.temp_dir_path, f"chunk_{index_of_chunk:04d}{run.audio_format.extension}")
+            # SSML mode: the chunk's timepoints, written before the audio file so a chunk on disk always has them
+            timepoints_filename = _timepoints_filename(chunk_filename) if ssml else None
+            cache_key = AudioCache.make_key(request_text, target.voice_name, target.language_code, target.audio_encoding)
+            # If the chunk file already exists (of this text, see _discard_stale_chunks), skip the API call
+            if os.path.exists(chunk_filename) and (timepoints_filename is None or os.path.exists(timepoints_filename)):
+                run.processed_chars += len(chunk)
+                resumed_chunks += 1
+            # Same text + voice synthesized before, reuse it for free
+            elif audio_cache is not None and _fetch_cached_chunk(audio_cache, cache_key, chunk_filename, timepoints_filename):
+                cached_chars += len(chunk)
+                cached_chunks += 1
+            else:
+                pending_chunks.append((run, index_of_chunk, chunk, request_text, chunk_filename, timepoints_filename, cache_key))
+
+        prefix = f"{run.label}: " if run.label else ""
+        if resumed_chunks:
+            cost = calculate_tts_cost(run.processed_chars, price_per_million)
+            print(f"{prefix}Found {resumed_chunks} existing chunk files. Skipping their API calls.")
+            print(f"--> Cumulative Characters: {run.processed_chars}, Estimated Cost so far: ${cost:.4f}")
+        metrics.increment("tts.chunks", resumed_chunks, source="resumed")
+        metrics.increment("tts.chunks", cached_chunks, source="cache")
+        metrics.increment("tts.chars", cached_chars, source="cache")
+        if cached_chunks:
+            print(f"{prefix}Reused {cached_chunks} chunks ({cached_chars} characters) from the audio cache at no cost.")
+
+    # Chunk by chunk across the targets (the sort is stable), so all outputs move ahead together
+    pending_chunks.sort(key=lambda pending_chunk: pending_chunk[1])
+
+    if rate_limiter is None:
+        rate_limiter = get_rate_limiter("tts")
+
+    max_workers = max(1, min(max_workers, len(pending_chunks) or 1))
+    targets_note = f" for {len(runs)} outputs" if len(runs) > 1 else ""
+    print(f"Synthesizing {len(pending_chunks)} chunks{targets_note} with up to {max_workers} requests in flight.")
+
+    synthesis_span = metrics.start_span("tts.synthesis", workers=max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_synthesize_chunk, backend, request_text, chunk_filename, timepoints_filename, index_of_chunk, len(text_chunks),
+                            MAX_RETRIES, INITIAL_BACKOFF, run.abort_event, run.target.voice_name, run.target.language_code,
+                            run.target.audio_encoding, rate_limiter):
+                (run, index_of_chunk, chunk, chunk_filename, timepoints_filename, cache_key)
+            for run, index_of_chunk, chunk, request_text, chunk_filename, timepoints_filename, cache_key in pending_chunks
+        }
+
+        # Results are consumed here in the main thread only, so cost reporting needs no locking
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Synthesizing audio..."):
+            run, index_of_chunk, chunk, chunk_filename, timepoints_filename, cache_key = futures[future]
+            chunk_label = f"Chunk {index_of_chunk+1}/{len(text_chunks)}"
+            if run.label:
+                chunk_label = f"{run.label} | {chunk_label}"
+            try:
+                success = future.result()
+            except Exception as e:
+                tqdm.write(f"\n!!! An unrecoverable error occurred on [{chunk_label}]: {e} !!!")
+                if run.unrecoverable_error is None:
+                    run.unrecoverable_error = e
+                run.abort_event.set()
+                run.failed_chunks.append(index_of_chunk)
+                continue
+
+            if not success:
+                run.failed_chunks.append(index_of_chunk)
+                continue
+
+            if audio_cache is not None:
+                if timepoints_filename is not None:
+                    audio_cache.store(_timepoints_cache_key(cache_key), timepoints_filename)
+                audio_cache.store(cache_key, chunk_filename)
+
+            run.processed_chars += len(chunk)
+            metrics.increment("tts.chunks", source="synthesized")
+            metrics.increment("tts.chars", len(chunk), source="synthesized")
+            processed_chars = sum(target_run.processed_chars for target_run in runs)
+            cost = calculate_tts_cost(processed_chars, price_per_million)
+            tqdm.write(f"[{chunk_label}] Done. --> Cumulative Characters: {processed_chars}, Estimated Cost so far: ${cost:.4f}")
+
+    synthesis_span.labels["outcome"] = "failed" if any(run.failed_chunks for run in runs) else "ok"
+    synthesis_span.finish()
+
+    for run in runs:
+        durations[run.target.output_filename] = _finish_chunk_target(run, len(text_chunks), sections, chunk_marks, interactive)
+    return durations
+
+def _finish_chunk_target(run, total_chunks, sections, chunk_marks, interactive):
+    # Combines the chunks of one target into its output file (plus the timing index in SSML mode) and removes its temp folder.
+    # sections, chunk_marks: SSML mode only, see build_ssml_chunks
+    # Returns the audio duration, None if chunks failed
+    output_filename = run.target.output_filename
+    prefix = f"{run.label}: " if run.label else ""
+    if run.failed_chunks:
+        metrics.increment("tts.failed_chunks", len(run.failed_chunks))
+        run.failed_chunks.sort()
+        if run.unrecoverable_error is not None:
+            print(f"\n!!! {prefix}Synthesis stopped after an unrecoverable error: {run.unrecoverable_error} !!!")
+        else:
+            print(f"\n!!! {prefix}Failed to process {len(run.failed_chunks)} chunk(s) after multiple retries (first failed: chunk {run.failed_chunks[0]+1}). Aborting. !!!")
+        save_partial = input("\n>>> Would you like to save the audio processed so far? (y/N): ").lower() if interactive else 'n'
+        if save_partial == 'y':
+            stitch_and_save_partial_audio(run.temp_dir_path, output_filename, run.target.audio_encoding)
+        print("Run the script again with the same output filename to resume.")
         return
-    
-    temp_dir_name = os.path.splitext(os.path.basename(output_filename))[0] + "_temp_chunks"
-    temp_dir_path = os.path.join(os.path.dirname(output_filename), temp_dir_name)
-    
+
+    # Combine chunks
+    print(f"\nAll chunks processed successfully. Combining into '{output_filename}'...")
+
+    # Find all chunk files in the temporary directory and sort them
+    chunk_files = sorted(glob.glob(os.path.join(run.temp_dir_path, f"chunk_*{run.audio_format.extension}")))
+    if len(chunk_files) != total_chunks:
+        print(f"!!! Warning: Expected {total_chunks} chunks but found {len(chunk_files)} on disk.")
+        if not interactive or input("Proceed anyway? (y/N) ").lower() != 'y':
+            return
+
+    # Streams the audio of each chunk into one file (MP3: frames behind a single header covering the whole book,
+    # Ogg Opus: chained streams)
+    with metrics.span("tts.stitch", files=len(chunk_files)):
+        duration = run.audio_format.stitch(chunk_files, output_filename)
+    metrics.increment("tts.audio_bytes", os.path.getsize(output_filename))
+    metrics.observe("tts.audio_seconds", duration)
+
+    print(f"\nCombining generated audio complete ({duration / 60:.1f} minutes).")
+    print(f"Audiobook saved as '{output_filename}'")
+
+    if sections is not None:
+        if len(chunk_files) == total_chunks:
+            index_path = timing_index_path(output_filename)
+            _write_timing_index(index_path, output_filename, duration, run.target.voice_name, sections, chunk_files,
+                                chunk_marks, run.audio_format.duration)
+            print(f"Timing index of {len(sections)} sections saved as '{index_path}'")
+        else:
+            print("!!! Warning: Chunks are missing, no timing index written.")
+
+    # Cleanup of temporary directory
+    try:
+        print(f"Cleaning up temporary directory: '{run.temp_dir_path}'")
+        shutil.rmtree(run.temp_dir_path)
+        print("Cleanup complete.")
+    except Exception as e:
+        print(f"\n!!! Warning: Could not remove temporary directory. Error: {e} !!!")
+        print("You can manually delete it if desired.")
+
+    return duration
+
+def _timepoints_filename(chunk_filename):
+    return os.path.splitext(chunk_filename)[0] + ".timepoints.json"
+
+def _timepoints_cache_key(cache_key):
+    # The timepoints of an SSML chunk are cached next to its audio, under a key derived from the audio's
+    return hashlib.sha256(f"{cache_key}/timepoints".encode("utf-8")).hexdigest()
+
+def _fetch_cached_chunk(audio_cache, cache_key, chunk_filename, timepoints_filename):
+    # SSML chunks are only a hit with their timepoints, the timepoints are fetched first so the audio file stays the
+    # marker of a finished chunk
+    if timepoints_filename is not None and not audio_cache.fetch(_timepoints_cache_key(cache_key), timepoints_filename):
+        return False
+    return audio_cache.fetch(cache_key, chunk_filename)
+
+def _write_timing_index(index_path, output_filename, duration, voice_name, sections, chunk_files, chunk_marks, chunk_duration):
+    # Start of every section in the stitched audio: the chunk's start (sum of the durations before it) plus the mark's
+    # time within the chunk. A mark the API reported no time for gets the start of its chunk.
+    # Mark names count within each chunk, chunk_marks (SsmlChunk.marks of every chunk) maps them to the sections
+    section_seconds = {}
+    chunk_start_seconds = 0.0
+    for chunk_filename, section_marks in zip(chunk_files, chunk_marks):
+        with open(_timepoints_filename(chunk_filename), "r", encoding="utf-8") as f:
+            chunk_timepoints = json.load(f)
+        # The chunk's marks in SSML order, the same order as its sections
+        sections_by_mark = dict(zip(chunk_timepoints["marks"], section_marks))
+        for mark, seconds in chunk_timepoints["timepoints"].items():
+            if mark in sections_by_mark:
+                section_seconds[sections_by_mark[mark]] = chunk_start_seconds + seconds
+        for section_mark in section_marks:
+            section_seconds.setdefault(section_mark, chunk_start_seconds)
+        chunk_start_seconds += chunk_duration(chunk_filename)
+
+    write_json_atomic(index_path, {
+        "audio_file": os.path.basename(output_filename),
+        "duration_seconds": round(duration, 3),
+        "voice_name": voice_name,
+        "sections": [
+            {
+                "mark": section.mark,
+                "kind": section.kind,
+                "title": section.text.split("\n", 1)[0][:TIMING_INDEX_TITLE_CHARS],
+                "text_offset": section.offset,
+                "seconds": round(section_seconds.get(section.mark, 0.0), 3),
+            }
+            for section in sections
+        ],
+    })
+
+def _synthesize_chunk(backend, chunk, chunk_filename, timepoints_filename, index_of_chunk, total_chunks, MAX_RETRIES, INITIAL_BACKOFF,
+                      abort_event, voice_name, language_code, audio_encoding, rate_limiter):
+    # Runs in a worker thread: synthesizes one chunk with its own retries and writes it to disk
+    # With a timepoints_filename the chunk is SSML, its mark times are saved there
+    # Pacing and backoff come from the shared rate_limiter, a throttled request pauses all workers rather than just this one
+    # Returns True on success, False if retries ran out (or the run was aborted), raises on unrecoverable errors
+    retries = 0
+    while retries < MAX_RETRIES:
+        if abort_event.is_set():
+            return False
+        with metrics.span("tts.rate_limit_wait"):
+            rate_limiter.acquire(len(chunk))
+        if abort_event.is_set():
+            return False
+        try:
+            if retries == 0:
+                tqdm.write(f"[Chunk {index_of_chunk+1}/{total_chunks}] Requesting voice: {voice_name}...")
+
+            # Latency of each API request, retried attempts included (failed ones carry an "error" label)
+            with metrics.span("tts.request"):
+                if timepoints_filename is None:
+                    audio_content = backend.synthesize(chunk, voice_name, language_code, audio_encoding)
+                else:
+                    audio_content, timepoints = backend.synthesize_ssml(chunk, voice_name, language_code, audio_encoding)
+            metrics.observe("tts.chunk_chars", len(chunk))
+            metrics.increment("tts.response_bytes", len(audio_content))
+            if timepoints_filename is not None:
+                write_json_atomic(timepoints_filename, {"marks": SSML_MARK_PATTERN.findall(chunk), "timepoints": timepoints})
+            # Save the successful chunk immediately, via a temp name so an interrupted write is never mistaken for a finished chunk on resume
+            partial_filename = chunk_filename + ".part"
+            with open(partial_filename, "wb") as out:
+                out.write(audio_content)
+            os.replace(partial_filename, chunk_filename)
+            rate_limiter.report_success()
+            return True
+
+        # Quota exceeded (429), overloaded (503) or timed out: slow down and retry
+        except TransientBackendError as e:
+            backoff_time = rate_limiter.report_throttled(INITIAL_BACKOFF)
+            retries += 1
+            if retries < MAX_RETRIES:
+                metrics.increment("tts.retries", status=e.status_code)
+                tqdm.write(f"\n ??? Warning: {e.description} on chunk {index_of_chunk+1}. Retrying in {backoff_time:.1f}s... (Attempt {retries + 1}/{MAX_RETRIES}) ???")
+
+    if retries >= MAX_RETRIES:
+        metrics.increment("tts.retries_exhausted")
+    return False
+
+def _prepare_temp_dir(temp_dir_path, interactive, what):
+    # Creates the folder of a synthesis run, or offers to resume the one an earlier run left. False if it can't be used
     if os.path.exists(temp_dir_path):
         print(f"\nFound existing temporary data at: {temp_dir_path}")
-        decision = input(">>> Resume from existing chunks (r) or Delete and restart (d)? (r/D): ").lower()
-        
+        if interactive:
+            decision = input(f">>> Resume from existing {what} (r) or Delete and restart (d)? (r/D): ").lower()
+        else:
+            decision = 'r'
+
         if decision == 'd' or decision == '':
             try:
                 shutil.rmtree(temp_dir_path)
@@ -29,111 +442,241 @@ def text_to_speech_converter(text, output_filename, price_per_million, TTS_CHUNK
                 print("Temporary directory cleared for fresh start.")
             except Exception as e:
                 print(f"Error clearing directory: {e}")
-                return
+                return False
         else:
-            print("Resuming from existing chunks...")
+            print(f"Resuming from existing {what}...")
     else:
         os.makedirs(temp_dir_path, exist_ok=True)
-    
-    # os.makedirs(temp_dir_path, exist_ok=True)
-    # print(f"Chunks will be temporarily stored in: '{temp_dir_path}'")
-        
-    try:
-        tts_client = texttospeech.TextToSpeechClient()
-    except Exception as e:
-        print(f"\n!!! Google Cloud Authentication Error: Could not initialize client: {e} !!!")
+    return True
+
+def _load_manifest(manifest_path, settings, what):
+    # Manifest of an earlier run with the same settings (voice, encoding, job size, ...), or a fresh one.
+    # what: "jobs" or "chunks", the entries it keeps by index
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("settings") == settings:
+                return manifest
+            print(f"Earlier {what} were made with other settings (voice, encoding, ...), starting over.")
+        except (OSError, ValueError) as e:
+            print(f"!!! Warning: Could not read '{manifest_path}' ({e}), starting over.")
+    return {"settings": settings, what: {}}
+
+def _discard_stale_chunks(temp_dir_path, settings, request_texts):
+    # Resume check of a chunk folder. A chunk file is only kept if the manifest of the run that wrote it has the same
+    # text hash at its index: chunks of another text (or voice), and chunks past the new chunk count, are deleted.
+    # Then records this run's hashes, before any chunk is written
+    manifest_path = os.path.join(temp_dir_path, CHUNK_MANIFEST_FILENAME)
+    manifest = _load_manifest(manifest_path, settings, "chunks")
+    text_hashes = [hashlib.sha256(request_text.encode("utf-8")).hexdigest() for request_text in request_texts]
+    stale_indices = set()
+    for file_name in os.listdir(temp_dir_path):
+        match = CHUNK_FILE_PATTERN.match(file_name)
+        if match is None:
+            continue
+        index = int(match.group(1))
+        if index < len(text_hashes) and manifest["chunks"].get(str(index)) == text_hashes[index]:
+            continue
+        os.remove(os.path.join(temp_dir_path, file_name))
+        stale_indices.add(index)
+    if stale_indices:
+        print(f"Removed {len(stale_indices)} chunk(s) of an earlier run whose text changed since, they are synthesized again.")
+    manifest["chunks"] = {str(index): text_hash for index, text_hash in enumerate(text_hashes)}
+    write_json_atomic(manifest_path, manifest)
+
+def _long_audio_converter(text, output_filename, price_per_million, backend, job_bytes, max_jobs, MAX_RETRIES, INITIAL_BACKOFF,
+                          voice_name, language_code, audio_encoding, rate_limiter, interactive):
+    # Long audio mode: the text goes out as a few large server-side jobs instead of thousands of chunk requests.
+    # Up to max_jobs run side by side, each is polled on its own and downloaded as soon as it is done, then the job
+    # files are stitched like chunks. Resume works like the chunk path: finished job files in <name>_temp_jobs are kept,
+    # and jobs that were still running when a run stopped are picked up again by their job id instead of paid for twice.
+    # Raises _LongAudioUnavailable if not a single job could be submitted
+    temp_dir_path = _output_sidecar_path(output_filename, "_temp_jobs")
+    if not _prepare_temp_dir(temp_dir_path, interactive, "jobs"):
         return
 
-    text_chunks = [text[i:i + TTS_CHUNK_SIZE] for i in range(0, len(text), TTS_CHUNK_SIZE)]
-    print(f"Text split into {len(text_chunks)} chunks for audio synthesis.")
-    
+    if backend.max_job_bytes:
+        job_bytes = min(job_bytes, backend.max_job_bytes)
+    # Same sentence-aware splitting as the chunks, so the same text always gives the same jobs
+    job_texts = split_text_for_tts(text, job_bytes)
+    print(f"Text split into {len(job_texts)} long audio job(s).")
+
+    manifest_path = os.path.join(temp_dir_path, LONG_AUDIO_MANIFEST_FILENAME)
+    settings = {"voice_name": voice_name, "language_code": language_code, "audio_encoding": audio_encoding, "job_bytes": job_bytes}
+    manifest = _load_manifest(manifest_path, settings, "jobs")
+    manifest_lock = threading.Lock()
+
+    def save_manifest():
+        with manifest_lock:
+            write_json_atomic(manifest_path, manifest)
+
+    base_name = os.path.splitext(os.path.basename(output_filename))[0]
+    job_files = []
+    pending_jobs = []
     processed_chars = 0
-    
-    for index_of_chunk, chunk in enumerate(tqdm(text_chunks, desc="Synthesizing audio...")):
-        # Define the path for this specific chunk audio file
-        chunk_filename = os.path.join(temp_dir_path, f"chunk_{index_of_chunk:04d}.mp3")
-        # If the chunk file already exists, skip the API call
-        if os.path.exists(chunk_filename):
-            processed_chars += len(chunk)
-            cost = calculate_tts_cost(processed_chars, price_per_million)
-            tqdm.write(f"\n[Chunk {index_of_chunk+1}/{len(text_chunks)}] Found existing chunk file. Skipping API call.")
-            tqdm.write(f"--> Cumulative Characters: {processed_chars}, Estimated Cost so far: ${cost:.4f}")
-            continue
+    for job_index, job_text in enumerate(job_texts):
+        job_file = os.path.join(temp_dir_path, f"job_{job_index:04d}.mp3")
+        job_files.append(job_file)
+        text_sha256 = hashlib.sha256(job_text.encode("utf-8")).hexdigest()
+        entry = manifest["jobs"].get(str(job_index))
+        if entry is None or entry["text_sha256"] != text_sha256:
+            # New job, or the text at this position changed since the earlier run
+            if os.path.exists(job_file):
+                os.remove(job_file)
+            entry = {"text_sha256": text_sha256, "job_name": f"{base_name}_{text_sha256[:16]}.mp3", "job_id": None}
+            manifest["jobs"][str(job_index)] = entry
+        if os.path.exists(job_file):
+            processed_chars += len(job_text)
+        else:
+            pending_jobs.append((job_index, job_text, job_file, entry))
+    save_manifest()
+
+    if processed_chars:
+        print(f"Found {len(job_texts) - len(pending_jobs)} finished job file(s), {processed_chars} characters.")
+    running_jobs = sum(1 for _, _, _, entry in pending_jobs if entry["job_id"])
+    if running_jobs:
+        print(f"Checking on {running_jobs} job(s) submitted by an earlier run.")
+
+    max_jobs = max(1, min(max_jobs, len(pending_jobs) or 1))
+    abort_event = threading.Event()
+    # Set once the service has accepted a job, from then on failures are reported instead of falling back to chunks
+    submitted_event = threading.Event()
+    if running_jobs or processed_chars:
+        submitted_event.set()
+    failed_jobs = []
+    unrecoverable_error = None
 
-        retries = 0
-        backoff_time = INITIAL_BACKOFF
-        while retries < MAX_RETRIES:
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        futures = {
+            executor.submit(_run_long_audio_job, backend, job_text, job_file, entry, job_index, len(job_texts), save_manifest,
+                            MAX_RETRIES, INITIAL_BACKOFF, abort_event, submitted_event, voice_name, language_code,
+                            audio_encoding, rate_limiter): (job_index, job_text)
+            for job_index, job_text, job_file, entry in pending_jobs
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Long audio jobs"):
+            job_index, job_text = futures[future]
             try:
-                synthesis_input = texttospeech.SynthesisInput(text=chunk)
-                voice = texttospeech.VoiceSelectionParams(language_code="en-US", name="en-US-Chirp3-HD-Aoede")
-                audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3)
-
-                if retries == 0:
-                    tqdm.write(f"\n[Chunk {index_of_chunk+1}/{len(text_chunks)}] Requesting voice: {voice.name}...")
-
-                response = tts_client.synthesize_speech(
-                    input=synthesis_input,
-                    voice=voice,
-                    audio_config=audio_config,
-                    timeout=120.0
-                )
-                # Save the successful chunk immediately
-                with open(chunk_filename, "wb") as out:
-                    out.write(response.audio_content)
-
-                processed_chars += len(chunk)
-                cost = calculate_tts_cost(processed_chars, price_per_million)
-                tqdm.write(f"--> Cumulative Characters: {processed_chars}, Estimated Cost so far: ${cost:.4f}")
-                
-                break  # Success, exit the retry loop
-
-            except (google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded) as e:
-                error_type = "Server error" if isinstance(e, google_exceptions.ServiceUnavailable) else "Timeout (Deadline Exceeded)"
-                tqdm.write(f"\n ??? Warning: {error_type} on chunk {index_of_chunk+1}. Retrying in {backoff_time}s... (Attempt {retries + 2}/{MAX_RETRIES}) ???")
-                time.sleep(backoff_time)
-                retries += 1
-                backoff_time *= 2
-            
+                success = future.result()
             except Exception as e:
-                print(f"\n!!! An unrecoverable error occurred on chunk {index_of_chunk+1}: {e} !!!")
-                save_partial = input("\n>>> Would you like to save the audio processed so far? (y/N): ").lower()
-                if save_partial == 'y':
-                    stitch_and_save_partial_audio(temp_dir_path, output_filename)
-                print("Aborting synthesis. Run the script again with the same output filename to resume.")
-                return
-
-        # Check if this specific chunk failed after all retries
-        if not os.path.exists(chunk_filename):
-            print(f"\n!!! Failed to process chunk {index_of_chunk+1} after multiple retries. Aborting. !!!")
-            save_partial = input("\n>>> Would you like to save the audio processed so far? (y/N): ").lower()
-            if save_partial == 'y':
-                stitch_and_save_partial_audio(temp_dir_path, output_filename)
-            print("Run the script again with the same output filename to resume.")
-            return
+                tqdm.write(f"\n!!! An unrecoverable error occurred on job {job_index+1}: {e} !!!")
+                if unrecoverable_error is None:
+                    unrecoverable_error = e
+                abort_event.set()
+                failed_jobs.append(job_index)
+                continue
+            if not success:
+                failed_jobs.append(job_index)
+                continue
+            processed_chars += len(job_text)
+            metrics.increment("tts_long.chars", len(job_text))
+            cost = calculate_tts_cost(processed_chars, price_per_million)
+            tqdm.write(f"[Job {job_index+1}/{len(job_texts)}] Done. --> Cumulative Characters: {processed_chars}, Estimated Cost so far: ${cost:.4f}")
 
-    # Combine chunks
-    print(f"\nAll chunks processed successfully. Combining into '{output_filename}'...")
-    
-    # Find all chunk files in the temporary directory and sort them
-    chunk_files = sorted(glob.glob(os.path.join(temp_dir_path, "chunk_*.mp3")))
-    if len(chunk_files) != len(text_chunks):
-        print(f"!!! Warning: Expected {len(text_chunks)} chunks but found {len(chunk_files)} on disk.")
-        if input("Proceed anyway? (y/N) ").lower() != 'y':
-            return
+    if failed_jobs:
+        metrics.increment("tts_long.failed_jobs", len(failed_jobs))
+        if unrecoverable_error is not None and not submitted_event.is_set():
+            shutil.rmtree(temp_dir_path, ignore_errors=True)
+            raise _LongAudioUnavailable(unrecoverable_error)
+        if unrecoverable_error is not None:
+            print(f"\n!!! Long audio synthesis stopped after an unrecoverable error: {unrecoverable_error} !!!")
+        else:
+            print(f"\n!!! {len(failed_jobs)} long audio job(s) failed after multiple retries. Aborting. !!!")
+        print("Run the script again with the same output filename to resume, finished and running jobs are kept.")
+        return
 
-    with open(output_filename, "wb") as out_file:
-        for chunk_file in chunk_files:
-            with open(chunk_file, "rb") as in_chunk:
-                out_file.write(in_chunk.read())
-    
-    print("\nCombining generated audio complete.")
+    print(f"\nAll jobs finished. Combining into '{output_filename}'...")
+    with metrics.span("tts.stitch", files=len(job_files)):
+        duration = AUDIO_FORMATS["MP3"].stitch(job_files, output_filename)
+    metrics.increment("tts.audio_bytes", os.path.getsize(output_filename))
+    metrics.observe("tts.audio_seconds", duration)
+    print(f"\nCombining generated audio complete ({duration / 60:.1f} minutes).")
     print(f"Audiobook saved as '{output_filename}'")
 
-    # Cleanup of temporary directory
     try:
         print(f"Cleaning up temporary directory: '{temp_dir_path}'")
         shutil.rmtree(temp_dir_path)
         print("Cleanup complete.")
     except Exception as e:
         print(f"\n!!! Warning: Could not remove temporary directory. Error: {e} !!!")
-        print("You can manually delete it if desired.")
\ No newline at end of file
+        print("You can manually delete it if desired.")
+
+    return duration
+
+def _wait_for_job(backend, job_id, abort_event):
+    # Polls until the job is done (True) or the run is aborted (False). Raises BackendError if the job failed,
+    # JobNotFoundError if the service doesn't know it. A status check that fails temporarily is just tried again later
+    delays = poll_delays(initial=1.0, maximum=LONG_AUDIO_MAX_POLL_SECONDS)
+    while True:
+        try:
+            if backend.poll(job_id) == "done":
+                return True
+        except JobNotFoundError:
+            raise
+        except TransientBackendError:
+            pass
+        if abort_event.wait(next(delays)):
+            return False
+
+def _run_long_audio_job(backend, job_text, job_file, entry, job_index, total_jobs, save_manifest, MAX_RETRIES, INITIAL_BACKOFF,
+                        abort_event, submitted_event, voice_name, language_code, audio_encoding, rate_limiter):
+    # Runs in a worker thread: submits one job (unless an earlier run already did), waits for it and downloads the audio.
+    # The job id goes into the manifest right after submission, so an interrupted run never pays for a job twice.
+    # Returns True on success, False if attempts ran out (or the run was aborted), raises on unrecoverable errors
+    attempts = 0
+    while attempts < MAX_RETRIES:
+        if abort_event.is_set():
+            return False
+
+        if entry["job_id"] is None:
+            with metrics.span("tts_long.rate_limit_wait"):
+                rate_limiter.acquire(len(job_text))
+            try:
+                with metrics.span("tts_long.submit"):
+                    entry["job_id"] = backend.submit(job_text, voice_name, language_code, audio_encoding, entry["job_name"])
+            except TransientBackendError as e:
+                backoff_time = rate_limiter.report_throttled(INITIAL_BACKOFF)
+                attempts += 1
+                metrics.increment("tts_long.retries", stage="submit", status=e.status_code)
+                tqdm.write(f"\n ??? Warning: {e.description} submitting job {job_index+1}. Retrying in {backoff_time:.1f}s... ???")
+                continue
+            rate_limiter.report_success()
+            submitted_event.set()
+            save_manifest()
+            tqdm.write(f"[Job {job_index+1}/{total_jobs}] Submitted ({len(job_text)} characters).")
+
+        try:
+            with metrics.span("tts_long.wait"):
+                if not _wait_for_job(backend, entry["job_id"], abort_event):
+                    return False
+        except JobNotFoundError:
+            tqdm.write(f"\n ??? Warning: the service no longer knows job {job_index+1}, submitting it again. ???")
+            metrics.increment("tts_long.retries", stage="lost")
+            entry["job_id"] = None
+            save_manifest()
+            attempts += 1
+            continue
+        except BackendError as e:
+            tqdm.write(f"\n ??? Warning: job {job_index+1} failed ({e}), submitting it again. ???")
+            metrics.increment("tts_long.retries", stage="job")
+            entry["job_id"] = None
+            save_manifest()
+            attempts += 1
+            continue
+
+        # Streamed into a temp name, an interrupted download is never mistaken for a finished job on resume
+        partial_filename = job_file + ".part"
+        try:
+            with open(partial_filename, "wb") as out, metrics.span("tts_long.download"):
+                backend.download(entry["job_id"], entry["job_name"], out)
+        except TransientBackendError as e:
+            attempts += 1
+            metrics.increment("tts_long.retries", stage="download", status=e.status_code)
+            tqdm.write(f"\n ??? Warning: {e.description} downloading job {job_index+1}, trying again. ???")
+            continue
+        os.replace(partial_filename, job_file)
+        metrics.increment("tts_long.download_bytes", os.path.getsize(job_file))
+        backend.discard(entry["job_id"], entry["job_name"])
+        return True
+
+    return False
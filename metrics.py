@@ -0,0 +1,201 @@
+import json
+import time
+import math
+import random
+import threading
+import contextlib
+from collections import defaultdict
+
+# Lightweight instrumentation for finding hot spots in a run: spans (timed stages), counters and latency histograms.
+#   with metrics.span("tts.request"): ...          duration goes into the "tts.request" histogram (seconds)
+#   metrics.increment("tts.retries", reason="429")  counters, optionally split by labels
+#   metrics.observe("tts.chunk_chars", 4711)        any other distribution
+# Everything lands in one process-wide registry (thread-safe, workers record concurrently). At the end of a run it is
+# written out with export_metrics(path): Prometheus text format for *.prom files, JSON lines otherwise (one line per
+# finished span, then one summary line per counter/histogram with count, sum, p50, p95 and max).
+# Memory stays bounded on long runs: histograms keep a fixed-size random sample for the percentiles, and individual span
+# records are only kept when keep_span_events is switched on (for a JSON lines export, see export_wants_span_events).
+
+# Values sampled per histogram for p50/p95, count, sum and max are exact
+HISTOGRAM_SAMPLE_SIZE = 4096
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+class _Histogram:
+    # Exact count, sum and max, plus a uniform sample of at most HISTOGRAM_SAMPLE_SIZE values (reservoir sampling)
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+        self.sample = []
+
+    def add(self, value, rng):
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.sample) < HISTOGRAM_SAMPLE_SIZE:
+            self.sample.append(value)
+        else:
+            index = rng.randrange(self.count)
+            if index < HISTOGRAM_SAMPLE_SIZE:
+                self.sample[index] = value
+
+class MetricsRegistry:
+
+    def __init__(self, keep_span_events=False):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._histograms = defaultdict(_Histogram)
+        self._random = random.Random()
+        # Individual span records for the JSON lines export (name, labels, start time, duration), one per finished span,
+        # so off unless a run asks for them
+        self.keep_span_events = keep_span_events
+        self._span_events = []
+        self._started = time.time()
+
+    def increment(self, name, amount=1, **labels):
+        with self._lock:
+            self._counters[(name, _label_key(labels))] += amount
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            self._histograms[(name, _label_key(labels))].add(value, self._random)
+
+    def start_span(self, name, **labels):
+        # For stages that don't fit a with block: span = start_span(...), later span.finish()
+        return _Span(self, name, labels)
+
+    @contextlib.contextmanager
+    def span(self, name, **labels):
+        # Times the block. If it raises, the duration is recorded with an "error" label (exception class) instead
+        running_span = self.start_span(name, **labels)
+        try:
+            yield running_span
+        except BaseException as e:
+            running_span.labels["error"] = type(e).__name__
+            raise
+        finally:
+            running_span.finish()
+
+    def _record_span(self, name, labels, started_at, duration):
+        label_key = _label_key(labels)
+        with self._lock:
+            self._histograms[(name, label_key)].add(duration, self._random)
+            if self.keep_span_events:
+                self._span_events.append({"type": "span", "name": name, "labels": dict(label_key),
+                                          "start": round(started_at, 6), "seconds": round(duration, 6)})
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._span_events.clear()
+            self._started = time.time()
+
+    def snapshot(self):
+        # Counters and histogram summaries as plain dicts (for reports and tests)
+        with self._lock:
+            counters = [{"name": name, "labels": dict(label_key), "value": value}
+                        for (name, label_key), value in sorted(self._counters.items())]
+            histograms = []
+            for (name, label_key), histogram in sorted(self._histograms.items()):
+                ordered = sorted(histogram.sample)
+                histograms.append({"name": name, "labels": dict(label_key), "count": histogram.count, "sum": histogram.sum,
+                                   "p50": percentile(ordered, 0.5), "p95": percentile(ordered, 0.95), "max": histogram.max})
+            return counters, histograms
+
+    def write_jsonl(self, path):
+        counters, histograms = self.snapshot()
+        with self._lock:
+            span_events = list(self._span_events)
+        with open(path, "w", encoding="utf-8") as f:
+            for event in span_events:
+                f.write(json.dumps(event) + "\n")
+            for counter in counters:
+                f.write(json.dumps(dict(counter, type="counter")) + "\n")
+            for histogram in histograms:
+                f.write(json.dumps(dict(histogram, type="histogram")) + "\n")
+
+    def write_prometheus(self, path):
+        # Counters as <name>_total, histograms as summaries with 0.5/0.95 quantiles. Dots become underscores,
+        # everything is prefixed with textractor_ so the metrics are easy to find next to other exporters
+        counters, histograms = self.snapshot()
+
+        def metric_name(name):
+            return "textractor_" + "".join(c if c.isalnum() else "_" for c in name)
+
+        def label_text(labels, extra=None):
+            items = list(labels.items()) + (list(extra.items()) if extra else [])
+            if not items:
+                return ""
+            escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in items)
+            return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + "}"
+
+        lines = []
+        declared = set()
+        for counter in counters:
+            name = metric_name(counter["name"]) + "_total"
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{label_text(counter['labels'])} {counter['value']}")
+        for histogram in histograms:
+            name = metric_name(histogram["name"])
+            if name not in declared:
+                lines.append(f"# TYPE {name} summary")
+                declared.add(name)
+            labels = histogram["labels"]
+            lines.append(f"{name}{label_text(labels, {'quantile': '0.5'})} {histogram['p50']}")
+            lines.append(f"{name}{label_text(labels, {'quantile': '0.95'})} {histogram['p95']}")
+            lines.append(f"{name}_sum{label_text(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{label_text(labels)} {histogram['count']}")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+class _Span:
+
+    def __init__(self, registry, name, labels):
+        self._registry = registry
+        self.name = name
+        # Can still be changed/added to before finish(), e.g. an outcome label
+        self.labels = dict(labels)
+        self._started_at = time.time()
+        self._start = time.perf_counter()
+        self._finished = False
+
+    def finish(self):
+        # Records the duration once, further calls are ignored. Returns the duration in seconds
+        duration = time.perf_counter() - self._start
+        if not self._finished:
+            self._finished = True
+            self._registry._record_span(self.name, self.labels, self._started_at, duration)
+        return duration
+
+# The process-wide registry, and shortcuts to it
+METRICS = MetricsRegistry()
+increment = METRICS.increment
+observe = METRICS.observe
+span = METRICS.span
+start_span = METRICS.start_span
+
+def export_wants_span_events(path):
+    # Only the JSON lines export writes individual spans, the registry keeps them when a run is going to write one
+    return not path.endswith(".prom")
+
+def export_metrics(path, registry=METRICS):
+    # *.prom -> Prometheus text format (e.g. for the node_exporter textfile collector), anything else -> JSON lines
+    if path.endswith(".prom"):
+        registry.write_prometheus(path)
+    else:
+        registry.write_jsonl(path)
+    print(f"Metrics saved to '{path}'")
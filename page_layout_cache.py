@@ -0,0 +1,69 @@
+import os
+import json
+import zlib
+import sqlite3
+import threading
+
+from utility_functions import content_key
+
+class PageLayoutCache:
+    # Persistent store for the sorted text blocks of PDF pages, the output of the expensive PyMuPDF step of the core extractor.
+    # Pages are keyed by a hash of the PDF's content plus the reader version, and by page index. Re-running an extraction
+    # with other fixes or an overlapping page range then only reads the pages it hasn't seen, everything else is cleanup.
+    # One SQLite file, each page's blocks stored as zlib-compressed JSON. No size cap, delete the file to start over
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS page_layouts ("
+                " document TEXT NOT NULL, page_index INTEGER NOT NULL, blocks BLOB NOT NULL,"
+                " PRIMARY KEY (document, page_index)) WITHOUT ROWID"
+            )
+
+    @staticmethod
+    def make_key(source_sha256, reader_version):
+        # reader_version covers how blocks are read and sorted, a change there must not reuse old layouts
+        return content_key(source_sha256, reader_version)
+
+    @staticmethod
+    def _encode(blocks):
+        return zlib.compress(json.dumps(list(blocks), ensure_ascii=False).encode('utf-8'))
+
+    @staticmethod
+    def _decode(data):
+        return tuple(json.loads(zlib.decompress(data).decode('utf-8')))
+
+    def get_pages(self, document_key, start_page_index, end_page_index):
+        # {page index: blocks} of the cached pages in [start_page_index, end_page_index), empty if the cache can't be read
+        try:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT page_index, blocks FROM page_layouts WHERE document = ? AND page_index >= ? AND page_index < ?",
+                    (document_key, start_page_index, end_page_index)
+                ).fetchall()
+            return {page_index: self._decode(blocks) for page_index, blocks in rows}
+        except (sqlite3.Error, zlib.error, ValueError) as e:
+            print(f"!!! Warning: Could not read page layout cache: {e}")
+            return {}
+
+    def put_pages(self, document_key, pages):
+        # pages: iterable of (page index, blocks). Failures only cost a future cache miss, so they are reported and ignored
+        rows = [(document_key, page_index, self._encode(blocks)) for page_index, blocks in pages]
+        if not rows:
+            return
+        try:
+            with self._lock, self._connection:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO page_layouts (document, page_index, blocks) VALUES (?, ?, ?)", rows
+                )
+        except sqlite3.Error as e:
+            print(f"!!! Warning: Could not store pages in page layout cache: {e}")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
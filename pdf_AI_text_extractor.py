@@ -1,12 +1,15 @@
 import os
-import time
+import json
 import shutil
 import re
+import threading
 import pymupdf
-from google import genai
-from google.genai import types
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from utility_functions import smart_stitch
+from utility_functions import smart_stitch, file_sha256, write_json_atomic
+from rate_limiter import get_rate_limiter
+from backends import GeminiExtractionBackend, TransientBackendError
+import metrics
 
 try:
     from config import GEMINI_API_KEY
@@ -14,14 +17,40 @@ except ImportError:
     pass
 
 ai_model = 'gemini-2.5-pro' #'gemini-2.0-flash'
+# Part of the response cache key, together with the model and prompt
+EXTRACTION_TEMPERATURE = 0.1
 
-def extract_text_with_gemini(pdf_path, start_page_index=0, end_page_index=None):
-    api_key = GEMINI_API_KEY
-    if not api_key:
-        print("!!! Error: GOOGLE_API_KEY not found. !!!")
-        return None
+# Characters searched on each side of a batch boundary for the overlap when stitching parallel batches,
+# the whole overlap page has to fit in it. Overlap search is near-linear, so a few dense pages worth is cheap
+PARALLEL_STITCH_WINDOW = 30000
+# Below this the best shared word run is more likely a repeated phrase than the actual overlap page (see find_text_overlap)
+PARALLEL_STITCH_MIN_CONFIDENCE = 0.25
+
+# Checkpoint of a run inside its batch folder: window bounds, status and anchor of every batch
+MANIFEST_FILENAME = "manifest.json"
+# Characters at the end of a batch that are handed to the next batch as its anchor
+ANCHOR_LENGTH = 300
+
+# Attempts per batch when Gemini answers 429 (quota), 503 (overloaded) or times out, the rate limiter decides how long to wait
+GEMINI_MAX_ATTEMPTS = 5
+
+def extract_text_with_gemini(pdf_path, start_page_index=0, end_page_index=None, parallel=False, max_concurrency=4,
+                             response_cache=None, rate_limiter=None, backend=None):
+    # parallel=False: batches run one after another, each prompt carries the tail of the previous batch as an anchor
+    # parallel=True: all page windows are sent at once (up to max_concurrency in flight) without anchors,
+    #                the overlapping pages are reconciled afterwards with smart_stitch
+    # response_cache: optional GeminiResponseCache, windows extracted before (same pages, model and prompt) are reused
+    # rate_limiter: paces the API requests (default: the shared "gemini" limiter)
+    # backend: a backends.ExtractionBackend, default is Gemini (fake_backends.FakeExtractionBackend for offline runs)
+    if backend is None:
+        api_key = GEMINI_API_KEY
+        if not api_key:
+            print("!!! Error: GOOGLE_API_KEY not found. !!!")
+            return None
+        backend = GeminiExtractionBackend(api_key, ai_model)
 
-    client = genai.Client(api_key=api_key)
+    if rate_limiter is None:
+        rate_limiter = get_rate_limiter("gemini")
     
     # Using an overlap so sentences arent cut off
     if ai_model == 'gemini-2.5-pro':
@@ -33,18 +62,10 @@ def extract_text_with_gemini(pdf_path, start_page_index=0, end_page_index=None):
     
     filename_base = os.path.splitext(os.path.basename(pdf_path))[0]
     
-    # dir of outputs from batches
+    # dir of outputs from batches, kept between runs so an interrupted extraction can resume (see manifest below)
     batch_output_dir = os.path.join("extracted_batches", filename_base)
-    if os.path.exists(batch_output_dir):
-        shutil.rmtree(batch_output_dir)
     os.makedirs(batch_output_dir, exist_ok=True)
     
-    # dir of PDF splits for batches
-    temp_split_dir = "temp_pdf_splits"
-    if os.path.exists(temp_split_dir):
-        shutil.rmtree(temp_split_dir)
-    os.makedirs(temp_split_dir, exist_ok=True)
-
     print(f"\n Processing '{filename_base}'. ")
     print(f"Intermediate batches will be saved to: {batch_output_dir}/")
     
@@ -67,62 +88,86 @@ def extract_text_with_gemini(pdf_path, start_page_index=0, end_page_index=None):
     full_book_text = []
     previous_anchor_text = None
 
+    # sliding window, step forward by (CHUNK_SIZE - OVERLAP) to create the overlap
+    step_size = CHUNK_SIZE - OVERLAP
+    # to not get stuck in a loop if step_size is <= 0
+    if step_size < 1: step_size = 1
+
+    # (batch number, first page, end page) of every window
+    batch_windows = []
+    for batch_num, current_start in enumerate(range(start_page_index, actual_end_index, step_size), start=1):
+        batch_windows.append((batch_num, current_start, min(current_start + CHUNK_SIZE, actual_end_index)))
+        # the last window already reaches the end, more would only repeat the overlap
+        if current_start + CHUNK_SIZE >= actual_end_index:
+            break
+
+    # Resume: batches a previous run of the same job finished are reused, as long as the PDF and settings still match
+    manifest_path = os.path.join(batch_output_dir, MANIFEST_FILENAME)
+    job = {
+        "source_sha256": file_sha256(pdf_path),
+        "model": backend.model,
+        "start_page_index": start_page_index,
+        "end_page_index": actual_end_index,
+        "chunk_size": CHUNK_SIZE,
+        "overlap": OVERLAP,
+        "parallel": parallel,
+    }
+    manifest = _load_manifest(manifest_path, job, batch_output_dir)
+    manifest_lock = threading.Lock()
+
+    if parallel:
+        try:
+            with metrics.span("gemini.extraction", mode="parallel"):
+                final_text = _extract_windows_in_parallel(backend, doc, batch_windows, batch_output_dir, max_concurrency,
+                                                          filename_base, response_cache, rate_limiter,
+                                                          manifest, manifest_path, manifest_lock)
+        finally:
+            doc.close()
+        _report_failed_batches(manifest, batch_output_dir)
+        print("\n Extraction Complete.")
+        return _final_cleanup(final_text)
+
+    sequential_span = metrics.start_span("gemini.extraction", mode="sequential")
     try:
-        # sliding window loop, step forward by (CHUNK_SIZE - OVERLAP) to create the overlap
-        step_size = CHUNK_SIZE - OVERLAP
-        # to not get stuck in a loop if step_size is <= 0
-        if step_size < 1: step_size = 1
+        for batch_num, current_start, current_end in batch_windows:
+            saved_text = _load_completed_batch(manifest, batch_output_dir, batch_num, current_start, current_end)
+            if saved_text is not None:
+                # Finished by an earlier run, its stored anchor continues the chain exactly as it was
+                print(f"\nBatch {batch_num} (Pages {current_start+1}-{current_end}): reusing saved batch.")
+                metrics.increment("gemini.batches", outcome="resumed")
+                full_book_text.append(saved_text)
+                previous_anchor_text = manifest["batches"][str(batch_num)]["anchor"] or previous_anchor_text
+                continue
 
-        batch_num = 1
-        
-        for current_start in range(start_page_index, actual_end_index, step_size):
-            current_end = min(current_start + CHUNK_SIZE, actual_end_index)
-            
-            # chunk PDF
-            chunk_filename = os.path.join(temp_split_dir, f"batch_{batch_num:03d}.pdf")
-            new_doc = pymupdf.open()
-            
-            # insert_pdf: from_page is inclusive, to_page is inclusive
-            # want indices [current_start ... current_end - 1]
-            new_doc.insert_pdf(doc, from_page=current_start, to_page=current_end - 1)
-            new_doc.save(chunk_filename)
-            new_doc.close()
+            # chunk PDF, kept in memory only
+            with metrics.span("gemini.build_window_pdf"):
+                chunk_pdf_bytes = _window_pdf_bytes(doc, current_start, current_end)
 
             print(f"\nBatch {batch_num} (Pages {current_start+1}-{current_end})...")
             
             # Extract
-            batch_text = _process_single_chunk_anchor(client, chunk_filename, previous_anchor_text)
+            batch_text, from_cache = _process_single_chunk_anchor(backend, chunk_pdf_bytes, previous_anchor_text,
+                                                                  display_name=f"{filename_base}_batch_{batch_num:03d}.pdf",
+                                                                  response_cache=response_cache, rate_limiter=rate_limiter)
             
             if batch_text:
-                batch_save_path = os.path.join(batch_output_dir, f"batch_{batch_num:03d}.txt")
-                with open(batch_save_path, "w", encoding="utf-8") as f:
-                    f.write(batch_text)
-                
                 full_book_text.append(batch_text)
-                print(f"  -> Extracted {len(batch_text)} chars.")
+                print(f"  -> {'Reused' if from_cache else 'Extracted'} {len(batch_text)} chars.")
                 
                 # Update Anchor (last ~300 chars)
-                clean_batch = batch_text.strip()
-                if len(clean_batch) > 300:
-                    previous_anchor_text = clean_batch[-300:]
-                else:
-                    previous_anchor_text = clean_batch 
+                previous_anchor_text = _anchor_from_batch(batch_text)
+                _save_completed_batch(manifest, manifest_path, manifest_lock, batch_output_dir,
+                                      batch_num, current_start, current_end, batch_text, previous_anchor_text)
             else:
                 print(f"!!! Warning: Batch {batch_num} returned no text.")
                 # Keep the old anchor if this batch failed, or set to None?
-
-            batch_num += 1
-            # if batch_num == 4:
-            #     break
-            # being nice to the API
-            time.sleep(2)
+                _record_batch_status(manifest, manifest_path, manifest_lock, batch_num, current_start, current_end, "failed")
 
     finally:
         doc.close()
-        # Clean up the split PDFs, but keep text batches
-        if os.path.exists(temp_split_dir):
-            shutil.rmtree(temp_split_dir)
+        sequential_span.finish()
 
+    _report_failed_batches(manifest, batch_output_dir)
     print("\n Extraction Complete.")
     
     # merge all batches
@@ -130,6 +175,9 @@ def extract_text_with_gemini(pdf_path, start_page_index=0, end_page_index=None):
     # final_text = full_book_text
     final_text = " ".join(full_book_text)
     
+    return _final_cleanup(final_text)
+
+def _final_cleanup(final_text):
     # final cleanup, can do regex
     # this now catches "word- \n part" that might have survived
     final_text = re.sub(r'([a-zA-Z]+)-\s*\n\s*', r'\1', final_text)
@@ -137,72 +185,234 @@ def extract_text_with_gemini(pdf_path, start_page_index=0, end_page_index=None):
     
     return final_text
 
-def _process_single_chunk_anchor(client, chunk_path, anchor_text):
+def _anchor_from_batch(batch_text):
+    # Tail of a batch that the next batch's prompt continues from
+    return batch_text.strip()[-ANCHOR_LENGTH:]
+
+def _load_manifest(manifest_path, job, batch_output_dir):
+    # Manifest of an earlier run of this exact job, or a fresh one. Batches of a different job
+    # (other PDF content, page range, model or mode) can't be reused, the folder is cleared for the new run then
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"!!! Warning: Could not read '{manifest_path}' ({e}), starting over.")
+            manifest = None
+
+        if manifest is not None and manifest.get("job") == job:
+            done = sum(1 for batch in manifest["batches"].values() if batch["status"] == "done")
+            print(f"Resuming earlier run: {done} batch(es) already extracted.")
+            return manifest
+        print("Earlier batches are from a different PDF/page range/settings, starting over.")
+
+    if os.path.exists(batch_output_dir):
+        shutil.rmtree(batch_output_dir)
+    os.makedirs(batch_output_dir, exist_ok=True)
+    manifest = {"job": job, "batches": {}}
+    write_json_atomic(manifest_path, manifest)
+    return manifest
+
+def _batch_path(batch_output_dir, batch_num):
+    return os.path.join(batch_output_dir, f"batch_{batch_num:03d}.txt")
+
+def _load_completed_batch(manifest, batch_output_dir, batch_num, current_start, current_end):
+    # Text of a batch an earlier run finished, None if it has to be (re)extracted
+    entry = manifest["batches"].get(str(batch_num))
+    if not entry or entry["status"] != "done" or (entry["start"], entry["end"]) != (current_start, current_end):
+        return None
     try:
-        sample_file = client.files.upload(file=chunk_path)
-        while sample_file.state.name == "PROCESSING":
-            time.sleep(1)
-            sample_file = client.files.get(name=sample_file.name)
-        if sample_file.state.name == "FAILED":
-            return None
+        with open(_batch_path(batch_output_dir, batch_num), "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _record_batch_status(manifest, manifest_path, manifest_lock, batch_num, current_start, current_end, status, anchor=None):
+    with manifest_lock:
+        manifest["batches"][str(batch_num)] = {"start": current_start, "end": current_end, "status": status, "anchor": anchor}
+        write_json_atomic(manifest_path, manifest)
 
-        # Dynamic prompt with anchor info
+def _save_completed_batch(manifest, manifest_path, manifest_lock, batch_output_dir, batch_num, current_start, current_end,
+                          batch_text, anchor):
+    # Batch file first, then the manifest entry pointing at it, so "done" always means the text is on disk
+    batch_save_path = _batch_path(batch_output_dir, batch_num)
+    partial_path = batch_save_path + ".part"
+    with open(partial_path, "w", encoding="utf-8") as f:
+        f.write(batch_text)
+    os.replace(partial_path, batch_save_path)
+    _record_batch_status(manifest, manifest_path, manifest_lock, batch_num, current_start, current_end, "done", anchor)
+
+def _report_failed_batches(manifest, batch_output_dir):
+    failed = sorted(int(batch_num) for batch_num, batch in manifest["batches"].items() if batch["status"] == "failed")
+    if failed:
+        print(f"!!! Warning: Batch(es) {', '.join(map(str, failed))} returned no text. "
+              f"Run the extraction again to retry only those, progress is kept in '{batch_output_dir}'.")
+
+def _window_pdf_bytes(doc, current_start, current_end):
+    # Copies pages [current_start, current_end) into their own PDF, built and returned in memory.
+    # Nothing touches the disk, so several extractions can run side by side without sharing a temp folder
+    new_doc = pymupdf.open()
+    try:
+        # insert_pdf: from_page is inclusive, to_page is inclusive
+        # want indices [current_start ... current_end - 1]
+        new_doc.insert_pdf(doc, from_page=current_start, to_page=current_end - 1)
+        # garbage=3 drops objects the copied pages don't use (fonts/images of other pages), deflate compresses streams,
+        # both keep the upload small. no_new_id keeps the bytes identical between runs, they are part of the cache key
+        return new_doc.tobytes(garbage=3, deflate=True, no_new_id=True)
+    finally:
+        new_doc.close()
+
+def _extract_windows_in_parallel(backend, doc, batch_windows, batch_output_dir, max_concurrency, filename_base,
+                                 response_cache, rate_limiter, manifest, manifest_path, manifest_lock):
+    # Sends every page window at once (bounded by max_concurrency), no window waits for another's anchor.
+    # The duplicated overlap pages are removed afterwards by stitching neighbouring batches in page order
+    batch_texts = {}
+    for batch_num, current_start, current_end in batch_windows:
+        saved_text = _load_completed_batch(manifest, batch_output_dir, batch_num, current_start, current_end)
+        if saved_text is not None:
+            batch_texts[batch_num] = saved_text
+            metrics.increment("gemini.batches", outcome="resumed")
+    pending_windows = [window for window in batch_windows if window[0] not in batch_texts]
+    if batch_texts:
+        print(f"Reusing {len(batch_texts)} saved batch(es).")
+
+    print(f"Sending {len(pending_windows)} page windows, up to {max_concurrency} at a time...")
+    # The source document is not thread-safe, workers take turns building their window PDF.
+    # Building it inside the worker also means only the windows currently in flight are held in memory
+    doc_lock = threading.Lock()
+
+    def extract_window(batch_num, current_start, current_end):
+        with doc_lock, metrics.span("gemini.build_window_pdf"):
+            chunk_pdf_bytes = _window_pdf_bytes(doc, current_start, current_end)
+        return _process_single_chunk_anchor(backend, chunk_pdf_bytes, None, standalone_window=True,
+                                            display_name=f"{filename_base}_batch_{batch_num:03d}.pdf",
+                                            response_cache=response_cache, rate_limiter=rate_limiter)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        futures = {}
+        for batch_num, current_start, current_end in pending_windows:
+            future = executor.submit(extract_window, batch_num, current_start, current_end)
+            futures[future] = (batch_num, current_start, current_end)
+
+        for future in as_completed(futures):
+            batch_num, current_start, current_end = futures[future]
+            batch_text, from_cache = future.result()
+            if not batch_text:
+                print(f"!!! Warning: Batch {batch_num} (Pages {current_start+1}-{current_end}) returned no text.")
+                _record_batch_status(manifest, manifest_path, manifest_lock, batch_num, current_start, current_end, "failed")
+                continue
+
+            _save_completed_batch(manifest, manifest_path, manifest_lock, batch_output_dir,
+                                  batch_num, current_start, current_end, batch_text, _anchor_from_batch(batch_text))
+            batch_texts[batch_num] = batch_text
+            print(f"  -> Batch {batch_num} (Pages {current_start+1}-{current_end}): {'reused' if from_cache else 'extracted'} {len(batch_text)} chars. ({len(batch_texts)}/{len(batch_windows)} done)")
+
+    print("\nStitching batches...")
+    stitched_text = ""
+    with metrics.span("gemini.stitch"):
+        for batch_num, _, _ in batch_windows:
+            if batch_num in batch_texts:
+                stitched_text = smart_stitch(stitched_text, batch_texts[batch_num].strip(), search_window=PARALLEL_STITCH_WINDOW,
+                                             min_confidence=PARALLEL_STITCH_MIN_CONFIDENCE)
+    return stitched_text
+
+def _build_extraction_prompt(anchor_text, standalone_window=False):
+    # Dynamic prompt with anchor info
+    
+    instructions = ""
+    
+    if standalone_window:
+        instructions = """
+        This PDF is one window of a longer document. Neighbouring windows share a page with this one,
+        the overlap is removed later, so do NOT skip or shorten anything at the start or end.
+        Extract the complete text of every page, from the very first line of the first page to the very last line of the last page.
+        """
+    elif anchor_text:
+        instructions = f"""
+        *** IMPORTANT: CONTINUATION INSTRUCTION ***
+        The previous batch of text ended with the following segment:
         
-        instructions = ""
+        <ANCHOR_START>
+        "{anchor_text}"
+        <ANCHOR_END>
         
-        if anchor_text:
-            instructions = f"""
-            *** IMPORTANT: CONTINUATION INSTRUCTION ***
-            The previous batch of text ended with the following segment:
-            
-            <ANCHOR_START>
-            "{anchor_text}"
-            <ANCHOR_END>
-            
-            Your Task:
-            1. LOCATE this specific text block within the first page of the PDF.
-            2. IGNORE everything before it.
-            3. IGNORE the anchor text itself (do not repeat it).
-            4. START your extraction IMMEDIATELY AFTER this anchor text.
-            5. Ensure the sentence flow is seamless.
-            """
-        else:
-            instructions = "This is the first batch. Start extraction from the very beginning."
-
-        prompt = f"""
-        You are a scientific audiobook editor. Convert this PDF into clean, linear text.
-
-        {instructions}
-
-        STRICT CLEANING RULES:
-        1. Remove all headers, footers, page numbers, and running titles.
-        2. Remove all Citations (e.g., [1], (Smith 2020)).
-        3. Remove Tables and Figures completely.
-        4. Join hyphenated words (e.g. "con-\ntext" -> "context").
-        5. Output PLAIN TEXT only.
+        Your Task:
+        1. LOCATE this specific text block within the first page of the PDF.
+        2. IGNORE everything before it.
+        3. IGNORE the anchor text itself (do not repeat it).
+        4. START your extraction IMMEDIATELY AFTER this anchor text.
+        5. Ensure the sentence flow is seamless.
         """
+    else:
+        instructions = "This is the first batch. Start extraction from the very beginning."
 
-        response_stream = client.models.generate_content_stream(
-            model=ai_model, 
-            contents=[sample_file, prompt],
-            config=types.GenerateContentConfig(temperature=0.1)
-        )
-        
-        chunk_text_parts = []
-        print("  AI Processing: ", end="", flush=True)
-        
-        for chunk in response_stream:
-            print(".", end="", flush=True)
-            if chunk.text:
-                chunk_text_parts.append(chunk.text)
-        
+    prompt = f"""
+    You are a scientific audiobook editor. Convert this PDF into clean, linear text.
+
+    {instructions}
+
+    STRICT CLEANING RULES:
+    1. Remove all headers, footers, page numbers, and running titles.
+    2. Remove all Citations (e.g., [1], (Smith 2020)).
+    3. Remove Tables and Figures completely.
+    4. Join hyphenated words (e.g. "con-\ntext" -> "context").
+    5. Output PLAIN TEXT only.
+    """
+    return prompt
+
+def _process_single_chunk_anchor(backend, chunk_pdf_bytes, anchor_text, standalone_window=False, display_name=None,
+                                 response_cache=None, rate_limiter=None):
+    # Returns (batch text or None, whether it came from the response cache)
+    prompt = _build_extraction_prompt(anchor_text, standalone_window)
+
+    cache_key = None
+    if response_cache is not None:
+        cache_key = response_cache.make_key(chunk_pdf_bytes, backend.model, prompt, EXTRACTION_TEMPERATURE)
+        cached_text = response_cache.get(cache_key)
+        if cached_text:
+            # Identical window and prompt were extracted before, no upload and no generation needed
+            metrics.increment("gemini.batches", outcome="cached")
+            metrics.increment("gemini.chars", len(cached_text), source="cache")
+            return cached_text, True
+
+    if rate_limiter is None:
+        rate_limiter = get_rate_limiter("gemini")
+
+    # progress dots would interleave between windows running side by side
+    show_progress = not standalone_window
+
+    def print_progress():
+        print(".", end="", flush=True)
+
+    for attempt in range(1, GEMINI_MAX_ATTEMPTS + 1):
+        # Waits for the request quota, and for the pause after a throttled request (from any window)
+        with metrics.span("gemini.rate_limit_wait"):
+            rate_limiter.acquire()
         try:
-            client.files.delete(name=sample_file.name)
-        except:
-            pass
-            
-        return "".join(chunk_text_parts)
+            if show_progress:
+                print("  AI Processing: ", end="", flush=True)
+            # Whole request latency (upload + generation), the backend times the two separately
+            with metrics.span("gemini.request", model=backend.model):
+                batch_text = backend.extract(chunk_pdf_bytes, prompt, EXTRACTION_TEMPERATURE, display_name=display_name,
+                                             on_progress=print_progress if show_progress else None)
+            rate_limiter.report_success()
+            metrics.increment("gemini.batches", outcome="extracted" if batch_text else "empty")
+            metrics.increment("gemini.chars", len(batch_text or ""), source="extracted")
 
-    except Exception as e:
-        print(f"\nError in batch: {e}")
-        return None
+            if cache_key is not None and batch_text:
+                response_cache.put(cache_key, batch_text)
+            return batch_text, False
+
+        except TransientBackendError as e:
+            if attempt < GEMINI_MAX_ATTEMPTS:
+                backoff_time = rate_limiter.report_throttled()
+                metrics.increment("gemini.retries", status=e.status_code)
+                print(f"\n ??? Warning: {e.description} from {backend.model}. Retrying in {backoff_time:.1f}s... (Attempt {attempt + 1}/{GEMINI_MAX_ATTEMPTS}) ???")
+                continue
+            print(f"\nError in batch: {e}")
+            metrics.increment("gemini.batches", outcome="failed")
+            return None, False
+        except Exception as e:
+            print(f"\nError in batch: {e}")
+            metrics.increment("gemini.batches", outcome="failed")
+            return None, False
@@ -1,9 +1,12 @@
 import re
 import pymupdf
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-from collections import defaultdict
+from collections import defaultdict, deque
 
-from utility_functions import reduce_text_numerics, is_likely_heading, clean_common_pdf_artifacts, load_custom_fixes_from_file, is_list_item
+from utility_functions import reduce_text_numerics, is_likely_heading, load_custom_fixes_from_file, is_list_item, is_all_caps_text, file_sha256
+from text_cleanup import clean_extracted_sections, HEADING_START, HEADING_END, LIST_ITEM_START, LIST_ITEM_END
+import metrics
 
 DEFAULT_FIXES = {
     "! ®": "",
@@ -22,20 +25,115 @@ DEFAULT_FIXES = {
     ".?": "."
     }
 
-def extract_and_clean_pdf_text(pdf_path, start_page_index=0, end_page_index=None, custom_replacements=None):
-    final_fixes = DEFAULT_FIXES.copy()
-    if custom_replacements:
-        final_fixes.update(custom_replacements)
+BULLET_PREFIX_PATTERN = re.compile(r'^\s*[•●\-\*]\s*')
+
+# Blocks containing these are skipped (journal boilerplate)
+SKIPPABLE_KEYWORDS = ['pp.', 'E-mail:', 'doi:']
+LOWERED_SKIPPABLE_KEYWORDS = [keyword.lower() for keyword in SKIPPABLE_KEYWORDS]
+
+# Pages read ahead of the page being cleaned by iter_clean_pdf_text, a running header/footer is recognised
+# once it has shown up twice within the pages read so far
+STREAM_LOOKAHEAD_PAGES = 8
+
+# Part of the page layout cache key, bump it when _read_page_blocks changes what it returns
+LAYOUT_READER_VERSION = 1
+# Newly read pages are written to the page layout cache in groups of this many
+LAYOUT_CACHE_WRITE_PAGES = 50
+
+def _read_page_blocks(page):
+    # Text of a page's blocks in reading order (top to bottom, then left to right)
+    # Only the text is kept, a tuple of strings per page is all both passes below need
+    blocks = sorted(page.get_text("blocks"), key=lambda b: (b[1], b[0]))
+    return tuple(block[4] for block in blocks)
+
+def _read_page_range_blocks(pdf_path, start_page_index, end_page_index):
+    # Process pool worker, a PyMuPDF document can't be shared between processes so each worker opens its own
+    doc = pymupdf.open(pdf_path)
+    try:
+        return [_read_page_blocks(doc[page_num]) for page_num in range(start_page_index, end_page_index)]
+    finally:
+        doc.close()
+
+def _page_runs(page_indices, batch_size):
+    # Sorted page indices -> (start, end) ranges of consecutive pages, none longer than batch_size
+    page_ranges = []
+    for page_num in page_indices:
+        if page_ranges and page_ranges[-1][1] == page_num and page_num - page_ranges[-1][0] < batch_size:
+            page_ranges[-1][1] = page_num + 1
+        else:
+            page_ranges.append([page_num, page_num + 1])
+    return [(batch_start, batch_end) for batch_start, batch_end in page_ranges]
+
+def _iter_read_pages(doc, pdf_path, page_indices, workers=1):
+    # Reads the given pages (sorted indices) with PyMuPDF, yields (page index, blocks) in page order
+    # With workers > 1 the pages are cut into small batches that are spread over a process pool. Results are collected
+    # in submission order, so the layouts (and therefore everything computed from them) match the serial path exactly
+    page_count = len(page_indices)
+    if workers <= 1 or page_count < 2 * workers:
+        for page_num in tqdm(page_indices, desc="Reading page layout"):
+            yield page_num, _read_page_blocks(doc[page_num])
+        return
+
+    # A few batches per worker keeps the pool busy when some pages are much heavier than others
+    batch_size = max(1, -(-page_count // (workers * 4)))
+    page_ranges = _page_runs(page_indices, batch_size)
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        batch_results = executor.map(_read_page_range_blocks,
+                                     [pdf_path] * len(page_ranges),
+                                     [batch_start for batch_start, _ in page_ranges],
+                                     [batch_end for _, batch_end in page_ranges])
+        with tqdm(total=page_count, desc=f"Reading page layout ({workers} processes)") as progress:
+            for (batch_start, _), batch_layouts in zip(page_ranges, batch_results):
+                progress.update(len(batch_layouts))
+                yield from enumerate(batch_layouts, start=batch_start)
+    finally:
+        # A consumer that stops early shouldn't have to wait for batches nobody will read
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def _iter_page_layouts(doc, pdf_path, start_page_index, end_page_index, workers=1, layout_cache=None, document_key=None):
+    # Block layouts of all pages in the range, yielded in page order as they are read.
+    # With a PageLayoutCache, pages read before (same PDF content, any earlier run) come from it and only the rest
+    # is read with PyMuPDF. Newly read pages are stored every LAYOUT_CACHE_WRITE_PAGES pages, so an interrupted run keeps them
+    cached_pages = layout_cache.get_pages(document_key, start_page_index, end_page_index) if layout_cache else {}
+    missing_pages = [page_num for page_num in range(start_page_index, end_page_index) if page_num not in cached_pages]
+    if layout_cache is not None:
+        metrics.increment("pdf_extract.layout_cache_pages", len(cached_pages), outcome="hit")
+        metrics.increment("pdf_extract.layout_cache_pages", len(missing_pages), outcome="miss")
+        if cached_pages:
+            print(f"Reusing {len(cached_pages)} page layouts from the cache, {len(missing_pages)} pages left to read.")
+
+    read_pages = _iter_read_pages(doc, pdf_path, missing_pages, workers)
+    pages_to_store = []
+    try:
+        for page_num in range(start_page_index, end_page_index):
+            if page_num in cached_pages:
+                yield cached_pages.pop(page_num)
+                continue
+            _, blocks = next(read_pages)
+            if layout_cache is not None:
+                pages_to_store.append((page_num, blocks))
+                if len(pages_to_store) >= LAYOUT_CACHE_WRITE_PAGES:
+                    layout_cache.put_pages(document_key, pages_to_store)
+                    pages_to_store = []
+            yield blocks
+    finally:
+        read_pages.close()
+        if pages_to_store:
+            layout_cache.put_pages(document_key, pages_to_store)
 
+def _open_page_range(pdf_path, start_page_index, end_page_index):
+    # (open document, end index) of the range to extract, (None, None) after reporting why it can't be read
     print(f"\n Starting analysis of '{pdf_path}'.")
     try:
         doc = pymupdf.open(pdf_path)
     except FileNotFoundError:
         print(f"!!! Error: PDF file not found at '{pdf_path}' !!!")
-        return None
+        return None, None
     except Exception as e:
         print(f"!!! An error occurred while opening the PDF: {e} !!!")
-        return None
+        return None, None
     
     total_pages = len(doc)
     if end_page_index is None or end_page_index > total_pages:
@@ -45,152 +143,219 @@ def extract_and_clean_pdf_text(pdf_path, start_page_index=0, end_page_index=None
     
     if start_page_index >= actual_end_index:
         print(f"!!! Error: Start page ({start_page_index+1}) is after End page ({actual_end_index}).")
-        return None
+        doc.close()
+        return None, None
         
     print(f"Processing range: Page {start_page_index + 1} to Page {actual_end_index}")
+    return doc, actual_end_index
 
-    # First loop: collecting potential headers and footers
-    header_counts = defaultdict(int)
-    footer_counts = defaultdict(int)
-    print("Identifying potential headers and footers...")
-    
-    for page_num in tqdm(range(start_page_index, actual_end_index), desc="Analyzing page structure"):
-        page = doc[page_num]
-        blocks = sorted(page.get_text("blocks"), key=lambda b: (b[1], b[0]))
-        if not blocks:
-            continue
-
-        first_block_text = blocks[0][4].strip()
-        if first_block_text:
-            normalized_header = reduce_text_numerics(first_block_text)
-            header_counts[normalized_header] += 1
-            
-        if len(blocks) > 1:
-            last_block_text = blocks[-1][4].strip()
-            if last_block_text:
-                normalized_footer = reduce_text_numerics(last_block_text)
-                footer_counts[normalized_footer] += 1
-
-    confirmed_headers_footers = set()
-    confirmed_headers_footers.add('_NUM_') 
-    for text, count in header_counts.items():
-        if count > 1: confirmed_headers_footers.add(text)
-    for text, count in footer_counts.items():
-        if count > 1: confirmed_headers_footers.add(text)
-    
-    print(f"Identified {len(confirmed_headers_footers)} unique repeating headers/footers.")
+def _count_header_footer_candidates(blocks, header_counts, footer_counts):
+    # First and last block of a page are header/footer candidates, counted with their numbers normalized away
+    if not blocks:
+        return
 
-    # Second loop: collecting clean text
-    full_text_parts = []
-    skippable_keywords = ['pp.', 'E-mail:', 'doi:'] 
-    
-    print("Extracting main content...")
-    for page_num in tqdm(range(start_page_index, actual_end_index), desc="Extracting clean text"):
-        page = doc[page_num]
-        blocks = sorted(page.get_text("blocks"), key=lambda b: (b[1], b[0]))
+    first_block_text = blocks[0].strip()
+    if first_block_text:
+        normalized_header = reduce_text_numerics(first_block_text)
+        header_counts[normalized_header] += 1
         
-        for index, block in enumerate(blocks):
-            block_text = block[4]
-            stripped_block_text = block_text.strip()
+    if len(blocks) > 1:
+        last_block_text = blocks[-1].strip()
+        if last_block_text:
+            normalized_footer = reduce_text_numerics(last_block_text)
+            footer_counts[normalized_footer] += 1
 
-            # 1. Block-level filters
-            if reduce_text_numerics(stripped_block_text) in confirmed_headers_footers:
-                continue
-            
-            # Skip lone page numbers at bottom
-            # is_last_block = (index == len(blocks) - 1)
-            # if is_last_block and stripped_block_text.startswith(tuple(str(n) for n in range(10))):
-            #     continue
-            # Only delete if it starts with a number AND is short (e.g. < 10 chars)
-            # This allows "1. Large issues..." (len 200+) to pass, but deletes "341" (len 3).
-            is_last_block = (index == len(blocks) - 1)
-            if is_last_block and stripped_block_text[0].isdigit():
-                # Check length! Page numbers are rarely longer than 4-5 digits/chars
-                if len(stripped_block_text) < 10:
-                    continue
-            
-            if any(keyword.lower() in stripped_block_text.lower() for keyword in skippable_keywords):
+class _SectionBuilder:
+    # Collects the extractor's text parts (joined by newlines they form the raw text for text_cleanup) and cuts them
+    # into sections that can be cleaned on their own: right in front of a heading tag, once the heading can no longer
+    # be merged with a following one, and only if no "(" before it is still open. See clean_extracted_sections
+
+    def __init__(self):
+        self.parts = []
+        self.sections = []
+        self._paren_open = False
+
+    def append(self, part):
+        if self.parts:
+            # The last part is final now, only the last part is ever changed (heading merges)
+            last_part = self.parts[-1]
+            if len(self.parts) > 1 and last_part.startswith(f" {HEADING_START}") and not self._paren_open:
+                # The heading's leading space ends this section, the next one starts with the tag itself
+                self.sections.append("\n".join(self.parts[:-1]) + "\n ")
+                self.parts = [last_part[1:]]
+            last_open, last_close = last_part.rfind("("), last_part.rfind(")")
+            if last_open != last_close:
+                self._paren_open = last_open > last_close
+        self.parts.append(part)
+
+    def take_sections(self):
+        sections = self.sections
+        self.sections = []
+        return sections
+
+    def finish(self):
+        # Everything not handed out yet, as the last section
+        section = "\n".join(self.parts)
+        self.parts = []
+        return section
+
+def _collect_page_text(blocks, is_header_or_footer, builder):
+    # Filters one page's blocks and adds its lines to the builder, headings and list items wrapped in structure tags
+    for index, block_text in enumerate(blocks):
+        stripped_block_text = block_text.strip()
+
+        # 1. Block-level filters
+        if is_header_or_footer(reduce_text_numerics(stripped_block_text)):
+            continue
+        
+        # Skip lone page numbers at bottom
+        # is_last_block = (index == len(blocks) - 1)
+        # if is_last_block and stripped_block_text.startswith(tuple(str(n) for n in range(10))):
+        #     continue
+        # Only delete if it starts with a number AND is short (e.g. < 10 chars)
+        # This allows "1. Large issues..." (len 200+) to pass, but deletes "341" (len 3).
+        is_last_block = (index == len(blocks) - 1)
+        if is_last_block and stripped_block_text[0].isdigit():
+            # Check length! Page numbers are rarely longer than 4-5 digits/chars
+            if len(stripped_block_text) < 10:
                 continue
+        
+        lowered_block_text = stripped_block_text.lower()
+        if any(keyword in lowered_block_text for keyword in LOWERED_SKIPPABLE_KEYWORDS):
+            continue
 
-            # 2. Line by line processing, split block into lines to detect headings
-            lines = block_text.split('\n')
+        # 2. Line by line processing, split block into lines to detect headings
+        lines = block_text.split('\n')
+        
+        for line in lines:
+            clean_line = line.strip()
+            if not clean_line:
+                continue
             
-            for line in lines:
-                clean_line = line.strip()
-                if not clean_line:
-                    continue
-                
-                is_heading = is_likely_heading(clean_line)
+            is_heading = is_likely_heading(clean_line)
 
-                if is_heading:
-                    merged = False
-                    if full_text_parts:
-                        last_entry = full_text_parts[-1]
-                        
-                        # Checking if last entry is a heading tag, to consider merging
-                        if last_entry.startswith(" <<<HEADING>>>"):
-                            # Extract actual text inside previous tag
-                            # Format is: " <<<HEADING>>>TEXT<<<END_HEADING>>> "
-                            prev_text = last_entry.replace(" <<<HEADING>>>", "").replace("<<<END_HEADING>>> ", "")
-                            
-                            # Are both ALL CAPS? Want to allow for non-letters like numbers/punctuation
-                            prev_is_caps = re.sub(r'[^a-zA-Z]', '', prev_text).isupper()
-                            curr_is_caps = re.sub(r'[^a-zA-Z]', '', clean_line).isupper()
-                            
-                            if prev_is_caps and curr_is_caps:
-                                # Merging, remove old tag, append current line to previous text, re-tag
-                                new_combined_text = f"{prev_text} {clean_line}"
-                                full_text_parts[-1] = f" <<<HEADING>>>{new_combined_text}<<<END_HEADING>>> "
-                                merged = True
+            if is_heading:
+                merged = False
+                # builder.append may start a new section, so the current parts are looked up again
+                full_text_parts = builder.parts
+                if full_text_parts:
+                    last_entry = full_text_parts[-1]
                     
-                    if not merged:
-                        # independent new heading
-                        marked_text = f" <<<HEADING>>>{clean_line}<<<END_HEADING>>> "
-                        full_text_parts.append(marked_text)
-                elif is_list_item(clean_line):
-                    # Remove bullet symbol (•, -, or other) to standardize later
-                    # This regex should remove start symbol and any surrounding whitespace
-                    content = re.sub(r'^\s*[•●\-\*]\s*', '', clean_line)
-                    
-                    # Wraps in tags to protect from being merged into a paragraph
-                    marked_text = f" <<<LIST_ITEM>>>{content}<<<END_LIST_ITEM>>> "
-                    full_text_parts.append(marked_text)
+                    # Checking if last entry is a heading tag, to consider merging
+                    if last_entry.startswith(f" {HEADING_START}"):
+                        # Extract actual text inside previous tag
+                        # Format is: " <<<HEADING>>>TEXT<<<END_HEADING>>> "
+                        prev_text = last_entry.replace(f" {HEADING_START}", "").replace(f"{HEADING_END} ", "")
+                        
+                        # Are both ALL CAPS? Want to allow for non-letters like numbers/punctuation
+                        prev_is_caps = is_all_caps_text(prev_text)
+                        curr_is_caps = is_all_caps_text(clean_line)
+                        
+                        if prev_is_caps and curr_is_caps:
+                            # Merging, remove old tag, append current line to previous text, re-tag
+                            new_combined_text = f"{prev_text} {clean_line}"
+                            full_text_parts[-1] = f" {HEADING_START}{new_combined_text}{HEADING_END} "
+                            merged = True
+                
+                if not merged:
+                    # independent new heading
+                    marked_text = f" {HEADING_START}{clean_line}{HEADING_END} "
+                    builder.append(marked_text)
+            elif is_list_item(clean_line):
+                # Remove bullet symbol (•, -, or other) to standardize later
+                # This regex should remove start symbol and any surrounding whitespace
+                content = BULLET_PREFIX_PATTERN.sub('', clean_line)
                 
-                else:
-                    # its normal text
-                    full_text_parts.append(line)
+                # Wraps in tags to protect from being merged into a paragraph
+                marked_text = f" {LIST_ITEM_START}{content}{LIST_ITEM_END} "
+                builder.append(marked_text)
+            
+            else:
+                # its normal text
+                builder.append(line)
 
-    # General text cleanup
-    full_text = "\n".join(full_text_parts)
-    
-    # 1. Hyphenation fix
-    # Uses full_text as source, so must be done BEFORE collapsing newlines
-    text = re.sub(r'([a-zA-Z]+)-\s*\n\s*', r'\1', full_text)
+def iter_clean_pdf_text(pdf_path, start_page_index=0, end_page_index=None, custom_replacements=None, workers=1,
+                        lookahead_pages=STREAM_LOOKAHEAD_PAGES, layout_cache=None):
+    # Generator version of extract_and_clean_pdf_text: yields the cleaned text in sections (a heading and what follows it)
+    # while later pages are still being read, "".join() of the sections is the whole cleaned text.
+    # Running headers/footers are voted on over the pages read so far, each page is cleaned once lookahead_pages more
+    # pages have been read. A header/footer that repeats only further apart than that stays in the text.
+    # lookahead_pages=None reads all pages first, the result is then exactly that of extract_and_clean_pdf_text.
+    # layout_cache: optional PageLayoutCache, pages read by an earlier run of the same PDF are not read again
+    # Yields nothing if the PDF or page range can't be read
+    final_fixes = DEFAULT_FIXES.copy()
+    if custom_replacements:
+        final_fixes.update(custom_replacements)
 
-    # 2. Apply common PDF artifact fixes, including custom ones
-    text = clean_common_pdf_artifacts(text, custom_fixes=final_fixes)
-    
-    # 3. Collapsing normal newlines to spaces
-    text = text.replace('\n', ' ')
-    
-    # 4. Collapsing multiple spaces
-    text = re.sub(r'\s+', ' ', text).strip()
+    doc, actual_end_index = _open_page_range(pdf_path, start_page_index, end_page_index)
+    if doc is None:
+        return
+    document_key = None
+    if layout_cache is not None:
+        document_key = layout_cache.make_key(file_sha256(pdf_path), f"{LAYOUT_READER_VERSION}/{pymupdf.VersionBind}")
+    raw_sections = _iter_raw_sections(doc, pdf_path, start_page_index, actual_end_index, workers, lookahead_pages,
+                                      layout_cache, document_key)
+    yield from clean_extracted_sections(raw_sections, final_fixes)
+    print("\nText extraction and cleaning complete.")
 
-    # 5. Expanding Heading tags into structure
-    # This must be done AFTER space collapse, so these newlines survive
-    text = text.replace("<<<HEADING>>>", "\n\n")
-    text = text.replace("<<<END_HEADING>>>", "\n\n")
+def _iter_raw_sections(doc, pdf_path, start_page_index, end_page_index, workers, lookahead_pages, layout_cache=None,
+                       document_key=None):
+    # Raw (uncleaned) text sections of the page range, see _SectionBuilder. Closes doc when done
+    header_counts = defaultdict(int)
+    footer_counts = defaultdict(int)
 
-    # lists -> newline + dash
-    # ensure items are separated and paused correctly in TTS
-    text = text.replace(" <<<LIST_ITEM>>>", "\n- ")
-    text = text.replace("<<<END_LIST_ITEM>>> ", "")
+    def is_header_or_footer(normalized_text):
+        # Seen as first or last block of more than one page so far, bare numbers are always page numbers
+        return normalized_text == '_NUM_' or header_counts.get(normalized_text, 0) > 1 or footer_counts.get(normalized_text, 0) > 1
 
-    # 6. Citation removal
-    text = re.sub(r'\([^)]*((?:19|20)\d{2}|et al\.|p\.|pp\.)[^)]*\)', '', text)
-    
-    # 7. Final cleanup of any weird spaces created by tags
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    
-    print("\nText extraction and cleaning complete.")
-    return text
\ No newline at end of file
+    builder = _SectionBuilder()
+    # Pages read but not collected yet
+    pending_layouts = deque()
+    page_count = 0
+    # Block extraction is the expensive PyMuPDF step, so it's done once per page and both the vote and the collection use it.
+    # Timed per page without the time the consumer spends on the sections yielded in between
+    page_layouts = _iter_page_layouts(doc, pdf_path, start_page_index, end_page_index, workers, layout_cache, document_key)
+    try:
+        while True:
+            with metrics.span("pdf_extract.read_page", workers=workers):
+                blocks = next(page_layouts, None)
+            if blocks is None:
+                break
+            page_count += 1
+            _count_header_footer_candidates(blocks, header_counts, footer_counts)
+            pending_layouts.append(blocks)
+            if lookahead_pages is not None and len(pending_layouts) > lookahead_pages:
+                with metrics.span("pdf_extract.collect_page"):
+                    _collect_page_text(pending_layouts.popleft(), is_header_or_footer, builder)
+                yield from builder.take_sections()
+    finally:
+        page_layouts.close()
+        doc.close()
+    metrics.increment("pdf_extract.pages", page_count)
+
+    confirmed_headers_footers = {'_NUM_'}
+    confirmed_headers_footers.update(text for text, count in header_counts.items() if count > 1)
+    confirmed_headers_footers.update(text for text, count in footer_counts.items() if count > 1)
+    print(f"Identified {len(confirmed_headers_footers)} unique repeating headers/footers.")
+
+    print("Extracting main content...")
+    while pending_layouts:
+        with metrics.span("pdf_extract.collect_page"):
+            _collect_page_text(pending_layouts.popleft(), is_header_or_footer, builder)
+        yield from builder.take_sections()
+    yield builder.finish()
+
+def extract_and_clean_pdf_text(pdf_path, start_page_index=0, end_page_index=None, custom_replacements=None, workers=1,
+                               layout_cache=None):
+    # Whole cleaned text of the page range, None if the PDF or range can't be read.
+    # All pages are read before any is cleaned, so headers/footers are voted on over the whole range
+    # layout_cache: optional PageLayoutCache, see iter_clean_pdf_text
+    sections = []
+    for section in iter_clean_pdf_text(pdf_path, start_page_index, end_page_index, custom_replacements, workers,
+                                       lookahead_pages=None, layout_cache=layout_cache):
+        sections.append(section)
+    if not sections:
+        return None
+    text = "".join(sections)
+    metrics.increment("pdf_extract.chars", len(text))
+    return text
@@ -0,0 +1,118 @@
+import time
+import random
+import threading
+
+# Client-side throttling shared by the TTS and Gemini calls.
+# Each API gets one RateLimiter (see get_rate_limiter), every request waits in acquire() until both its quotas have room:
+# requests per minute and, optionally, characters per minute. Both are token buckets that refill continuously, so
+# requests go out as soon as the quota allows instead of after fixed sleeps.
+# When the API still pushes back (429/503) the limiter lowers its own rate and pauses every caller for a jittered,
+# growing backoff (multiplicative decrease). Each success raises the rate again in small steps (additive increase),
+# so throughput settles just under whatever the API actually accepts.
+
+class RateLimiter:
+
+    def __init__(self, requests_per_minute=None, chars_per_minute=None, jitter=0.1,
+                 min_rate_fraction=0.1, recovery_step=0.05, max_backoff=60.0):
+        # None for a quota means no limit on it. jitter is the random extra fraction added to every wait,
+        # it keeps parallel workers from waking up (and hitting the API) in lockstep
+        self.jitter = jitter
+        self.min_rate_fraction = min_rate_fraction
+        self.recovery_step = recovery_step
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        # Fraction of the configured rates currently used, lowered on throttling and raised back on success
+        self._rate_fraction = 1.0
+        self._blocked_until = 0.0
+        self._consecutive_throttles = 0
+        self.set_limits(requests_per_minute, chars_per_minute)
+
+    def set_limits(self, requests_per_minute=None, chars_per_minute=None):
+        with self._lock:
+            self.requests_per_minute = requests_per_minute
+            self.chars_per_minute = chars_per_minute
+            # Buckets start full, a minute's worth of quota may go out at once like the API allows
+            self._request_tokens = float(requests_per_minute or 0)
+            self._char_tokens = float(chars_per_minute or 0)
+            self._last_refill = time.monotonic()
+
+    def _refill(self, now):
+        elapsed_minutes = (now - self._last_refill) / 60
+        self._last_refill = now
+        if self.requests_per_minute:
+            self._request_tokens = min(self.requests_per_minute,
+                                       self._request_tokens + elapsed_minutes * self.requests_per_minute * self._rate_fraction)
+        if self.chars_per_minute:
+            self._char_tokens = min(self.chars_per_minute,
+                                    self._char_tokens + elapsed_minutes * self.chars_per_minute * self._rate_fraction)
+
+    def _seconds_until_available(self, now, chars):
+        # 0 if the request can go out now, otherwise how long until the blocking quota has refilled enough
+        wait = max(0.0, self._blocked_until - now)
+        if self.requests_per_minute and self._request_tokens < 1:
+            rate_per_second = self.requests_per_minute * self._rate_fraction / 60
+            wait = max(wait, (1 - self._request_tokens) / rate_per_second)
+        if self.chars_per_minute and chars:
+            # A single request larger than the whole per-minute quota only has to wait for a full bucket
+            needed = min(chars, self.chars_per_minute)
+            if self._char_tokens < needed:
+                rate_per_second = self.chars_per_minute * self._rate_fraction / 60
+                wait = max(wait, (needed - self._char_tokens) / rate_per_second)
+        return wait
+
+    def acquire(self, chars=0):
+        # Blocks until one request of `chars` characters fits both quotas, then takes it out of them
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._seconds_until_available(now, chars)
+                if wait <= 0:
+                    if self.requests_per_minute:
+                        self._request_tokens -= 1
+                    if self.chars_per_minute and chars:
+                        self._char_tokens -= min(chars, self.chars_per_minute)
+                    return
+            time.sleep(wait * (1 + random.uniform(0, self.jitter)))
+
+    def report_success(self):
+        # Additive increase: the rate climbs back towards the configured quota one step per successful request
+        with self._lock:
+            self._consecutive_throttles = 0
+            self._rate_fraction = min(1.0, self._rate_fraction + self.recovery_step)
+
+    def report_throttled(self, initial_backoff=2.0):
+        # Multiplicative decrease on a 429/503 (or timeout): halves the rate and pauses all callers.
+        # The pause doubles with every throttle in a row, starting at initial_backoff. Returns the pause in seconds
+        with self._lock:
+            self._rate_fraction = max(self.min_rate_fraction, self._rate_fraction / 2)
+            backoff = min(self.max_backoff, initial_backoff * 2 ** self._consecutive_throttles)
+            backoff *= 1 + random.uniform(0, self.jitter)
+            self._consecutive_throttles += 1
+            self._blocked_until = max(self._blocked_until, time.monotonic() + backoff)
+            # Requests already counted against the buckets are what got throttled, don't let them burst again
+            self._request_tokens = min(self._request_tokens, 0.0)
+            self._char_tokens = min(self._char_tokens, 0.0)
+            return backoff
+
+def poll_delays(initial=0.25, maximum=5.0, factor=1.5, jitter=0.1):
+    # Waits between status checks of a long-running operation: quick checks first, then slower ones,
+    # so short operations aren't held up by a fixed interval and long ones aren't polled needlessly
+    delay = initial
+    while True:
+        yield delay * (1 + random.uniform(0, jitter))
+        delay = min(maximum, delay * factor)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+def get_rate_limiter(name, requests_per_minute=None, chars_per_minute=None):
+    # One shared limiter per API name ("tts", "gemini"), so every caller in the process draws from the same quota.
+    # Passing limits (re)configures the shared limiter, without them the existing one is returned as is
+    with _registry_lock:
+        limiter = _registry.get(name)
+        if limiter is None:
+            limiter = _registry[name] = RateLimiter(requests_per_minute, chars_per_minute)
+        elif requests_per_minute is not None or chars_per_minute is not None:
+            limiter.set_limits(requests_per_minute, chars_per_minute)
+        return limiter
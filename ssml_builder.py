@@ -0,0 +1,112 @@
+import re
+from collections import namedtuple
+from xml.sax.saxutils import escape
+
+from utility_functions import split_text_for_tts, is_likely_heading
+
+# SSML for the cleaned text, for synthesis with timing marks (text_to_speech_converter with ssml=True).
+# The cleanup leaves structure as plain text: headings and paragraphs are separated by "\n\n", list items start with "\n- ".
+# Every heading/paragraph becomes a section with a <mark> at its start, so the TTS API reports where in the audio it begins,
+# and gets a <break> in front of it, longer around headings. List items get a short break instead of the spoken "-".
+# Sections are named by their index in the whole document ("s0", "s1", ...), but the <mark> names in the SSML count within
+# the chunk ("m0", "m1", ...). An edit early in the document then only changes the SSML (and audio cache key) of the chunks
+# it touches, not of every chunk after it. SsmlChunk.marks maps the chunk's marks back to the sections.
+
+# A section: name, "heading" or "paragraph", character offset in the text, and the section text itself
+Section = namedtuple("Section", ["mark", "kind", "offset", "text"])
+# One synthesis request: the plain text (for cost and progress), its SSML, and the sections its marks stand for,
+# in order: the SSML's mark "m<i>" is the start of section marks[i]
+SsmlChunk = namedtuple("SsmlChunk", ["text", "ssml", "marks"])
+
+SECTION_BREAK_PATTERN = re.compile(r'\n\s*\n\s*')
+LIST_ITEM_BREAK_PATTERN = re.compile(r'\s*\n- ')
+
+PARAGRAPH_BREAK_TIME = "600ms"
+HEADING_BREAK_TIME = "1200ms"
+LIST_ITEM_BREAK_TIME = "300ms"
+
+# Headings are short lines the cleanup put on their own. Checked on top of is_likely_heading, which misses plain titles
+HEADING_MAX_CHARS = 120
+SENTENCE_END_CHARACTERS = ('.', '!', '?', ':', ';', ',', '"', "'", ')')
+
+def _section_kind(section_text):
+    if is_likely_heading(section_text):
+        return "heading"
+    if len(section_text) <= HEADING_MAX_CHARS and "\n" not in section_text and not section_text.endswith(SENTENCE_END_CHARACTERS):
+        return "heading"
+    return "paragraph"
+
+def find_sections(text):
+    # Headings and paragraphs of the text, in order
+    sections = []
+    section_start = len(text) - len(text.lstrip())
+    for boundary in SECTION_BREAK_PATTERN.finditer(text):
+        if boundary.start() > section_start:
+            section_text = text[section_start:boundary.start()].strip()
+            sections.append(Section(f"s{len(sections)}", _section_kind(section_text), section_start, section_text))
+        section_start = boundary.end()
+    section_text = text[section_start:].strip()
+    if section_text:
+        sections.append(Section(f"s{len(sections)}", _section_kind(section_text), section_start, section_text))
+    return sections
+
+def chunk_mark_name(mark_index):
+    # Name of the chunk's mark_index-th <mark>
+    return f"m{mark_index}"
+
+def _ssml_text(text):
+    # Escaped text of one section part, list item markers replaced by a pause
+    return LIST_ITEM_BREAK_PATTERN.sub(f'<break time="{LIST_ITEM_BREAK_TIME}"/>', escape(text.strip()))
+
+def _build_chunk_ssml(text, chunk_start, chunk_end, chunk_sections, previous_kind):
+    # SSML for text[chunk_start:chunk_end], chunk_sections are the sections starting inside it.
+    # previous_kind: kind of the section before the chunk's first section, None at the start of the document
+    parts = ["<speak>"]
+    position = chunk_start
+    for mark_index, section in enumerate(chunk_sections):
+        if section.offset > position:
+            parts.append(_ssml_text(text[position:section.offset]))
+        if previous_kind is not None:
+            is_heading_break = "heading" in (previous_kind, section.kind)
+            parts.append(f'<break time="{HEADING_BREAK_TIME if is_heading_break else PARAGRAPH_BREAK_TIME}"/>')
+        parts.append(f'<mark name="{chunk_mark_name(mark_index)}"/>')
+        previous_kind = section.kind
+        position = section.offset
+    if chunk_end > position:
+        parts.append(_ssml_text(text[position:chunk_end]))
+    parts.append("</speak>")
+    return " ".join(part for part in parts if part)
+
+def build_ssml_chunks(text, max_bytes=4800):
+    # Splits the text like split_text_for_tts and turns each chunk into SSML of at most max_bytes (UTF-8), the API limit
+    # applies to the SSML with all its tags. Returns (sections, chunks)
+    sections = find_sections(text)
+    chunks = []
+    # The tags and escaping take room, chunks that still come out too large are split again with a smaller text budget
+    pending_texts = [(chunk, int(max_bytes * 0.8)) for chunk in split_text_for_tts(text, int(max_bytes * 0.8))]
+    pending_texts.reverse()
+    search_start = 0
+    section_index = 0
+    while pending_texts:
+        chunk_text, text_budget = pending_texts.pop()
+        # Chunks are stripped, contiguous pieces of the text, in order
+        chunk_start = text.index(chunk_text, search_start)
+        chunk_end = chunk_start + len(chunk_text)
+
+        first_section_index = section_index
+        while section_index < len(sections) and sections[section_index].offset < chunk_end:
+            section_index += 1
+        chunk_sections = sections[first_section_index:section_index]
+        previous_kind = sections[first_section_index - 1].kind if first_section_index else None
+        ssml = _build_chunk_ssml(text, chunk_start, chunk_end, chunk_sections, previous_kind)
+
+        if len(ssml.encode("utf-8")) > max_bytes and text_budget > 1:
+            section_index = first_section_index
+            smaller_budget = max(1, int(text_budget * 0.8))
+            pieces = split_text_for_tts(chunk_text, smaller_budget)
+            pending_texts.extend((piece, smaller_budget) for piece in reversed(pieces))
+            continue
+
+        chunks.append(SsmlChunk(chunk_text, ssml, [section.mark for section in chunk_sections]))
+        search_start = chunk_end
+    return sections, chunks
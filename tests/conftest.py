@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+# The app modules live in the repo root (no package), the synthetic test documents in benchmarks/
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+
+from rate_limiter import RateLimiter
+
+# Prose with sentence ends, paragraph breaks and a heading, enough for a few dozen TTS chunks at small chunk sizes
+SAMPLE_SENTENCES = [
+    "The model results show that the data analysis method had a significant effect.",
+    "Samples were measured between groups over several weeks.",
+    "However, previous studies reported similar findings in controlled experiments!",
+    "Is the effect stable across all of the measured conditions?",
+]
+
+def make_sample_text(paragraphs=12):
+    parts = ["Results and Discussion"]
+    for paragraph_index in range(paragraphs):
+        sentences = [SAMPLE_SENTENCES[(paragraph_index + offset) % len(SAMPLE_SENTENCES)] for offset in range(4)]
+        parts.append(f"Paragraph {paragraph_index + 1}. " + " ".join(sentences))
+    return "\n\n".join(parts)
+
+def make_varied_text(paragraphs=40):
+    # No sentence repeats, unlike make_sample_text: for tests of where the chunking cuts, which depends on nearby content
+    parts = ["Results and Discussion"]
+    for paragraph_index in range(paragraphs):
+        parts.append(" ".join(f"Measurement {paragraph_index}.{run} came out at {(paragraph_index * 37 + run * 11) % 97} units in run {run}."
+                              for run in range(5)))
+    return "\n\n".join(parts)
+
+@pytest.fixture
+def sample_text():
+    return make_sample_text()
+
+@pytest.fixture
+def rate_limiter():
+    # A limiter of the test's own, without quotas, so tests don't share (or wait on) the process-wide "tts" limiter
+    return RateLimiter()
+
+@pytest.fixture(scope="session")
+def synthetic_pdf(tmp_path_factory):
+    # Paper-like PDF from the benchmark material, 45 pages (three Gemini windows at 20 pages, several layout batches)
+    from synthetic_documents import make_synthetic_pdf
+
+    pdf_path = str(tmp_path_factory.mktemp("pdf") / "paper.pdf")
+    make_synthetic_pdf(pdf_path, 45)
+    return pdf_path
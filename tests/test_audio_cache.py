@@ -0,0 +1,65 @@
+import os
+import errno
+
+import audio_cache
+from audio_cache import AudioCache
+
+def make_entry(cache, tmp_path, name, size):
+    # Stores `size` bytes under the key of `name`, returns the key
+    source_path = tmp_path / f"{name}.mp3"
+    source_path.write_bytes(name.encode("utf-8") * (size // len(name)))
+    key = AudioCache.make_key(name, "fake-voice", "en-US", "MP3")
+    cache.store(key, str(source_path))
+    return key
+
+def test_store_fetch_and_contains(tmp_path):
+    cache = AudioCache(str(tmp_path / "cache"))
+    key = make_entry(cache, tmp_path, "chunk", 500)
+    destination_path = str(tmp_path / "chunk_0000.mp3")
+
+    assert cache.contains(key)
+    assert cache.fetch(key, destination_path)
+    assert (tmp_path / "chunk_0000.mp3").read_bytes() == (tmp_path / "chunk.mp3").read_bytes()
+    # Another voice is another entry
+    assert not cache.contains(AudioCache.make_key("chunk", "other-voice", "en-US", "MP3"))
+
+    missing_path = str(tmp_path / "chunk_0001.mp3")
+    assert not cache.fetch(AudioCache.make_key("missing", "fake-voice", "en-US", "MP3"), missing_path)
+    assert not os.path.exists(missing_path)
+    assert not os.path.exists(missing_path + ".part")
+
+def test_eviction_drops_least_recently_used_down_to_90_percent(tmp_path):
+    cache = AudioCache(str(tmp_path / "cache"), max_bytes=1000)
+    keys = [make_entry(cache, tmp_path, name, 300) for name in ("first", "second", "third")]
+    # Stored in that order, then "first" is used again
+    for age, key in zip((300, 200, 100), keys):
+        os.utime(cache._entry_path(key), (0, os.path.getmtime(cache._entry_path(key)) - age))
+    assert cache.fetch(keys[0], str(tmp_path / "chunk_0000.mp3"))
+
+    fourth_key = make_entry(cache, tmp_path, "fourth", 300)
+
+    # 1200 bytes over a cap of 1000: the oldest entry goes, 900 bytes are left
+    assert [cache.contains(key) for key in keys + [fourth_key]] == [True, False, True, True]
+    assert sum(size for _, _, size in cache._scan_entries()) == 900
+    # A new instance counts the same size from disk
+    assert AudioCache(str(tmp_path / "cache"), max_bytes=1000)._total_bytes == 900
+
+def test_failed_fetch_leaves_no_files_behind(tmp_path, monkeypatch, capsys):
+    cache = AudioCache(str(tmp_path / "cache"))
+    key = make_entry(cache, tmp_path, "chunk", 500)
+    destination_path = str(tmp_path / "chunk_0000.mp3")
+    # A chunk file of an earlier, interrupted attempt
+    (tmp_path / "chunk_0000.mp3").write_bytes(b"stale")
+
+    def copy_until_disk_full(source_path, target_path):
+        with open(target_path, "wb") as f:
+            f.write(b"half of the audio")
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(audio_cache.shutil, "copyfile", copy_until_disk_full)
+
+    assert not cache.fetch(key, destination_path)
+    assert sorted(os.listdir(tmp_path)) == ["cache", "chunk.mp3"]
+    assert "Could not read chunk from audio cache" in capsys.readouterr().out
+    # The entry itself is kept
+    assert cache.contains(key)
@@ -0,0 +1,135 @@
+import struct
+
+import pytest
+
+from audio_stitcher import (parse_frame_header, scan_mp3_file, get_mp3_duration, stitch_mp3_files, iter_ogg_pages, ogg_crc32,
+                            get_ogg_opus_duration, stitch_ogg_opus_files, OGG_BOS_FLAG)
+from fake_backends import fake_mp3_audio, fake_ogg_opus_audio, FAKE_MP3_FRAME_SIZE, FAKE_MP3_FRAME_SECONDS
+
+CHUNK_TEXTS = [
+    "The first chunk of the book, a few sentences long. " * 3,
+    "A second, shorter chunk.",
+    "The third chunk closes the chapter and is the longest of them all by a wide margin. " * 6,
+]
+
+def id3v2_tag(payload_size=300):
+    # ID3v2.3 header with a syncsafe size, followed by padding
+    size = bytes((payload_size >> shift) & 0x7F for shift in (21, 14, 7, 0))
+    return b"ID3\x03\x00\x00" + size + bytes(payload_size)
+
+def id3v1_tag():
+    return b"TAG" + bytes(125)
+
+def read_info_tag(path):
+    # (tag name, flags, frame count, byte count) of the Xing/Info frame the output starts with
+    with open(path, "rb") as f:
+        data = f.read(200)
+    header = parse_frame_header(data[:4])
+    # MPEG-2 mono side info
+    offset = 4 + 9
+    assert header is not None
+    return (data[offset:offset + 4],) + struct.unpack_from(">III", data, offset + 4)
+
+@pytest.fixture
+def mp3_chunks(tmp_path):
+    # Chunk files shaped like the API's: one with ID3v2 and ID3v1 tags, one starting with its own Info frame
+    paths = []
+    for index, text in enumerate(CHUNK_TEXTS):
+        path = tmp_path / f"chunk_{index:04d}.mp3"
+        path.write_bytes(fake_mp3_audio(text))
+        paths.append(str(path))
+    with open(paths[0], "rb") as f:
+        audio = f.read()
+    with open(paths[0], "wb") as f:
+        f.write(id3v2_tag() + audio + id3v1_tag())
+    tagged_path = str(tmp_path / "tagged.mp3")
+    stitch_mp3_files([paths[1]], tagged_path)
+    paths[1] = tagged_path
+    return paths
+
+def test_mp3_stitch_writes_one_info_header_for_the_whole_file(tmp_path, mp3_chunks):
+    expected_frames = sum(len(fake_mp3_audio(text)) // FAKE_MP3_FRAME_SIZE for text in CHUNK_TEXTS)
+    output_path = str(tmp_path / "book.mp3")
+
+    duration = stitch_mp3_files(mp3_chunks, output_path)
+
+    assert duration == pytest.approx(expected_frames * FAKE_MP3_FRAME_SECONDS)
+    tag_name, flags, frame_count, byte_count = read_info_tag(output_path)
+    # Constant bitrate chunks: "Info", with frame count, byte count and seek table
+    assert tag_name == b"Info"
+    assert flags == 0x7
+    assert frame_count == expected_frames
+    with open(output_path, "rb") as f:
+        output = f.read()
+    assert byte_count == len(output)
+    # Only the new tag frame and the audio frames, the chunks' own tags are gone
+    assert len(output) - expected_frames * FAKE_MP3_FRAME_SIZE == parse_frame_header(output[:4]).length
+    assert b"ID3" not in output and b"TAG" not in output
+    assert output.count(b"Info") == 1
+
+    assert scan_mp3_file(output_path).frame_count == expected_frames
+    assert get_mp3_duration(output_path) == pytest.approx(duration)
+
+def test_mp3_stitch_of_one_chunk_keeps_its_duration(tmp_path):
+    chunk_path = tmp_path / "chunk.mp3"
+    chunk_path.write_bytes(fake_mp3_audio(CHUNK_TEXTS[0]))
+
+    duration = stitch_mp3_files([str(chunk_path)], str(tmp_path / "book.mp3"))
+
+    assert duration == pytest.approx(get_mp3_duration(str(chunk_path)))
+    assert read_info_tag(str(tmp_path / "book.mp3"))[2] == scan_mp3_file(str(chunk_path)).frame_count
+
+def ogg_links(path):
+    # (serial, page sequence numbers) of every chained stream, checking each page's checksum on the way
+    links = []
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "rb") as f:
+        position = 0
+        for page in iter_ogg_pages(f):
+            page_size = 27 + len(page.segment_table) + len(page.body)
+            raw = bytearray(data[position:position + page_size])
+            stored_crc = struct.unpack_from("<I", raw, 22)[0]
+            raw[22:26] = bytes(4)
+            assert ogg_crc32(raw) == stored_crc
+            if page.header_type & OGG_BOS_FLAG:
+                links.append((page.serial, []))
+            assert page.serial == links[-1][0]
+            links[-1][1].append(page.sequence)
+            position += page_size
+    assert position == len(data)
+    return links
+
+def test_ogg_opus_stitch_chains_streams_with_unique_serials(tmp_path):
+    # The same text twice gives two streams with the same serial, the second has to be renumbered
+    texts = [CHUNK_TEXTS[0], CHUNK_TEXTS[1], CHUNK_TEXTS[0], CHUNK_TEXTS[2]]
+    chunk_paths = []
+    for index, text in enumerate(texts):
+        path = tmp_path / f"chunk_{index:04d}.ogg"
+        path.write_bytes(fake_ogg_opus_audio(text))
+        chunk_paths.append(str(path))
+    chunk_durations = [get_ogg_opus_duration(path) for path in chunk_paths]
+    output_path = str(tmp_path / "book.ogg")
+
+    duration = stitch_ogg_opus_files(chunk_paths, output_path)
+
+    assert duration == pytest.approx(sum(chunk_durations))
+    assert get_ogg_opus_duration(output_path) == pytest.approx(duration)
+    links = ogg_links(output_path)
+    assert len(links) == len(texts)
+    assert len({serial for serial, _ in links}) == len(texts)
+    # Page order inside each link is untouched
+    assert all(sequences == list(range(len(sequences))) for _, sequences in links)
+
+def test_ogg_opus_duration_of_a_chained_file_covers_every_link(tmp_path):
+    first_path, second_path = str(tmp_path / "first.ogg"), str(tmp_path / "second.ogg")
+    (tmp_path / "first.ogg").write_bytes(fake_ogg_opus_audio(CHUNK_TEXTS[0]))
+    (tmp_path / "second.ogg").write_bytes(fake_ogg_opus_audio(CHUNK_TEXTS[2]))
+    chained_path = str(tmp_path / "chained.ogg")
+    stitch_ogg_opus_files([first_path, second_path], chained_path)
+    expected = get_ogg_opus_duration(first_path) + get_ogg_opus_duration(second_path)
+
+    assert get_ogg_opus_duration(chained_path) == pytest.approx(expected)
+    # A chained file as input of another stitch (e.g. a partial save) counts in full
+    assert stitch_ogg_opus_files([chained_path, first_path], str(tmp_path / "book.ogg")) == pytest.approx(
+        expected + get_ogg_opus_duration(first_path))
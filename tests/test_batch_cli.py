@@ -0,0 +1,80 @@
+import os
+import json
+
+import pytest
+
+import batch_cli
+
+@pytest.fixture
+def work_dir(tmp_path, monkeypatch):
+    # Batch runs write relative to the working directory, two small PDFs to work on
+    from synthetic_documents import make_synthetic_pdf
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("papers")
+    make_synthetic_pdf(os.path.join("papers", "first.pdf"), 2, seed=1)
+    make_synthetic_pdf(os.path.join("papers", "second.pdf"), 2, seed=2)
+    return tmp_path
+
+def run(capsys, *argv):
+    # (exit code, JSON summary from stdout)
+    exit_code = batch_cli.main(["papers", "--fake-backends", "--extract-workers", "1", "--no-long-audio", *argv])
+    return exit_code, json.loads(capsys.readouterr().out)
+
+def test_fake_runs_stay_apart_from_real_outputs_and_caches(work_dir, capsys):
+    exit_code, summary = run(capsys)
+
+    assert exit_code == 0
+    assert summary["totals"]["ok"] == 2
+    for folder in ("audio_cache", "generated_audio", "extracted_texts", "EPUB_Output"):
+        assert not os.path.exists(folder)
+        assert os.path.isdir(os.path.join(batch_cli.FAKE_BACKENDS_FOLDER, folder))
+    audio_paths = [audio["path"] for document in summary["documents"] for audio in document["audio"]]
+    assert audio_paths and all(path.startswith(batch_cli.FAKE_BACKENDS_FOLDER + os.sep) for path in audio_paths)
+    assert all(os.path.exists(path) for path in audio_paths)
+
+def test_synthesis_error_fails_only_its_document(work_dir, capsys, monkeypatch):
+    # Chunking the first document's text blows up, before its synthesis even starts
+    calls = []
+    split_text_for_tts = batch_cli.split_text_for_tts
+
+    def split_first_text_fails(text, max_bytes):
+        calls.append(text)
+        if len(calls) == 1:
+            raise ValueError("fake chunking bug")
+        return split_text_for_tts(text, max_bytes)
+
+    monkeypatch.setattr(batch_cli, "split_text_for_tts", split_first_text_fails)
+    exit_code, summary = run(capsys)
+
+    assert exit_code == 1
+    first, second = summary["documents"]
+    assert first["status"] == "failed"
+    assert first["error"] == "synthesis failed: fake chunking bug"
+    assert first["audio"] == []
+    # The batch went on with the next document
+    assert second["status"] == "ok"
+    assert all(audio["duration_seconds"] for audio in second["audio"])
+    assert summary["totals"]["ok"] == 1
+    assert summary["totals"]["failed"] == 1
+    assert summary["totals"]["characters"] == first["characters"] + second["characters"]
+
+def test_rerun_skips_finished_documents_and_overwrite_reuses_the_cache(work_dir, capsys):
+    exit_code, summary = run(capsys)
+    assert exit_code == 0
+    assert summary["totals"]["estimated_cost"] == pytest.approx(sum(document["estimated_cost"] for document in summary["documents"]))
+    assert summary["totals"]["estimated_cost"] > 0
+
+    exit_code, summary = run(capsys)
+    assert exit_code == 0
+    assert [document["status"] for document in summary["documents"]] == ["skipped", "skipped"]
+    assert summary["totals"]["skipped"] == 2 and summary["totals"]["ok"] == 0
+    assert summary["totals"]["characters"] == 0
+    assert summary["totals"]["estimated_cost"] == 0
+
+    # Same texts again: every chunk comes from the audio cache, nothing is billed
+    exit_code, summary = run(capsys, "--overwrite")
+    assert exit_code == 0
+    assert summary["totals"]["ok"] == 2
+    assert summary["totals"]["estimated_cost"] == 0
+    assert all(document["cached_characters"] > 0 and document["estimated_cost"] == 0 for document in summary["documents"])
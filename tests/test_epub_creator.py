@@ -0,0 +1,77 @@
+import zipfile
+from xml.etree import ElementTree
+
+import pytest
+
+from epub_creator import create_epub_from_text, write_epub_from_blocks, iter_text_blocks
+
+XHTML = "{http://www.w3.org/1999/xhtml}"
+OPF = "{http://www.idpf.org/2007/opf}"
+NCX = "{http://www.daisy.org/z3986/2005/ncx/}"
+
+def read_book(epub_path):
+    # {entry name: parsed XML} of every XML part, checks the zip layout readers rely on on the way
+    with zipfile.ZipFile(epub_path) as book:
+        first_entry = book.infolist()[0]
+        assert first_entry.filename == "mimetype"
+        assert first_entry.compress_type == zipfile.ZIP_STORED
+        assert book.read("mimetype") == b"application/epub+zip"
+        return {name: ElementTree.fromstring(book.read(name)) for name in book.namelist()
+                if name.endswith((".xhtml", ".opf", ".ncx", ".xml"))}
+
+def nav_titles(parts):
+    return [link.text for link in parts["EPUB/nav.xhtml"].iter(f"{XHTML}a")]
+
+def test_chapters_follow_the_headings(tmp_path):
+    text = "\n\n".join([
+        "Opening paragraph before any heading.",
+        "1. Introduction", "First paragraph.", "Second paragraph.",
+        # No paragraph until the next heading, the chapter is dropped
+        "2. Background",
+        "3. Methods", "How it was done.",
+        "Chapter 4 Results", "What came out.",
+    ])
+    epub_path = str(tmp_path / "paper.epub")
+
+    chapter_count = write_epub_from_blocks(iter_text_blocks(text), epub_path, title="Paper")
+
+    parts = read_book(epub_path)
+    assert chapter_count == 4
+    assert nav_titles(parts) == ["Start", "1. Introduction", "3. Methods", "Chapter 4 Results"]
+    assert len(list(parts["EPUB/toc.ncx"].iter(f"{NCX}navPoint"))) == chapter_count
+    # nav first, then the chapters in order
+    spine = [itemref.get("idref") for itemref in parts["EPUB/content.opf"].iter(f"{OPF}itemref")]
+    assert spine == ["nav"] + [f"chapter_{number}" for number in range(1, chapter_count + 1)]
+    introduction = parts["EPUB/chap_2.xhtml"]
+    assert [p.text for p in introduction.iter(f"{XHTML}p")] == ["First paragraph.", "Second paragraph."]
+
+def test_markup_characters_are_escaped(tmp_path):
+    title = 'Fish & Chips <"Draft"> it\'s'
+    heading = "1. Salt & <Vinegar>"
+    paragraph = 'Cost < 5 & "cheap", said O\'Brien > everyone.\x0c'
+    epub_path = str(tmp_path / "paper.epub")
+
+    create_epub_from_text("\n\n".join([heading, paragraph]), epub_path, title=title)
+
+    parts = read_book(epub_path)
+    chapter = parts["EPUB/chap_1.xhtml"]
+    assert chapter.find(f"{XHTML}head/{XHTML}title").text == heading
+    assert chapter.find(f"{XHTML}body/{XHTML}h1").text == heading
+    # Control characters are dropped, they are not allowed in XML
+    assert chapter.find(f"{XHTML}body/{XHTML}p").text == paragraph.rstrip("\x0c")
+    assert parts["EPUB/content.opf"].find(f"{OPF}metadata/{{http://purl.org/dc/elements/1.1/}}title").text == title
+    assert parts["EPUB/toc.ncx"].find(f"{NCX}docTitle/{NCX}text").text == title
+    assert nav_titles(parts) == [heading]
+
+@pytest.mark.parametrize("text", ["", "1. Introduction\n\n2. Methods"])
+def test_book_without_paragraphs_gets_a_title_page(tmp_path, text):
+    epub_path = str(tmp_path / "empty.epub")
+
+    assert write_epub_from_blocks(iter_text_blocks(text), epub_path, title="Empty Paper") == 0
+
+    parts = read_book(epub_path)
+    # The navigation is never an empty list
+    assert nav_titles(parts) == ["Empty Paper"]
+    assert len(list(parts["EPUB/toc.ncx"].iter(f"{NCX}navPoint"))) == 1
+    assert [itemref.get("idref") for itemref in parts["EPUB/content.opf"].iter(f"{OPF}itemref")] == ["nav", "title_page"]
+    assert parts["EPUB/title.xhtml"].find(f"{XHTML}body/{XHTML}h1").text == "Empty Paper"
@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+from fake_backends import FakeLongAudioBackend, FakeTTSBackend, fake_mp3_audio, FAKE_MP3_FRAME_SIZE, FAKE_MP3_FRAME_SECONDS
+from google_ai_tts_converter import text_to_speech_converter
+from rate_limiter import RateLimiter
+from utility_functions import split_text_for_tts
+
+JOB_BYTES = 600
+
+def convert(text, output_filename, long_audio_backend, chunk_backend, MAX_RETRIES=10):
+    return text_to_speech_converter(text, output_filename, 30.0, TTS_CHUNK_SIZE=300, MAX_RETRIES=MAX_RETRIES,
+                                    INITIAL_BACKOFF=0.001, rate_limiter=RateLimiter(), interactive=False,
+                                    backend=chunk_backend, long_audio_backend=long_audio_backend, long_audio_min_bytes=0,
+                                    long_audio_job_bytes=JOB_BYTES, long_audio_rate_limiter=RateLimiter())
+
+def test_failed_jobs_are_submitted_again(tmp_path, sample_text):
+    job_texts = split_text_for_tts(sample_text, JOB_BYTES)
+    # Jobs are done (or failed) as soon as they are polled, every other one fails
+    long_audio_backend = FakeLongAudioBackend(job_latency=0.0, job_failure_rate=0.5, latency=0.0, jitter=0.0, seed=1)
+    chunk_backend = FakeTTSBackend(latency=0.0, jitter=0.0)
+    output_filename = str(tmp_path / "book.mp3")
+
+    duration = convert(sample_text, output_filename, long_audio_backend, chunk_backend)
+
+    # Resubmissions on top of one submission per job, and no fallback to chunk requests
+    assert long_audio_backend.service.stats["requests"] > len(job_texts)
+    assert chunk_backend.service.stats["requests"] == 0
+    frames = sum(len(fake_mp3_audio(job_text)) // FAKE_MP3_FRAME_SIZE for job_text in job_texts)
+    assert duration == pytest.approx(frames * FAKE_MP3_FRAME_SECONDS)
+    assert not os.path.exists(str(tmp_path / "book_temp_jobs"))
+
+def test_jobs_failing_every_attempt_keep_the_run_resumable(tmp_path, sample_text):
+    job_texts = split_text_for_tts(sample_text, JOB_BYTES)
+    long_audio_backend = FakeLongAudioBackend(job_latency=0.0, job_failure_rate=1.0, latency=0.0, jitter=0.0)
+    output_filename = str(tmp_path / "book.mp3")
+
+    assert convert(sample_text, output_filename, long_audio_backend, FakeTTSBackend(), MAX_RETRIES=2) is None
+    assert long_audio_backend.service.stats["requests"] == 2 * len(job_texts)
+    assert os.path.exists(str(tmp_path / "book_temp_jobs" / "jobs.json"))
+
+    # A working service finishes the same jobs on the next run
+    long_audio_backend = FakeLongAudioBackend(job_latency=0.0, latency=0.0, jitter=0.0)
+    assert convert(sample_text, output_filename, long_audio_backend, FakeTTSBackend()) is not None
+    assert long_audio_backend.service.stats["requests"] == len(job_texts)
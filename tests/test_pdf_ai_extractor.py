@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+import pdf_AI_text_extractor
+from backends import BackendError
+from fake_backends import FakeExtractionBackend
+from rate_limiter import RateLimiter
+
+class FailingExtractionBackend(FakeExtractionBackend):
+    # Fails for good on the page window named fail_batch
+
+    def __init__(self, fail_batch, **service_settings):
+        super().__init__(**service_settings)
+        self.fail_batch = fail_batch
+
+    def extract(self, pdf_bytes, prompt, temperature, display_name=None, on_progress=None):
+        if display_name and self.fail_batch in display_name:
+            raise BackendError("400 Fake invalid argument")
+        return super().extract(pdf_bytes, prompt, temperature, display_name=display_name, on_progress=on_progress)
+
+@pytest.fixture
+def work_dir(tmp_path, monkeypatch):
+    # Batches are kept in ./extracted_batches, 20-page windows (non-pro model settings) give the 45-page PDF three of them
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pdf_AI_text_extractor, "ai_model", "fake-extractor")
+    return tmp_path
+
+def extract(pdf_path, backend, parallel=False):
+    return pdf_AI_text_extractor.extract_text_with_gemini(pdf_path, parallel=parallel, rate_limiter=RateLimiter(), backend=backend)
+
+def read_manifest(work_dir):
+    with open(work_dir / "extracted_batches" / "paper" / pdf_AI_text_extractor.MANIFEST_FILENAME, encoding="utf-8") as f:
+        return json.load(f)
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_rerun_only_extracts_failed_batches(work_dir, synthetic_pdf, parallel):
+    failing_backend = FailingExtractionBackend("_batch_002", latency=0.0, jitter=0.0)
+    extract(synthetic_pdf, failing_backend, parallel)
+
+    statuses = {batch_num: batch["status"] for batch_num, batch in read_manifest(work_dir)["batches"].items()}
+    assert statuses == {"1": "done", "2": "failed", "3": "done"}
+
+    backend = FakeExtractionBackend(latency=0.0, jitter=0.0)
+    text = extract(synthetic_pdf, backend, parallel)
+
+    assert backend.service.stats["requests"] == 1
+    assert text
+    statuses = {batch_num: batch["status"] for batch_num, batch in read_manifest(work_dir)["batches"].items()}
+    assert statuses == {"1": "done", "2": "done", "3": "done"}
+
+    # Everything is on disk now, a third run sends nothing
+    backend = FakeExtractionBackend(latency=0.0, jitter=0.0)
+    assert extract(synthetic_pdf, backend, parallel) == text
+    assert backend.service.stats["requests"] == 0
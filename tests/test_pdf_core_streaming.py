@@ -0,0 +1,49 @@
+import pytest
+
+import pdf_core_text_extractor
+from pdf_core_text_extractor import extract_and_clean_pdf_text, iter_clean_pdf_text
+from page_layout_cache import PageLayoutCache
+
+@pytest.fixture(scope="module")
+def reference_text(synthetic_pdf):
+    return extract_and_clean_pdf_text(synthetic_pdf)
+
+@pytest.mark.parametrize("lookahead_pages", [None, 1, 3, 8])
+def test_streamed_sections_join_to_the_whole_text(synthetic_pdf, reference_text, lookahead_pages):
+    sections = list(iter_clean_pdf_text(synthetic_pdf, lookahead_pages=lookahead_pages))
+
+    assert len(sections) > 1
+    assert "".join(sections) == reference_text
+    # The running header is recognized within the lookahead too
+    assert not any("Journal of Synthetic Studies" in section for section in sections)
+
+@pytest.mark.parametrize("lookahead_pages", [None, 2])
+def test_streamed_page_range_matches(synthetic_pdf, lookahead_pages):
+    expected = extract_and_clean_pdf_text(synthetic_pdf, 5, 30)
+
+    assert "".join(iter_clean_pdf_text(synthetic_pdf, 5, 30, lookahead_pages=lookahead_pages)) == expected
+
+@pytest.mark.parametrize("lookahead_pages", [None, 3])
+def test_process_pool_gives_the_same_text(synthetic_pdf, reference_text, lookahead_pages):
+    # 45 pages over 3 processes: batches come back from the pool, pages must still be cleaned in order
+    sections = iter_clean_pdf_text(synthetic_pdf, workers=3, lookahead_pages=lookahead_pages)
+
+    assert "".join(sections) == reference_text
+    assert extract_and_clean_pdf_text(synthetic_pdf, workers=3) == reference_text
+
+@pytest.mark.parametrize("lookahead_pages", [None, 3])
+def test_layout_cache_gives_the_same_text(tmp_path, monkeypatch, synthetic_pdf, reference_text, lookahead_pages):
+    layout_cache = PageLayoutCache(str(tmp_path / "layouts.sqlite3"))
+    # Partly filled by an earlier run over a sub-range, the rest is read (in processes) and added
+    extract_and_clean_pdf_text(synthetic_pdf, 10, 20, layout_cache=layout_cache)
+    sections = iter_clean_pdf_text(synthetic_pdf, workers=3, lookahead_pages=lookahead_pages, layout_cache=layout_cache)
+    assert "".join(sections) == reference_text
+
+    # Now every page comes from the cache, nothing is read from the PDF
+    def read_page_blocks(page):
+        raise AssertionError(f"page {page.number} read despite the layout cache")
+
+    monkeypatch.setattr(pdf_core_text_extractor, "_read_page_blocks", read_page_blocks)
+    sections = iter_clean_pdf_text(synthetic_pdf, lookahead_pages=lookahead_pages, layout_cache=layout_cache)
+    assert "".join(sections) == reference_text
+    layout_cache.close()
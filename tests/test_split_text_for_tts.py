@@ -0,0 +1,84 @@
+import re
+
+import pytest
+
+from conftest import make_sample_text, make_varied_text
+from utility_functions import split_text_for_tts, TTS_SEGMENT_BOUNDARY_PATTERN
+
+def assert_chunks_cover_text(chunks, text):
+    # Chunks are stripped, in-order pieces of the text: between (and around) them there is only whitespace
+    position = 0
+    for chunk in chunks:
+        chunk_start = text.index(chunk, position)
+        assert not text[position:chunk_start].strip()
+        position = chunk_start + len(chunk)
+    assert not text[position:].strip()
+    assert re.sub(r"\s+", "", "".join(chunks)) == re.sub(r"\s+", "", text)
+
+@pytest.mark.parametrize("max_bytes", [120, 300, 4800])
+def test_chunks_fit_the_byte_budget_and_cover_the_text(max_bytes):
+    text = make_sample_text(paragraphs=40)
+    chunks = split_text_for_tts(text, max_bytes)
+
+    assert all(len(chunk.encode("utf-8")) <= max_bytes for chunk in chunks)
+    assert_chunks_cover_text(chunks, text)
+
+def test_multibyte_text_is_budgeted_in_bytes():
+    # 2-, 3- and 4-byte characters: a character budget would overshoot the API limit several times over
+    text = " ".join(["Grüße aus Köln.", "日本語のテキストです。", "Emoji 🎧🎧 zum Hören!", "Ünïcödé ëvérywhérë?"] * 60)
+    chunks = split_text_for_tts(text, 200)
+
+    assert len(chunks) > 1
+    assert all(len(chunk.encode("utf-8")) <= 200 for chunk in chunks)
+    assert_chunks_cover_text(chunks, text)
+
+def test_overlong_sentence_is_split_at_words():
+    sentence = " ".join(f"word{index}" for index in range(400)) + "."
+    chunks = split_text_for_tts(sentence, 250)
+
+    assert len(chunks) > 1
+    assert all(len(chunk.encode("utf-8")) <= 250 for chunk in chunks)
+    # Word boundaries only, no word is cut
+    assert all(re.fullmatch(r"word\d+", word) for chunk in chunks for word in chunk.rstrip(".").split())
+    assert_chunks_cover_text(chunks, sentence)
+
+@pytest.mark.parametrize("word", ["x" * 1000, "ä" * 500, "日本" * 200, "🎧" * 150])
+def test_overlong_word_is_hard_cut_between_characters(word):
+    # An odd budget, so cuts fall inside multi-byte characters unless they are moved back
+    text = f"Before. {word} After."
+    chunks = split_text_for_tts(text, 101)
+
+    assert all(0 < len(chunk.encode("utf-8")) <= 101 for chunk in chunks)
+    assert "".join(chunks).replace(" ", "") == text.replace(" ", "")
+    assert_chunks_cover_text(chunks, text)
+
+def test_same_text_gives_same_chunks():
+    text = make_sample_text(paragraphs=40)
+    assert split_text_for_tts(text, 300) == split_text_for_tts(text, 300)
+
+def test_early_edit_leaves_later_chunks_identical():
+    # One long paragraph, so no paragraph break puts the chunking back into step
+    text = make_varied_text().replace("\n\n", " ")
+    edited_text = text.replace("Measurement 0.2", "Measurement 0.2, after a sentence inserted by an edit,", 1)
+    chunks = split_text_for_tts(text, 600)
+    edited_chunks = split_text_for_tts(edited_text, 600)
+
+    # Back in step within a few chunks of the edit, all the rest is reused from the audio cache
+    assert chunks[0] != edited_chunks[0]
+    assert edited_chunks[-(len(chunks) - 3):] == chunks[3:]
+    # Packed full, every chunk after the edit is shifted
+    assert split_text_for_tts(edited_text, 600, resync=False)[-1] != split_text_for_tts(text, 600, resync=False)[-1]
+
+def test_without_resync_chunks_are_packed_full():
+    text = make_varied_text()
+    packed_chunks = split_text_for_tts(text, 300, resync=False)
+
+    assert len(packed_chunks) < len(split_text_for_tts(text, 300))
+    assert_chunks_cover_text(packed_chunks, text)
+    # Every chunk but the last ended only because the next sentence didn't fit
+    for chunk, next_chunk in zip(packed_chunks, packed_chunks[1:]):
+        next_sentence = TTS_SEGMENT_BOUNDARY_PATTERN.split(next_chunk, 1)[0]
+        assert len(f"{chunk} {next_sentence}".encode("utf-8")) > 300
+
+def test_empty_text():
+    assert split_text_for_tts("", 300) == []
@@ -0,0 +1,68 @@
+import re
+from xml.etree import ElementTree
+
+import pytest
+
+from conftest import make_sample_text, make_varied_text
+from ssml_builder import build_ssml_chunks, find_sections, chunk_mark_name
+from utility_functions import split_text_for_tts
+
+MARK_PATTERN = re.compile(r'<mark name="([^"]*)"/>')
+
+def escape_heavy_text():
+    # "&", "<" and quotes grow five- to sixfold when escaped, a text budget of 80% is not enough for such chunks
+    paragraphs = [f"Section {index} & co. <draft> \"quoted\" & 'more' & <tags> & so on." * 3 for index in range(12)]
+    return "\n\n".join(paragraphs)
+
+@pytest.mark.parametrize("max_bytes", [400, 1000, 4800])
+@pytest.mark.parametrize("text", [make_sample_text(paragraphs=40), escape_heavy_text()], ids=["prose", "escapes"])
+def test_ssml_chunks_fit_the_byte_budget(text, max_bytes):
+    sections, chunks = build_ssml_chunks(text, max_bytes)
+
+    assert all(len(chunk.ssml.encode("utf-8")) <= max_bytes for chunk in chunks)
+    # Well-formed SSML
+    assert all(ElementTree.fromstring(chunk.ssml).tag == "speak" for chunk in chunks)
+    # Every section is marked exactly once, in order
+    assert [mark for chunk in chunks for mark in chunk.marks] == [section.mark for section in sections]
+
+def test_chunks_are_located_in_order():
+    # The same sentence again and again: each chunk has to be found after the previous one, not at its first occurrence
+    text = "\n\n".join(["The same sentence is repeated here."] * 60)
+    sections, chunks = build_ssml_chunks(text, 400)
+
+    position = 0
+    for chunk in chunks:
+        chunk_start = text.index(chunk.text, position)
+        assert not text[position:chunk_start].strip()
+        position = chunk_start + len(chunk.text)
+    assert not text[position:].strip()
+    assert len(sections) == 60
+    assert sum(len(chunk.marks) for chunk in chunks) == 60
+
+def test_too_large_ssml_is_split_again():
+    text = escape_heavy_text()
+    _, chunks = build_ssml_chunks(text, 1000)
+
+    # More chunks than the first split at the text budget, none is over the limit
+    assert len(chunks) > len(split_text_for_tts(text, 800))
+    assert all(len(chunk.ssml.encode("utf-8")) <= 1000 for chunk in chunks)
+    assert re.sub(r"\s+", "", "".join(chunk.text for chunk in chunks)) == re.sub(r"\s+", "", text)
+
+def test_mark_names_count_within_the_chunk():
+    _, chunks = build_ssml_chunks(make_sample_text(paragraphs=40), 400)
+
+    for chunk in chunks:
+        assert MARK_PATTERN.findall(chunk.ssml) == [chunk_mark_name(index) for index in range(len(chunk.marks))]
+
+def test_inserted_paragraph_keeps_later_chunks():
+    text = make_varied_text()
+    edited_text = text.replace("\n\n", "\n\nAn inserted paragraph near the start of the document.\n\n", 1)
+    _, chunks = build_ssml_chunks(text, 400)
+    _, edited_chunks = build_ssml_chunks(edited_text, 400)
+
+    # Section names all move by one, the SSML sent for the later chunks (and their audio cache keys) doesn't
+    assert len(find_sections(edited_text)) == len(find_sections(text)) + 1
+    assert [chunk.ssml for chunk in edited_chunks[-20:]] == [chunk.ssml for chunk in chunks[-20:]]
+    later_marks = [mark for chunk in chunks[-20:] for mark in chunk.marks]
+    assert later_marks
+    assert [mark for chunk in edited_chunks[-20:] for mark in chunk.marks] == [f"s{int(mark[1:]) + 1}" for mark in later_marks]
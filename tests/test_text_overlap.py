@@ -0,0 +1,68 @@
+import pytest
+
+from utility_functions import find_text_overlap, smart_stitch
+
+# 16 words, the seam between two extraction batches in these tests
+SEAM = "the committee reviewed every sample twice before publishing the final numbers in its annual report."
+BEFORE = "Earlier pages describe how the study was set up and which sites took part in it."
+AFTER = "The next section compares these numbers with the previous year and explains the differences."
+
+def test_exact_overlap_is_found_and_trimmed():
+    previous_text = f"{BEFORE} {SEAM}"
+    # Same words, other line breaks and spacing
+    new_text = SEAM.replace(" every ", "\nevery  ") + "\n\n" + AFTER
+
+    match = find_text_overlap(previous_text, new_text)
+
+    assert match.size == len(SEAM.split())
+    assert match.tail_start == len(BEFORE.split())
+    assert match.head_start == 0
+    assert new_text[match.head_cut_index:] == "\n\n" + AFTER
+    # Nothing of the tail comes after the seam, only the run length limits the confidence
+    assert match.confidence == pytest.approx(len(SEAM.split()) / 40)
+    assert smart_stitch(previous_text, new_text) == f"{BEFORE} {SEAM}\n\n{AFTER}"
+
+def test_no_overlap_appends_with_a_newline():
+    unrelated_text = "Figures one to four summarize measurements per region."
+    match = find_text_overlap(BEFORE, unrelated_text)
+
+    assert match.size == 0
+    assert match.confidence == 0.0
+    assert smart_stitch(BEFORE, unrelated_text) == f"{BEFORE}\n{unrelated_text}"
+    assert smart_stitch("", AFTER) == AFTER
+
+def test_real_seam_wins_over_short_repeated_runs():
+    # "the results show that" is everywhere in both texts, the seam is the one long run
+    phrase = "the results show that"
+    previous_text = " ".join(f"{phrase} site {number} did well." for number in range(30)) + " " + SEAM
+    new_text = SEAM + " " + " ".join(f"{phrase} group {number} did not." for number in range(30))
+
+    match = find_text_overlap(previous_text, new_text)
+
+    assert match.size == len(SEAM.split())
+    assert match.tail_start == len(previous_text.split()) - len(SEAM.split())
+    assert match.head_start == 0
+    stitched = smart_stitch(previous_text, new_text)
+    assert stitched.count(SEAM) == 1
+    assert stitched == previous_text + new_text[len(SEAM):]
+
+def test_spurious_run_in_the_middle_of_the_tail_has_low_confidence():
+    # A shared run with a lot of tail text after it doesn't explain the seam
+    previous_text = f"{SEAM} {BEFORE} {BEFORE.upper()} {AFTER.upper()}"
+    new_text = f"{SEAM} {AFTER}"
+
+    match = find_text_overlap(previous_text, new_text)
+
+    assert match.size == len(SEAM.split())
+    assert match.confidence < 0.2
+    assert smart_stitch(previous_text, new_text, min_confidence=0.3) == f"{previous_text}\n{new_text}"
+
+def test_overlap_below_min_overlap_words_is_not_trimmed():
+    short_seam = " ".join(SEAM.split()[:8])
+    previous_text = f"{BEFORE} {short_seam}"
+    new_text = f"{short_seam} {AFTER}"
+
+    assert find_text_overlap(previous_text, new_text).size == 8
+    # 8 < min_overlap_words (11): could be a common phrase, both copies are kept
+    assert smart_stitch(previous_text, new_text) == f"{previous_text}\n{new_text}"
+    assert smart_stitch(previous_text, new_text, min_overlap_words=8) == f"{previous_text} {AFTER}"
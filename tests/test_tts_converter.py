@@ -0,0 +1,182 @@
+import os
+import json
+import threading
+
+import pytest
+
+from backends import BackendError, QuotaExceededError
+from fake_backends import FakeTTSBackend, fake_mp3_audio, FAKE_MP3_FRAME_SIZE, FAKE_MP3_FRAME_SECONDS
+from google_ai_tts_converter import text_to_speech_converter, timing_index_path, _write_timing_index
+from ssml_builder import Section, find_sections
+from audio_stitcher import scan_mp3_file
+from rate_limiter import RateLimiter
+from utility_functions import split_text_for_tts
+from conftest import make_sample_text
+import metrics
+
+CHUNK_SIZE = 300
+
+def expected_duration(text, chunk_size=CHUNK_SIZE):
+    # What the stitched fake audio of all chunks has to add up to
+    frames = sum(len(fake_mp3_audio(chunk)) // FAKE_MP3_FRAME_SIZE for chunk in split_text_for_tts(text, chunk_size))
+    return frames * FAKE_MP3_FRAME_SECONDS
+
+def convert(text, output_filename, backend, rate_limiter, max_workers=4, MAX_RETRIES=5):
+    return text_to_speech_converter(text, output_filename, 30.0, TTS_CHUNK_SIZE=CHUNK_SIZE, MAX_RETRIES=MAX_RETRIES,
+                                    INITIAL_BACKOFF=0.001, max_workers=max_workers, rate_limiter=rate_limiter,
+                                    interactive=False, backend=backend)
+
+class FailingTTSBackend(FakeTTSBackend):
+    # Fails for good on every chunk containing fail_text, like a request the API rejects (400)
+
+    def __init__(self, fail_text, **service_settings):
+        super().__init__(**service_settings)
+        self.fail_text = fail_text
+
+    def synthesize(self, text, voice_name, language_code, audio_encoding):
+        if self.fail_text in text:
+            raise BackendError("400 Fake invalid argument")
+        return super().synthesize(text, voice_name, language_code, audio_encoding)
+
+class QuotaTTSBackend(FakeTTSBackend):
+    # Answers the first `rejections` requests with 429
+
+    def __init__(self, rejections, **service_settings):
+        super().__init__(**service_settings)
+        self.rejections = rejections
+        self._rejections_lock = threading.Lock()
+
+    def synthesize(self, text, voice_name, language_code, audio_encoding):
+        with self._rejections_lock:
+            reject = self.rejections > 0
+            self.rejections -= 1
+        if reject:
+            raise QuotaExceededError("429 Fake quota exceeded")
+        return super().synthesize(text, voice_name, language_code, audio_encoding)
+
+class RecordingRateLimiter(RateLimiter):
+    # Counts the throttles reported to it
+
+    def __init__(self, **limits):
+        super().__init__(**limits)
+        self.throttles = 0
+
+    def report_throttled(self, initial_backoff=2.0):
+        self.throttles += 1
+        return super().report_throttled(initial_backoff)
+
+def test_transient_errors_are_retried(tmp_path, sample_text, rate_limiter):
+    backend = FakeTTSBackend(latency=0.0, jitter=0.0, error_rate=0.3, seed=3)
+    output_filename = str(tmp_path / "book.mp3")
+
+    duration = convert(sample_text, output_filename, backend, rate_limiter, MAX_RETRIES=10)
+
+    assert backend.service.stats["errors"] > 0
+    assert duration == pytest.approx(expected_duration(sample_text))
+    assert scan_mp3_file(output_filename).frame_count == round(expected_duration(sample_text) / FAKE_MP3_FRAME_SECONDS)
+    assert not os.path.exists(str(tmp_path / "book_temp_chunks"))
+
+def test_hard_failure_keeps_chunks_and_resumes(tmp_path, sample_text, rate_limiter):
+    chunks = split_text_for_tts(sample_text, CHUNK_SIZE)
+    failing_chunk = len(chunks) // 2
+    output_filename = str(tmp_path / "book.mp3")
+    temp_dir_path = str(tmp_path / "book_temp_chunks")
+
+    # One worker, so the chunks before the failing one are done when it aborts the run
+    # (the worker may already have started the next one by then)
+    failing_backend = FailingTTSBackend(chunks[failing_chunk], latency=0.0, jitter=0.0)
+    assert convert(sample_text, output_filename, failing_backend, rate_limiter, max_workers=1) is None
+    assert not os.path.exists(output_filename)
+    saved_chunks = sorted(name for name in os.listdir(temp_dir_path) if name.startswith("chunk_"))
+    assert saved_chunks[:failing_chunk] == [f"chunk_{index:04d}.mp3" for index in range(failing_chunk)]
+    assert f"chunk_{failing_chunk:04d}.mp3" not in saved_chunks
+    assert len(saved_chunks) < len(chunks) - 1
+
+    backend = FakeTTSBackend(latency=0.0, jitter=0.0)
+    duration = convert(sample_text, output_filename, backend, rate_limiter)
+
+    # Only the chunks the first run didn't finish are requested again
+    assert backend.service.stats["requests"] == len(chunks) - len(saved_chunks)
+    assert duration == pytest.approx(expected_duration(sample_text))
+    assert not os.path.exists(temp_dir_path)
+
+def test_stale_chunks_of_another_text_are_not_stitched(tmp_path, sample_text, rate_limiter):
+    # A failed run of a longer text leaves its chunks, the rerun is of an edited, shorter text (e.g. re-extracted)
+    old_text = make_sample_text(paragraphs=24) + "\n\nA closing remark the API rejects."
+    old_chunks = split_text_for_tts(old_text, CHUNK_SIZE)
+    output_filename = str(tmp_path / "book.mp3")
+    temp_dir_path = str(tmp_path / "book_temp_chunks")
+    failing_backend = FailingTTSBackend("closing remark", latency=0.0, jitter=0.0)
+    assert convert(old_text, output_filename, failing_backend, rate_limiter, max_workers=1) is None
+
+    new_text = "An inserted first sentence moves every chunk boundary. " + sample_text
+    new_chunks = split_text_for_tts(new_text, CHUNK_SIZE)
+    assert len([name for name in os.listdir(temp_dir_path) if name.startswith("chunk_")]) > len(new_chunks)
+    backend = FakeTTSBackend(latency=0.0, jitter=0.0)
+    duration = convert(new_text, output_filename, backend, rate_limiter)
+
+    # Only chunks whose text is unchanged at their index are resumed, the stitched audio is the new text's alone
+    unchanged = sum(1 for old_chunk, new_chunk in zip(old_chunks, new_chunks) if old_chunk == new_chunk)
+    assert backend.service.stats["requests"] == len(new_chunks) - unchanged
+    assert duration == pytest.approx(expected_duration(new_text))
+    assert not os.path.exists(temp_dir_path)
+
+def test_requests_in_flight_stay_within_workers(tmp_path, sample_text, rate_limiter):
+    backend = FakeTTSBackend(latency=0.02, jitter=0.0)
+
+    duration = convert(sample_text, str(tmp_path / "book.mp3"), backend, rate_limiter, max_workers=3)
+
+    assert duration == pytest.approx(expected_duration(sample_text))
+    assert 1 < backend.service.stats["peak_concurrency"] <= 3
+
+def test_quota_errors_throttle_the_rate_limiter(tmp_path, sample_text):
+    metrics.METRICS.reset()
+    backend = QuotaTTSBackend(3, latency=0.0, jitter=0.0)
+    rate_limiter = RecordingRateLimiter()
+
+    duration = convert(sample_text, str(tmp_path / "book.mp3"), backend, rate_limiter, MAX_RETRIES=5)
+
+    assert duration == pytest.approx(expected_duration(sample_text))
+    assert rate_limiter.throttles == 3
+    counters, _ = metrics.METRICS.snapshot()
+    retries = {counter["labels"].get("status"): counter["value"] for counter in counters if counter["name"] == "tts.retries"}
+    assert retries == {"429": 3}
+
+def test_timing_index_maps_chunk_marks_to_sections(tmp_path):
+    # Two chunks of 10 s with marks m0, m1 each, the API reported no time for the second chunk's m1
+    chunk_timepoints = [{"marks": ["m0", "m1"], "timepoints": {"m0": 0.0, "m1": 2.5}},
+                        {"marks": ["m0", "m1"], "timepoints": {"m0": 1.0}}]
+    chunk_files = []
+    for index, timepoints in enumerate(chunk_timepoints):
+        chunk_files.append(str(tmp_path / f"chunk_{index:04d}.mp3"))
+        (tmp_path / f"chunk_{index:04d}.timepoints.json").write_text(json.dumps(timepoints), encoding="utf-8")
+    sections = [Section("s0", "heading", 0, "Introduction"), Section("s1", "paragraph", 14, "First line\nsecond line"),
+                Section("s2", "paragraph", 40, "Third"), Section("s3", "heading", 47, "Methods")]
+    index_path = str(tmp_path / "book.timing.json")
+
+    _write_timing_index(index_path, str(tmp_path / "book.mp3"), 20.0, "fake-voice", sections, chunk_files,
+                        [["s0", "s1"], ["s2", "s3"]], lambda chunk_filename: 10.0)
+
+    with open(index_path, encoding="utf-8") as f:
+        index = json.load(f)
+    assert index["audio_file"] == "book.mp3"
+    assert [(section["mark"], section["seconds"]) for section in index["sections"]] == [
+        ("s0", 0.0), ("s1", 2.5), ("s2", 11.0), ("s3", 10.0)]
+    assert index["sections"][1]["title"] == "First line"
+    assert [section["text_offset"] for section in index["sections"]] == [0, 14, 40, 47]
+
+def test_ssml_run_writes_a_timing_index_of_every_section(tmp_path, sample_text, rate_limiter):
+    output_filename = str(tmp_path / "book.mp3")
+    duration = text_to_speech_converter(sample_text, output_filename, 30.0, TTS_CHUNK_SIZE=CHUNK_SIZE * 2, INITIAL_BACKOFF=0.001,
+                                        rate_limiter=rate_limiter, interactive=False,
+                                        backend=FakeTTSBackend(latency=0.0, jitter=0.0), ssml=True)
+
+    with open(timing_index_path(output_filename), encoding="utf-8") as f:
+        index = json.load(f)
+    sections = find_sections(sample_text)
+    assert [section["mark"] for section in index["sections"]] == [section.mark for section in sections]
+    seconds = [section["seconds"] for section in index["sections"]]
+    assert seconds[0] == pytest.approx(0.0, abs=0.1)
+    # Sections in order through the whole audio, not restarting at every chunk
+    assert all(earlier < later for earlier, later in zip(seconds, seconds[1:]))
+    assert seconds[-1] < duration
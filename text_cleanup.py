@@ -0,0 +1,129 @@
+import re
+
+from utility_functions import ARTIFACT_PATTERN, apply_replacement_rules
+import metrics
+
+# Cleanup of the raw text that extract_and_clean_pdf_text collects from a PDF.
+# Every stage is a full pass over a multi-megabyte string, so the patterns are compiled once and steps are merged into
+# one pass where that is actually faster. The result is identical to running the original steps one after another
+# (except for the replacement rules, which now all apply in one leftmost-longest pass, see apply_replacement_rules):
+#   1. hyphenation fix
+#   2. common artifact fixes (replacement rules + citation-corruption regexes)
+#   3. newline/whitespace collapse
+#   4. heading/list tag expansion
+#   5. citation removal
+#   6. squeezing repeated newlines
+# Patterns start with a literal character where possible (lookbehinds come after it), so the regex engine can jump to
+# candidate positions. Run benchmarks/bench_text_cleanup.py to see the cost of each stage.
+#
+# clean_extracted_sections runs the same stages on a document that arrives in pieces (see iter_clean_pdf_text).
+# A piece ends in the whitespace in front of a heading tag and the next one starts with the tag, so no match of any
+# stage spans two pieces, and the cleaned pieces joined are exactly clean_extracted_text of the joined input. That holds
+# as long as no replacement rule contains a newline (fix files are read line by line) and the extractor doesn't cut
+# while a "(" is still open (a citation could run on past the heading).
+
+# Structure markers placed by the extractor, expanded into plain text structure at the end of the cleanup
+HEADING_START = "<<<HEADING>>>"
+HEADING_END = "<<<END_HEADING>>>"
+LIST_ITEM_START = "<<<LIST_ITEM>>>"
+LIST_ITEM_END = "<<<END_LIST_ITEM>>>"
+
+# Joins "exam-\nple" -> "example". Same as re.sub(r'([a-zA-Z]+)-\s*\n\s*', r'\1', ...) but without capturing and
+# re-inserting the whole word
+HYPHENATION_PATTERN = re.compile(r'-(?<=[a-zA-Z]-)\s*\n\s*')
+
+# Newlines become spaces and whitespace runs collapse to one space, in one pass.
+# Runs that already are a single space are not matched, most of the text is left alone that way
+WHITESPACE_PATTERN = re.compile(r' \s+|[^\S ]\s*')
+
+# Tag expansion + citation removal in one pass. Tags contain none of the citation keywords, so a citation matches the
+# same way whether the tags in it are expanded yet or not.
+# The space between two list items belongs to the next item's start tag, hence the lookahead on the end tag
+STRUCTURE_OR_CITATION_PATTERN = re.compile(
+    r'\([^)]*((?:19|20)\d{2}|et al\.|p\.|pp\.)[^)]*\)'
+    + '|' + re.escape(HEADING_START)
+    + '|' + re.escape(HEADING_END)
+    + '|' + re.escape(" " + LIST_ITEM_START)
+    + '|' + re.escape(LIST_ITEM_END + " ") + '(?!' + re.escape(LIST_ITEM_START) + ')'
+)
+STRUCTURE_REPLACEMENTS = {
+    HEADING_START: "\n\n",
+    HEADING_END: "\n\n",
+    " " + LIST_ITEM_START: "\n- ",
+    LIST_ITEM_END + " ": "",
+}
+
+REPEATED_NEWLINES_PATTERN = re.compile(r'\n{3,}')
+
+def join_hyphenated_lines(text, fixes=None):
+    # Uses the raw line breaks, so must run BEFORE whitespace is collapsed
+    return HYPHENATION_PATTERN.sub('', text)
+
+def remove_artifacts(text, fixes=None):
+    # "Daubert?6" -> "Daubert" style superscript corruption, see clean_common_pdf_artifacts
+    return ARTIFACT_PATTERN.sub('', text)
+
+def collapse_whitespace(text, fixes=None):
+    return WHITESPACE_PATTERN.sub(' ', text).strip()
+
+def _structure_or_citation(match):
+    # Tags are looked up, citations are removed
+    return STRUCTURE_REPLACEMENTS.get(match.group(0), "")
+
+def expand_structure_and_remove_citations(text, fixes=None):
+    # Must run AFTER the whitespace collapse, so the newlines of headings and lists survive
+    return STRUCTURE_OR_CITATION_PATTERN.sub(_structure_or_citation, text)
+
+def squeeze_newlines(text, fixes=None):
+    # Citation removal can leave heading breaks next to each other, so this can't share the previous pass
+    return REPEATED_NEWLINES_PATTERN.sub('\n\n', text)
+
+# (name, function) in the order they have to run, all take (text, fixes)
+CLEANUP_STAGES = (
+    ("hyphenation", join_hyphenated_lines),
+    ("replacement rules", apply_replacement_rules),
+    ("artifacts", remove_artifacts),
+    ("whitespace", collapse_whitespace),
+    ("structure tags + citations", expand_structure_and_remove_citations),
+    ("newline squeeze", squeeze_newlines),
+)
+
+def clean_extracted_text(full_text, fixes=None):
+    # Runs all cleanup stages on the joined extractor output
+    text = full_text
+    for name, stage in CLEANUP_STAGES:
+        with metrics.span("text_cleanup.stage", stage=name):
+            text = stage(text, fixes)
+    return text
+
+def _clean_section(text, fixes, is_first, is_last):
+    # The whitespace stage strips the ends of the whole document, so only the start of the first and the end of the last piece
+    for _, stage in CLEANUP_STAGES:
+        if stage is collapse_whitespace:
+            text = WHITESPACE_PATTERN.sub(' ', text)
+            if is_first:
+                text = text.lstrip()
+            if is_last:
+                text = text.rstrip()
+        else:
+            text = stage(text, fixes)
+    return text
+
+def clean_extracted_sections(raw_sections, fixes=None):
+    # Generator, cleans the extractor output piece by piece (see the top of this file for how pieces are cut).
+    # One piece is held back until the next arrives, the last one is only known at the end
+    previous_section = None
+    is_first = True
+    for raw_section in raw_sections:
+        if not raw_section:
+            continue
+        if previous_section is not None:
+            with metrics.span("text_cleanup.section"):
+                cleaned_section = _clean_section(previous_section, fixes, is_first, False)
+            yield cleaned_section
+            is_first = False
+        previous_section = raw_section
+    if previous_section is not None:
+        with metrics.span("text_cleanup.section"):
+            cleaned_section = _clean_section(previous_section, fixes, is_first, True)
+        yield cleaned_section
\ No newline at end of file
@@ -1,22 +1,32 @@
 import os
-from prompt_toolkit import prompt
-from prompt_toolkit.completion import PathCompleter
 
 from config import * 
-from utility_functions import get_unique_filename, open_file_for_editing, calculate_tts_cost, load_custom_fixes_from_file
-from pdf_core_text_extractor import extract_and_clean_pdf_text
-from google_ai_tts_converter import text_to_speech_converter
-from pdf_AI_text_extractor import extract_text_with_gemini
+from utility_functions import get_unique_filename, open_file_for_editing, calculate_tts_cost, load_custom_fixes_from_file, split_text_for_tts
 from epub_creator import create_epub_from_text
+from audio_cache import AudioCache
+from gemini_response_cache import GeminiResponseCache
+from page_layout_cache import PageLayoutCache
+from audio_stitcher import AUDIO_FORMATS
+from rate_limiter import get_rate_limiter
+from metrics import METRICS, export_metrics, export_wants_span_events
+
+# Startup only loads what every workflow needs. PyMuPDF, the TTS converter (and through the backends the Google SDKs)
+# and prompt_toolkit are imported inside the workflows that use them, so e.g. txt -> EPUB starts at once
+# and works on a machine without those packages or Google credentials
+
+def prompt_path(message):
+    # Path input with TAB completion
+    from prompt_toolkit import prompt
+    from prompt_toolkit.completion import PathCompleter
+    return prompt(message, completer=PathCompleter())
 
 ##############################################################################################################################
 ##############################################################################################################################
 ##############################################################################################################################
 
 def process_ai_extraction_workflow():
-    path_completer = PathCompleter()
     print("\n AI Text Extraction  (Gemini) ---")
-    pdf_path = prompt(">>> Enter path to PDF: ", completer=path_completer)
+    pdf_path = prompt_path(">>> Enter path to PDF: ")
 
     if not os.path.exists(pdf_path):
         print("!!! File not found.")
@@ -34,7 +44,13 @@ def process_ai_extraction_workflow():
     if end_input.isdigit() and int(end_input) > 0:
         end_page_index = int(end_input)
     
-    clean_text = extract_text_with_gemini(pdf_path, start_page_index, end_page_index)
+    from pdf_AI_text_extractor import extract_text_with_gemini
+    parallel = input(f">>> Send page windows in parallel, up to {GEMINI_MAX_CONCURRENCY} at a time? (y/N): ").lower() == 'y'
+
+    clean_text = extract_text_with_gemini(pdf_path, start_page_index, end_page_index,
+                                          parallel=parallel, max_concurrency=GEMINI_MAX_CONCURRENCY,
+                                          response_cache=GeminiResponseCache(GEMINI_RESPONSE_CACHE_FOLDER),
+                                          rate_limiter=get_rate_limiter("gemini", GEMINI_REQUESTS_PER_MINUTE))
     # clean_text = extract_text_with_gemini(pdf_path)
 
     if clean_text:
@@ -51,7 +67,6 @@ def process_ai_extraction_workflow():
 
 def process_pdf_workflow():
     # Workflow for processing a PDF file
-    path_completer = PathCompleter()
     print("\n################################# How to Navigate ###########################")
     print("#                                                                             #")
     print("# - Press TAB to see available files and folders.                             #")
@@ -59,13 +74,14 @@ def process_pdf_workflow():
     print("# - For WSL: your C: drive is at '/mnt/c/'.                                   #")
     print("#                                                                             #")
     print("###############################################################################\n")
-    pdf_path = prompt(">>> Enter the path to your PDF file: ", completer=path_completer)
+    pdf_path = prompt_path(">>> Enter the path to your PDF file: ")
 
     if not os.path.exists(pdf_path):
         print(f"\n!!! Error: File does not exist at '{pdf_path}' !!!")
         return
 
-    clean_text = extract_and_clean_pdf_text(pdf_path)
+    from pdf_core_text_extractor import extract_and_clean_pdf_text
+    clean_text = extract_and_clean_pdf_text(pdf_path, layout_cache=PageLayoutCache(PAGE_LAYOUT_CACHE_PATH))
     if not clean_text:
         return
 
@@ -100,8 +116,7 @@ def process_pdf_workflow():
 
 def extract_pdf_only_workflow():
     # Ask for PDF
-    path_completer = PathCompleter()
-    pdf_path = prompt(">>> Enter the path to your PDF file: ", completer=path_completer)
+    pdf_path = prompt_path(">>> Enter the path to your PDF file: ")
     if not os.path.exists(pdf_path):
         print(f"!!! Error: File not found at {pdf_path}")
         return
@@ -117,19 +132,28 @@ def extract_pdf_only_workflow():
     if end_input.isdigit() and int(end_input) > 0:
         end_page_index = int(end_input)
 
-    fixes_path = prompt(">>> Path to custom replacements file (optional): ", completer=path_completer).strip()
+    fixes_path = prompt_path(">>> Path to custom replacements file (optional): ").strip()
     user_fixes = {}
     if fixes_path:
         # If user typed something, try to load it
         # If user just hit Enter, skip
         user_fixes = load_custom_fixes_from_file(fixes_path)
 
+    workers_input = input(f">>> Worker processes for page extraction (default {PDF_EXTRACTION_WORKERS}): ").strip()
+    if workers_input.isdigit() and int(workers_input) > 0:
+        workers = int(workers_input)
+    else:
+        workers = PDF_EXTRACTION_WORKERS
+
     # Extract
+    from pdf_core_text_extractor import extract_and_clean_pdf_text
     # clean_text = extract_and_clean_pdf_text(pdf_path)
     clean_text = extract_and_clean_pdf_text(pdf_path, 
                                             start_page_index, 
                                             end_page_index,
-                                            custom_replacements=user_fixes)
+                                            custom_replacements=user_fixes,
+                                            workers=workers,
+                                            layout_cache=PageLayoutCache(PAGE_LAYOUT_CACHE_PATH))
     if not clean_text: 
         return
 
@@ -149,7 +173,6 @@ def extract_pdf_only_workflow():
 
 def process_txt_workflow():
     # Workflow for generating audio from a text (.txt) file
-    path_completer = PathCompleter()
     print("\n######################### How to Navigate #####################################")
     print("#                                                                             #")
     print("# - Press TAB to see available files and folders.                             #")
@@ -158,7 +181,7 @@ def process_txt_workflow():
     print("# - For WSL: your C: drive is at '/mnt/c/'.                                   #")
     print("#                                                                             #")
     print("###############################################################################\n")
-    txt_path = prompt(">>> Enter the path to your .txt file: ", completer=path_completer)
+    txt_path = prompt_path(">>> Enter the path to your .txt file: ")
 
     if not os.path.exists(txt_path):
         print(f"\n!!! Error: File does not exist at '{txt_path}' !!!")
@@ -195,7 +218,6 @@ def handle_epub_generation(text_content, source_path):
         create_epub_from_text(text_content, epub_path, title=base_name)
 
 def process_txt_to_epub_workflow():
-    path_completer = PathCompleter()
     print("\n######################### Text to EPUB Converter ##############################")
     print("#                                                                             #")
     print("#  Converts a raw .txt file into a structured EPUB audiobook.                 #")
@@ -204,7 +226,7 @@ def process_txt_to_epub_workflow():
     print("#                                                                             #")
     print("###############################################################################\n")
     
-    txt_path = prompt(">>> Enter the path to your .txt file: ", completer=path_completer)
+    txt_path = prompt_path(">>> Enter the path to your .txt file: ")
 
     if not os.path.exists(txt_path):
         print(f"\n!!! Error: File does not exist at '{txt_path}' !!!")
@@ -252,12 +274,37 @@ def process_txt_to_epub_workflow():
 
 def generate_audio_from_text(text_content, source_path):
     # Method for prompting user and starting audio synthesis
-    char_count = len(text_content)
-    estimated_cost = calculate_tts_cost(char_count, PRICE_PER_MILLION_CHARS_HD)
+    audio_cache = AudioCache(AUDIO_CACHE_FOLDER, AUDIO_CACHE_MAX_BYTES)
+
+    # (voice, encoding) of every output, the main one first
+    output_variants = [(TTS_VOICE_NAME, TTS_AUDIO_ENCODING)] + [variant for variant in TTS_EXTRA_TARGETS
+                                                                if variant != (TTS_VOICE_NAME, TTS_AUDIO_ENCODING)]
+
+    from google_ai_tts_converter import synthesize_targets, SynthesisTarget, uses_long_audio
+    from ssml_builder import build_ssml_chunks
+    # Chunks already in the audio cache are not sent to the API, so they cost nothing. The chunks are the ones the
+    # synthesis will send: (chunk text, request text), SSML in timing mode, and the cache is keyed by the request text
+    if TTS_SSML_TIMING:
+        text_chunks = [(ssml_chunk.text, ssml_chunk.ssml) for ssml_chunk in build_ssml_chunks(text_content, TTS_CHUNK_SIZE)[1]]
+    else:
+        text_chunks = [(chunk, chunk) for chunk in split_text_for_tts(text_content, TTS_CHUNK_SIZE)]
+    char_count = sum(len(chunk) for chunk, _ in text_chunks)
+    # Outputs made by long audio jobs skip the cache, all of their text is billed
+    has_long_audio_backend = bool(GOOGLE_CLOUD_PROJECT and TTS_LONG_AUDIO_GCS_BUCKET)
+    cached_chunks = [chunk for voice_name, audio_encoding in output_variants
+                     if not uses_long_audio(text_content, audio_encoding, TTS_SSML_TIMING, has_long_audio_backend,
+                                            TTS_LONG_AUDIO_MIN_BYTES)
+                     for chunk, request_text in text_chunks
+                     if audio_cache.contains(AudioCache.make_key(request_text, voice_name, TTS_LANGUAGE_CODE, audio_encoding))]
+    cached_char_count = sum(len(chunk) for chunk in cached_chunks)
+    estimated_cost = calculate_tts_cost(char_count * len(output_variants) - cached_char_count, PRICE_PER_MILLION_CHARS_HD)
 
     print("\n###############################################################")
     print("#                        Cost Estimation")
     print(f"# Total characters in given text to synthesize: {char_count}")
+    if len(output_variants) > 1:
+        print(f"# Output versions (voice + encoding): {len(output_variants)}, each is billed")
+    print(f"# Audio cache hits: {len(cached_chunks)}/{len(text_chunks) * len(output_variants)} chunks, {cached_char_count} characters (no cost)")
     print(f"# Estimated cost: ${estimated_cost:.4f}")
     print("#")
     print("#                      IMPORTANT")
@@ -272,17 +319,35 @@ def generate_audio_from_text(text_content, source_path):
     if not create_audio or create_audio == 'y':
         os.makedirs(AUDIO_OUTPUT_FOLDER, exist_ok=True)
         base_name = os.path.splitext(os.path.basename(source_path))[0]
-        default_output_suggestion = os.path.join(AUDIO_OUTPUT_FOLDER, f"{base_name}.mp3")
+        default_output_suggestion = os.path.join(AUDIO_OUTPUT_FOLDER, f"{base_name}{AUDIO_FORMATS[TTS_AUDIO_ENCODING].extension}")
         
         unique_default_name = get_unique_filename(default_output_suggestion)
         
-        output_filename = input(f">>> Enter the desired output MP3 path (default: {unique_default_name}): ")
+        output_filename = input(f">>> Enter the desired output {TTS_AUDIO_ENCODING} path (default: {unique_default_name}): ")
         if not output_filename:
             output_filename = unique_default_name
 
         output_filename = get_unique_filename(output_filename)
 
-        text_to_speech_converter(text_content, output_filename, PRICE_PER_MILLION_CHARS_HD, TTS_CHUNK_SIZE, MAX_RETRIES, INITIAL_BACKOFF)
+        from backends import GoogleLongAudioBackend
+        # Extra versions are named after the main output: the voice is added when it differs, the extension follows the encoding
+        output_stem = os.path.splitext(output_filename)[0]
+        targets = [SynthesisTarget(output_filename, TTS_VOICE_NAME, TTS_LANGUAGE_CODE, TTS_AUDIO_ENCODING)]
+        for voice_name, audio_encoding in output_variants[1:]:
+            voice_suffix = "" if voice_name == TTS_VOICE_NAME else f"_{voice_name}"
+            extra_filename = get_unique_filename(f"{output_stem}{voice_suffix}{AUDIO_FORMATS[audio_encoding].extension}")
+            targets.append(SynthesisTarget(extra_filename, voice_name, TTS_LANGUAGE_CODE, audio_encoding))
+
+        long_audio_backend = None
+        if has_long_audio_backend:
+            long_audio_backend = GoogleLongAudioBackend(GOOGLE_CLOUD_PROJECT, TTS_LONG_AUDIO_GCS_BUCKET, TTS_LONG_AUDIO_LOCATION)
+        synthesize_targets(text_content, targets, PRICE_PER_MILLION_CHARS_HD, TTS_CHUNK_SIZE, MAX_RETRIES, INITIAL_BACKOFF, TTS_MAX_WORKERS,
+                           audio_cache=audio_cache,
+                           rate_limiter=get_rate_limiter("tts", TTS_REQUESTS_PER_MINUTE, TTS_CHARS_PER_MINUTE),
+                           long_audio_backend=long_audio_backend, long_audio_min_bytes=TTS_LONG_AUDIO_MIN_BYTES,
+                           long_audio_job_bytes=TTS_LONG_AUDIO_JOB_BYTES, long_audio_max_jobs=TTS_LONG_AUDIO_MAX_JOBS,
+                           long_audio_rate_limiter=get_rate_limiter("tts_long", TTS_LONG_AUDIO_REQUESTS_PER_MINUTE),
+                           ssml=TTS_SSML_TIMING)
     else:
         print("Skipping audio generation.")
 
@@ -292,7 +357,8 @@ def generate_audio_from_text(text_content, source_path):
 
 def main():
     print("#######################################\n##### PDF to audio conversion CLI #####\n#######################################")
-    path_completer = PathCompleter()
+    if METRICS_OUTPUT_PATH:
+        METRICS.keep_span_events = export_wants_span_events(METRICS_OUTPUT_PATH)
     while True:
         print("\nPlease choose an option:")
         print("1: Process a new PDF file")
@@ -320,6 +386,8 @@ def main():
         else:
             print("\n!!! Invalid choice, please try again. !!!")
 
+    if METRICS_OUTPUT_PATH:
+        export_metrics(METRICS_OUTPUT_PATH)
     print("\nScript finished.")
 
 if __name__ == "__main__":
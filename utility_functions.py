@@ -5,7 +5,14 @@ import ast
 import glob
 import platform
 import subprocess
-import difflib
+import array
+import collections
+import zlib
+import functools
+import json
+import hashlib
+
+from audio_stitcher import AUDIO_FORMATS
 
 def get_unique_filename(path):
     # Checks if filename exists, appends number if it does
@@ -19,6 +26,35 @@ def get_unique_filename(path):
             return new_path
         counter += 1
 
+def file_sha256(path, block_size=1024 * 1024):
+    # Content hash of a file, read in blocks so large PDFs don't have to fit in memory
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def content_key(*parts):
+    # Hex SHA-256 of the parts (bytes as they are, anything else as UTF-8 text), each prefixed with its length,
+    # so ("ab", "c") and ("a", "bc") never hash the same. Used as the entry names of the persistent caches
+    hasher = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode('utf-8')
+        hasher.update(len(data).to_bytes(8, "big"))
+        hasher.update(data)
+    return hasher.hexdigest()
+
+def sharded_path(folder, key, extension):
+    # Path of a cache entry, two-character subfolders keep any single directory small
+    return os.path.join(folder, key[:2], key + extension)
+
+def write_json_atomic(path, data):
+    # Written next to the target and swapped in, a crash mid-write never leaves a half file (e.g. a manifest) behind
+    partial_path = path + ".part"
+    with open(partial_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(partial_path, path)
+
 def open_file_for_editing(filepath):
     # Opens a file in the default system editor
     # NOTE: Only tested WSL/Windows, others are from copilot, hope they work! 
@@ -40,14 +76,25 @@ def open_file_for_editing(filepath):
         print(f"\n!!! Could not automatically open the file. Error: {e} !!!!")
         print("Open the file manually to make edits.")
 
+DIGITS_PATTERN = re.compile(r'\d+')
+
 def reduce_text_numerics(text):
     # Replaces all digits in a string with a placeholder for pattern matching
-    return re.sub(r'\d+', '_NUM_', text)
+    return DIGITS_PATTERN.sub('_NUM_', text)
 
-def stitch_and_save_partial_audio(temp_dir_path, original_output_filename):
+def stitch_and_save_partial_audio(temp_dir_path, original_output_filename, audio_encoding="MP3"):
     # Method for when voice generation fails - finds existing chunks and stitches them into a partial audio file, if requested
     print("\n--- Attempting to save partial audio ---")
-    chunk_files = sorted(glob.glob(os.path.join(temp_dir_path, "chunk_*.mp3")))
+    audio_format = AUDIO_FORMATS[audio_encoding]
+    chunk_files = sorted(glob.glob(os.path.join(temp_dir_path, f"chunk_*{audio_format.extension}")))
+
+    # With concurrent synthesis later chunks can finish before earlier ones, only keep the unbroken run from the first chunk
+    contiguous_files = []
+    for expected_index, chunk_file in enumerate(chunk_files):
+        if os.path.basename(chunk_file) != f"chunk_{expected_index:04d}{audio_format.extension}":
+            break
+        contiguous_files.append(chunk_file)
+    chunk_files = contiguous_files
     
     if not chunk_files:
         print("No completed chunks found to save.")
@@ -61,53 +108,219 @@ def stitch_and_save_partial_audio(temp_dir_path, original_output_filename):
     partial_filename = f"{base}_partial_to_chunk_{num_chunks_saved}{ext}"
     
     print(f"Combining chunks into '{partial_filename}'...")
-    with open(partial_filename, "wb") as out_file:
-        for chunk_file in chunk_files:
-            with open(chunk_file, "rb") as in_chunk:
-                out_file.write(in_chunk.read())
+    audio_format.stitch(chunk_files, partial_filename)
     
     print(f"Partial audiobook saved successfully as '{partial_filename}'")
 
+# Places where a TTS chunk may end, best first: paragraph/heading breaks ("\n\n"), list items ("\n- ") and sentence ends.
+# The whitespace after the boundary is matched so it stays attached to the preceding segment.
+TTS_SEGMENT_BOUNDARY_PATTERN = re.compile(r'\n\s*\n\s*|\n(?=- )|(?<=[.!?])\s+|(?<=[.!?]["\'\)\]])\s+')
+TTS_WORD_PATTERN = re.compile(r'\S+\s*')
+# Resync points of split_text_for_tts: a chunk at least this full ends early after a sentence whose text hash is divisible
+# by TTS_RESYNC_HASH_DIVISOR (about one sentence in that many). A lower fill or divisor falls back into step sooner after
+# an edit, but ends more chunks early: at these values prose with short sentences gives up to a fifth more chunks
+# (and requests) than packing every chunk full
+TTS_RESYNC_MIN_FILL = 0.75
+TTS_RESYNC_HASH_DIVISOR = 4
+
+def split_text_for_tts(text, max_bytes=4800, resync=True):
+    # Splits text into chunks for the TTS API, whose request limit is in UTF-8 bytes, not characters
+    # Chunks end on paragraph, list item or sentence boundaries and are packed greedily up to max_bytes.
+    # Sentences longer than max_bytes fall back to word boundaries, and single "words" longer than that to a hard byte cut.
+    # Runs in linear time, and the same text always gives the same chunks (resume relies on chunk_NNNN indices)
+    # resync=True: a chunk may also end early at a resync point (see TTS_RESYNC_MIN_FILL). Cut points then depend on nearby
+    # content instead of on everything before them, so after an edit the chunking falls back into step a few chunks later
+    # and the audio cache can reuse the rest of the document. resync=False packs every chunk full, for the fewest chunks
+    if not text:
+        return []
+
+    resync_min_bytes = int(max_bytes * TTS_RESYNC_MIN_FILL) if resync else None
+
+    chunks = []
+    current_parts = []
+    current_bytes = 0
+
+    def flush():
+        nonlocal current_parts, current_bytes
+        chunk = "".join(current_parts).strip()
+        if chunk:
+            chunks.append(chunk)
+        current_parts = []
+        current_bytes = 0
+
+    def add_piece(piece, piece_bytes):
+        nonlocal current_bytes
+        if current_parts and current_bytes + piece_bytes > max_bytes:
+            flush()
+        current_parts.append(piece)
+        current_bytes += piece_bytes
+
+    segment_start = 0
+    for boundary in TTS_SEGMENT_BOUNDARY_PATTERN.finditer(text):
+        segment = text[segment_start:boundary.end()]
+        segment_start = boundary.end()
+        _add_tts_segment(segment, max_bytes, add_piece)
+        if (resync_min_bytes is not None and current_bytes >= resync_min_bytes
+                and zlib.crc32(segment.strip().encode('utf-8')) % TTS_RESYNC_HASH_DIVISOR == 0):
+            flush()
+    if segment_start < len(text):
+        _add_tts_segment(text[segment_start:], max_bytes, add_piece)
+
+    flush()
+    return chunks
+
+def _add_tts_segment(segment, max_bytes, add_piece):
+    # Feeds one sentence/paragraph segment to the packer, breaking it up first if it can never fit in one chunk
+    segment_bytes = len(segment.encode('utf-8'))
+    if segment_bytes <= max_bytes:
+        add_piece(segment, segment_bytes)
+        return
+
+    for word_match in TTS_WORD_PATTERN.finditer(segment):
+        word = word_match.group(0)
+        encoded_word = word.encode('utf-8')
+        if len(encoded_word) <= max_bytes:
+            add_piece(word, len(encoded_word))
+            continue
+
+        # No whitespace to split on, cut at the byte limit without breaking a multi-byte character
+        while encoded_word:
+            piece = encoded_word[:max_bytes].decode('utf-8', errors='ignore')
+            if not piece:
+                # max_bytes smaller than a single character, take the character anyway
+                piece = encoded_word.decode('utf-8')[0]
+            piece_bytes = len(piece.encode('utf-8'))
+            add_piece(piece, piece_bytes)
+            encoded_word = encoded_word[piece_bytes:]
+
 def calculate_tts_cost(character_count, price_per_million_chars):
     # Calculates the estimated cost for a given number of characters
     return (character_count / 1_000_000) * price_per_million_chars
 
-def smart_stitch(previous_text, new_text, search_window=4000):
+# Overlap detection for smart_stitch: longest run of identical words shared by the end of one text and the start of
+# the next. Words are interned to ints and compared as arrays, the longest run is found by binary search over its
+# length with a rolling hash check per length, so the cost is ~(n + m) * log(min(n, m)) even on repetitive text
+WORD_TOKEN_PATTERN = re.compile(r'\S+')
+_OVERLAP_HASH_MODULUS = (1 << 61) - 1
+_OVERLAP_HASH_BASE = 1_000_003
+# A run of this many words is treated as certainly the same passage, shorter runs get proportionally lower confidence
+CONFIDENT_OVERLAP_WORDS = 40
+
+OverlapMatch = collections.namedtuple("OverlapMatch", "size tail_start head_start head_cut_index confidence")
+
+def _tokenize_for_overlap(text, vocabulary):
+    # Word ids (shared vocabulary across both texts) and the end offset of every word
+    word_ids = array.array('q')
+    word_ends = array.array('q')
+    for m in WORD_TOKEN_PATTERN.finditer(text):
+        word_ids.append(vocabulary.setdefault(m.group(0), len(vocabulary) + 1))
+        word_ends.append(m.end())
+    return word_ids, word_ends
+
+def _prefix_hashes(word_ids):
+    hashes = [0] * (len(word_ids) + 1)
+    value = 0
+    for index, word_id in enumerate(word_ids):
+        value = (value * _OVERLAP_HASH_BASE + word_id) % _OVERLAP_HASH_MODULUS
+        hashes[index + 1] = value
+    return hashes
+
+def _find_common_run(tail_ids, head_ids, tail_hashes, head_hashes, powers, length):
+    # (tail_start, head_start) of a shared run of `length` words, earliest in the tail then earliest in the head,
+    # or None. Hash hits are verified against the words, so a collision can't produce a wrong match
+    power = powers[length]
+    tail_starts = {}
+    for i in range(len(tail_ids) - length + 1):
+        window_hash = (tail_hashes[i + length] - tail_hashes[i] * power) % _OVERLAP_HASH_MODULUS
+        tail_starts.setdefault(window_hash, []).append(i)
+
+    best = None
+    for j in range(len(head_ids) - length + 1):
+        window_hash = (head_hashes[j + length] - head_hashes[j] * power) % _OVERLAP_HASH_MODULUS
+        for i in tail_starts.get(window_hash, ()):
+            if best is not None and i >= best[0]:
+                break
+            if tail_ids[i:i + length] == head_ids[j:j + length]:
+                best = (i, j)
+                break
+    return best
+
+def find_text_overlap(tail_text, head_text):
+    # Longest run of words that tail_text and head_text share, as an OverlapMatch:
+    #   size            - words in the run (0 if nothing is shared)
+    #   tail_start      - word index of the run in tail_text, head_start the same for head_text
+    #   head_cut_index  - character offset in head_text right after the run, new text continues from there
+    #   confidence      - 0..1, how sure we are the run is the real seam: long runs score higher, and words of
+    #                     the tail that come after the run (text the run does not explain) lower it
+    vocabulary = {}
+    tail_ids, _ = _tokenize_for_overlap(tail_text, vocabulary)
+    head_ids, head_ends = _tokenize_for_overlap(head_text, vocabulary)
+
+    max_length = min(len(tail_ids), len(head_ids))
+    if max_length == 0:
+        return OverlapMatch(0, 0, 0, 0, 0.0)
+
+    tail_hashes = _prefix_hashes(tail_ids)
+    head_hashes = _prefix_hashes(head_ids)
+    powers = [1] * (max_length + 1)
+    for length in range(1, max_length + 1):
+        powers[length] = powers[length - 1] * _OVERLAP_HASH_BASE % _OVERLAP_HASH_MODULUS
+
+    # A shared run of length L contains one of every shorter length, so the longest length can be binary searched
+    best_length, best_position = 0, None
+    low, high = 1, max_length
+    while low <= high:
+        length = (low + high) // 2
+        position = _find_common_run(tail_ids, head_ids, tail_hashes, head_hashes, powers, length)
+        if position is None:
+            high = length - 1
+        else:
+            best_length, best_position = length, position
+            low = length + 1
+
+    if best_position is None:
+        return OverlapMatch(0, 0, 0, 0, 0.0)
+
+    tail_start, head_start = best_position
+    trailing_tail_words = len(tail_ids) - (tail_start + best_length)
+    confidence = (min(1.0, best_length / CONFIDENT_OVERLAP_WORDS)
+                  * best_length / (best_length + trailing_tail_words))
+    head_cut_index = head_ends[head_start + best_length - 1]
+    return OverlapMatch(best_length, tail_start, head_start, head_cut_index, round(confidence, 3))
+
+def smart_stitch(previous_text, new_text, search_window=4000, min_overlap_words=11, min_confidence=0.0):
     # Stitches two texts using word-based matching to ignore whitespace/formatting differences
+    # Overlaps shorter than min_overlap_words or below min_confidence are not trusted, the texts are joined with a newline then
     if not previous_text:
         return new_text
 
     tail = previous_text[-search_window:]
     head = new_text[:search_window]
+    match = find_text_overlap(tail, head)
 
-    def tokenize_with_indices(text):
-        tokens = []
-        for m in re.finditer(r'\S+', text):
-            tokens.append({
-                "word": m.group(0),
-                "start": m.start(),
-                "end": m.end()
-            })
-        return tokens
-
-    tail_tokens = tokenize_with_indices(tail)
-    head_tokens = tokenize_with_indices(head)
-    
-    tail_words = [t["word"] for t in tail_tokens]
-    head_words = [t["word"] for t in head_tokens]
-
-    matcher = difflib.SequenceMatcher(None, tail_words, head_words)
-    match = matcher.find_longest_match(0, len(tail_words), 0, len(head_words))
-
-    if match.size > 10:
-        print(f"    [Stitch] Found overlap of {match.size} words.")
-        last_match_word_idx = match.b + match.size - 1
-        cut_char_index = head_tokens[last_match_word_idx]["end"]
-        return previous_text + new_text[cut_char_index:]
+    if match.size >= min_overlap_words and match.confidence >= min_confidence:
+        print(f"    [Stitch] Found overlap of {match.size} words (confidence {match.confidence:.2f}).")
+        return previous_text + new_text[match.head_cut_index:]
+    elif match.size:
+        print(f"    [Stitch] Overlap of {match.size} words (confidence {match.confidence:.2f}) too weak. Appending with newline.")
     else:
         print("    [Stitch] No overlap found. Appending with newline.")
-        return previous_text + "\n" + new_text
+    return previous_text + "\n" + new_text
     
+# Patterns are compiled once here, is_likely_heading and is_list_item run on every line of a document
+ROMAN_HEADING_PATTERN = re.compile(r'^[IVXLCDM]+\s*[:.]\s+[A-Z]')
+KEYWORD_HEADING_PATTERN = re.compile(r'^(?:chapter|section|part|appendix|figure|table)\s+\w+', re.IGNORECASE)
+NUMBERED_HEADING_PATTERN = re.compile(r'^\d+(?:\.\d+)*\.?\s+[A-Z]')
+ASCII_LOWERCASE_PATTERN = re.compile(r'[a-z]')
+ASCII_UPPERCASE_PATTERN = re.compile(r'[A-Z]')
+
+def is_all_caps_text(text, min_letters=1):
+    # True if text has at least min_letters ASCII letters and none of them are lowercase, digits/punctuation are ignored
+    # Same result as re.sub(r'[^a-zA-Z]', '', text).isupper() plus a length check, without building the stripped string
+    if ASCII_LOWERCASE_PATTERN.search(text):
+        return False
+    return len(ASCII_UPPERCASE_PATTERN.findall(text)) >= min_letters
+
 def is_likely_heading(text):
     text = text.strip()
     if not text:
@@ -124,11 +337,11 @@ def is_likely_heading(text):
     # \s*[:.]     : Optional space, then MANDATORY punctuation (dot or colon) to avoid matching words like "I" or "MIX"
     # \s+         : Space
     # [A-Z]       : Followed by a capital letter (The title text)
-    if re.match(r'^[IVXLCDM]+\s*[:.]\s+[A-Z]', text):
+    if ROMAN_HEADING_PATTERN.match(text):
         return True
 
     # Matches standard keywords like "Chapter 1", "Section IV", "3. Results", "Appendix A"
-    if re.match(r'^(?:chapter|section|part|appendix|figure|table)\s+\w+', text, re.IGNORECASE):
+    if KEYWORD_HEADING_PATTERN.match(text):
         return True
     
     # Looks for numbered sections like "1. Introduction" or "2.3 Methodology"
@@ -137,34 +350,78 @@ def is_likely_heading(text):
     # \.?           : OPTIONAL trailing dot (Handles "4.1.1." AND "4.1.1")
     # \s+           : Space
     # [A-Z]         : Followed by a capital letter
-    if re.match(r'^\d+(?:\.\d+)*\.?\s+[A-Z]', text):
+    if NUMBERED_HEADING_PATTERN.match(text):
         return True
 
     # All caps check, some styles have headings so, allowing for some punctuation so stripping digits and spaces to check if the LETTERS are uppercase
-    clean_letters = re.sub(r'[^a-zA-Z]', '', text)
-    if len(clean_letters) > 3 and clean_letters.isupper():
+    if is_all_caps_text(text, min_letters=4):
         return True
 
     return False
 
+# Both citation-corruption fixes below as one pattern, see clean_common_pdf_artifacts for what each part matches.
+# The first alternative covers "word?12!3": removing "?12" on its own would leave "word!3" for the "!digit" fix to catch.
+# Every alternative starts with the literal '?' or '!' and checks the preceding character with a lookbehind after it,
+# which lets the regex engine skip straight to candidate positions instead of evaluating lookbehinds everywhere
+ARTIFACT_PATTERN = re.compile(r'\?(?<=[a-zA-Z]\?)\d+(?:\?\d+)*!\d+|\?(?<=[a-zA-Z0-9\)]\?)\d+|!(?<=[a-zA-Z]!)\d+')
+
+def _trie_regex(targets):
+    # Regex for a set of literal strings, shaped like a trie: "ab", "abc", "b" -> "(?:ab(?:c)?|b)"
+    # At each position the engine only follows characters that continue some target, so cost depends on target length,
+    # not on how many targets there are. Greedy optional groups make the longest target win.
+    trie = {}
+    for target in targets:
+        node = trie
+        for char in target:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def node_pattern(node):
+        branches = [re.escape(char) + node_pattern(child) for char, child in sorted(node.items()) if char != '']
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # A target ends here but longer ones continue, so the rest is optional
+        if '' in node:
+            pattern = '(?:' + pattern + ')?'
+        return pattern
+
+    return node_pattern(trie)
+
+@functools.lru_cache(maxsize=32)
+def _compile_replacement_pattern(targets):
+    return re.compile(_trie_regex(targets))
+
+def apply_replacement_rules(text, fixes=None):
+    # Applies a {target: replacement} dict of literal fixes in a single pass over the text
+    # Precedence when rules overlap, independent of dict order:
+    #   - text is scanned left to right, the leftmost match wins
+    #   - of the targets starting at the same position, the longest wins ("! ®" beats "!")
+    #   - replaced text is not scanned again, so one rule's output never feeds another rule
+    if not text or not fixes:
+        return text
+    rules = {target: replacement for target, replacement in fixes.items() if target}
+    if not rules:
+        return text
+    pattern = _compile_replacement_pattern(tuple(sorted(rules)))
+    return pattern.sub(lambda match: rules[match.group(0)], text)
+
 def clean_common_pdf_artifacts(text, custom_fixes=None):
     # Scan for and removes specific PDF text layer corruption patterns, can add custom features here. 
     if not text:
         return text
     
     # Custom fixes, for my pdf now a superscript becomes "! ®" for example
-    if custom_fixes:
-        for target, replacement in custom_fixes.items():
-            text = text.replace(target, replacement)
+    # All rules go through one pass, see apply_replacement_rules for which rule wins when they overlap
+    text = apply_replacement_rules(text, custom_fixes)
 
     # 2. Fix for question-mark+digit corruption, a common mapping error for superscript citations like '26'
     # Matches any letter/paren/digit, followed by '?', then a digit
     # Example: "1947)?6" -> "1947)" | "Daubert?6" -> "Daubert"
-    text = re.sub(r'(?<=[a-zA-Z0-9\)])\?\d+', '', text)
-
     # 3. Fix for exclamation+digit or similar weird suffixes
     # Matches: word followed immediately by '!' and a digit (if that ever happens)
-    text = re.sub(r'(?<=[a-zA-Z])!\d+', '', text)
+    # Both done in one pass with ARTIFACT_PATTERN
+    text = ARTIFACT_PATTERN.sub('', text)
 
     return text
 
@@ -203,10 +460,13 @@ def load_custom_fixes_from_file(file_path):
         print("Ensure the file contains a valid Python dictionary structure like {'bad': 'good'}.")
         return {}
     
+BULLET_LIST_PATTERN = re.compile(r'^\s*([•●\-\*])\s+(.*)')
+NUMBERED_LIST_PATTERN = re.compile(r'^\s*(?:\d+\.|[IVX]+\.)\s+[A-Z]')
+
 def is_list_item(text):
     # Check if item is a list, must start with bullet + SPACE or something like that.
     # The \s+ ensures "-word" is ignored, but "- Word" is caught, so hyphenation still works...
-    match = re.match(r'^\s*([•●\-\*])\s+(.*)', text)
+    match = BULLET_LIST_PATTERN.match(text)
     
     if match:
         content = match.group(2) # text after bullet
@@ -224,7 +484,7 @@ def is_list_item(text):
 
     # Check for numbered lists "1. " or "IV. "
     # Must be followed by space.
-    if re.match(r'^\s*(?:\d+\.|[IVX]+\.)\s+[A-Z]', text):
+    if NUMBERED_LIST_PATTERN.match(text):
         return True
         
     return False
\ No newline at end of file